@@ -29,6 +29,7 @@ import imp
 import os
 import sys
 import json
+import itertools
 
 
 DRIVERS_LOCATION = '/usr/local/lib/datastore/drivers'
@@ -43,6 +44,48 @@ class DuplicateKeyException(DatastoreException):
     pass
 
 
+class DatastoreBatch(object):
+    """
+    Collects datastore operations and executes them on exit using the
+    bulk (*_many) driver methods. Consecutive operations of the same kind
+    on the same collection are sent together, in submission order, inside
+    a single driver transaction. ``results`` holds a (pkey, error) tuple
+    for every operation.
+    """
+    def __init__(self, datastore):
+        self.datastore = datastore
+        self.operations = []
+        self.results = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            self.execute()
+
+    def insert(self, collection, obj):
+        self.operations.append((collection, 'insert', obj))
+
+    def update(self, collection, pkey, obj):
+        self.operations.append((collection, 'update', (pkey, obj)))
+
+    def upsert(self, collection, pkey, obj):
+        self.operations.append((collection, 'upsert', (pkey, obj)))
+
+    def delete(self, collection, pkey):
+        self.operations.append((collection, 'delete', pkey))
+
+    def execute(self):
+        operations, self.operations = self.operations, []
+        with self.datastore.transaction():
+            for (collection, kind), group in itertools.groupby(operations, key=lambda o: (o[0], o[1])):
+                fn = getattr(self.datastore, '{0}_many'.format(kind))
+                self.results.extend(fn(collection, [o[2] for o in group]))
+
+        return self.results
+
+
 def get_datastore(type, dsn, database='freenas'):
     mod = imp.load_source(type, os.path.join(DRIVERS_LOCATION, type, type + '.py'))
     if mod is None:
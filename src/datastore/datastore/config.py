@@ -26,9 +26,17 @@
 #####################################################################
 
 import re
+import copy
+import time
+import threading
 from datastore import DatastoreException
 
 
+# Versions are wall clock timestamps taken before the write is committed,
+# so sync() looks back a bit to catch writes that took a while to land
+VERSION_SLACK = 5
+
+
 class ConfigNode(object):
     def __init__(self, path, root):
         self.path = path
@@ -58,10 +66,7 @@ class ConfigNode(object):
         return result
 
     def __getstate__(self):
-        if not self.has_children:
-            return self.value
-
-        return {k: self[k].__getstate__() for k in self.children}
+        return self.root.get_subtree(self.path)
 
     def __getitem__(self, item):
         return ConfigNode(self.path + '.' + item, self.root)
@@ -90,39 +95,183 @@ class ConfigNode(object):
 
 
 class ConfigStore(object):
-    def __init__(self, datastore):
+    """
+    Accessor for the ``config`` collection.
+
+    With ``cached=True`` the whole collection is loaded up front and all
+    reads are served from memory; ``set`` writes through to the datastore.
+    Other processes are told about changed keys through ``notify``
+    callable (usually emitting ``config.changed`` event) and are expected
+    to call ``invalidate`` when they receive such notification. Keys being
+    invalidated are read from the datastore until they are re-fetched.
+
+    Every write also stamps the key with a version. Consumers which cannot
+    rely on the notification arriving before their next read (eg. an RPC
+    issued right after ``set`` by another process) call ``sync`` first,
+    which re-reads all keys written since the last sync.
+    """
+    def __init__(self, datastore, cached=False, notify=None):
         self.__datastore = datastore
+        self.__cache = None
+        self.__stale = {}
+        self.__version = 0
+        self.__lock = threading.RLock()
+        self.__notify = notify
         if not self.__datastore.collection_exists('config'):
             raise DatastoreException("'config' collection doesn't exist")
 
+        if cached:
+            self.reload()
+
     @staticmethod
     def create(datastore):
         datastore.collection_create('config', 'ltree', 'config')
 
+    @property
+    def cached(self):
+        return self.__cache is not None
+
+    def __is_fresh(self, key=None):
+        # Tells whether cache may be used for given key (or for any key)
+        if self.__cache is None:
+            return False
+
+        if key is None:
+            return not self.__stale
+
+        return key not in self.__stale
+
+    def reload(self):
+        cache = {}
+        version = 0
+        for i in self.__datastore.query('config'):
+            cache[i['id']] = i.get('value')
+            version = max(version, i.get('version', 0))
+
+        with self.__lock:
+            self.__cache = cache
+            self.__version = version
+
+    def invalidate(self, keys):
+        if not self.cached:
+            return
+
+        # Mark keys first, so that reads happening before they are re-fetched
+        # go to the datastore instead of returning stale values
+        with self.__lock:
+            for key in keys:
+                self.__stale[key] = self.__stale.get(key, 0) + 1
+
+        for key in keys:
+            fetched = False
+            try:
+                ret = self.__datastore.get_by_id('config', key)
+                fetched = True
+            finally:
+                with self.__lock:
+                    if fetched:
+                        if ret is None:
+                            self.__cache.pop(key, None)
+                        else:
+                            self.__cache[key] = ret.get('value')
+
+                    self.__stale[key] -= 1
+                    if not self.__stale[key]:
+                        del self.__stale[key]
+
+    def sync(self):
+        if not self.cached:
+            return
+
+        changed = self.__datastore.query('config', ('version', '>', self.__version - VERSION_SLACK))
+        with self.__lock:
+            for i in changed:
+                self.__cache[i['id']] = i.get('value')
+                self.__version = max(self.__version, i['version'])
+
     def exists(self, key):
+        with self.__lock:
+            if self.__is_fresh(key):
+                return key in self.__cache
+
         return self.__datastore.exists('config', ('id', '=', key))
 
     def get(self, key, default=None):
+        with self.__lock:
+            if self.__is_fresh(key):
+                if key not in self.__cache:
+                    return default
+
+                return copy.deepcopy(self.__cache[key])
+
         ret = self.__datastore.get_one('config', ('id', '=', key))
         return ret['value'] if ret is not None else default
 
     def set(self, key, value):
-        self.__datastore.upsert('config', key, value, config=True)
+        self.__datastore.upsert('config', key, {'value': value, 'version': time.time()})
+        with self.__lock:
+            if self.cached:
+                self.__cache[key] = copy.deepcopy(value)
+
+        if self.__notify:
+            self.__notify([key])
 
     def list_children(self, key=None):
+        with self.__lock:
+            if self.__is_fresh():
+                prefix = key + '.' if key is not None else ''
+                return [
+                    {'id': k, 'value': copy.deepcopy(v)}
+                    for k, v in self.__cache.items() if k.startswith(prefix)
+                ]
+
         if key is None:
             return self.__datastore.query('config', wrap=False)
         return self.__datastore.query('config', ('id', '~', key + '\..*'), wrap=False)
 
     def children_dict(self, root):
+        with self.__lock:
+            if self.__is_fresh():
+                regex = re.compile(re.escape(root) + '\.[a-zA-Z0-9_]+\.')
+                items = [{'id': k, 'value': v} for k, v in self.__cache.items() if regex.match(k)]
+            else:
+                items = None
+
+        if items is None:
+            items = self.__datastore.query('config', ('id', '~', re.escape(root) + '\.[a-zA-Z0-9_]+\.'))
+
         result = {}
-        for item in self.__datastore.query('config', ('id', '~', re.escape(root) + '\.[a-zA-Z0-9_]+\.')):
+        for item in items:
             matched = item['id'][len(root) + 1:]
             key, _, value = matched.partition('.')
 
             if key not in list(result.keys()):
                 result[key] = {}
 
-            result[key][value] = item['value']
+            result[key][value] = copy.deepcopy(item['value'])
+
+        return result
+
+    def get_subtree(self, root):
+        # Snapshot of whole subtree using single lookup, nodes having children
+        # are represented as dicts, leaves as their values
+        result = {}
+        for item in self.list_children(root):
+            path = [i for i in item['id'][len(root) + 1:].split('.') if i]
+            if not path:
+                continue
+
+            ptr = result
+            for name in path[:-1]:
+                if not isinstance(ptr.get(name), dict) or name not in ptr:
+                    ptr[name] = {}
+
+                ptr = ptr[name]
+
+            if path[-1] not in ptr:
+                ptr[path[-1]] = item['value']
+
+        if not result:
+            return self.get(root)
 
         return result
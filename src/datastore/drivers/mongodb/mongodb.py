@@ -26,16 +26,18 @@
 #####################################################################
 
 
+import re
 import time
 import copy
 import uuid
+import contextlib
 import dateutil.parser
 from datetime import datetime
 from pymongo import MongoClient
 import pymongo
 import pymongo.errors
 from six import string_types
-from datastore import DuplicateKeyException
+from datastore import DatastoreException, DuplicateKeyException, DatastoreBatch
 from freenas.utils.query import wrap
 
 
@@ -44,6 +46,14 @@ class MongodbDatastore(object):
         self.conn = None
         self.db = None
         self.log_db = None
+        self.collections_cache = {}
+        self.pkey_blocks = {}
+        self.seeded_sequences = set()
+        self.collections_cache_stats = {
+            'hits': 0,
+            'misses': 0,
+            'invalidations': 0
+        }
         self.operators_table = {
             '>': '$gt',
             '<': '$lt',
@@ -110,8 +120,25 @@ class MongodbDatastore(object):
 
         return {'$and': result} if len(result) > 0 else {}
 
+    def _get_collection_metadata(self, collection):
+        item = self.collections_cache.get(collection)
+        if item is not None:
+            self.collections_cache_stats['hits'] += 1
+            return item
+
+        self.collections_cache_stats['misses'] += 1
+        item = self.db['collections'].find_one({"_id": collection})
+        if item is not None:
+            self.collections_cache[collection] = item
+
+        return item
+
+    def _invalidate_collection_metadata(self, collection):
+        self.collections_cache_stats['invalidations'] += 1
+        self.collections_cache.pop(collection, None)
+
     def _get_db(self, collection):
-        c = self.db['collections'].find_one({"_id": collection})
+        c = self._get_collection_metadata(collection)
         typ = c['attributes'].get('type', 'config')
 
         if typ == 'log':
@@ -128,6 +155,7 @@ class MongodbDatastore(object):
         attributes = attributes or {}
         ttl_index = attributes.get('ttl_index')
         unique_indexes = attributes.get('unique_indexes', [])
+        indexes = attributes.get('indexes', [])
         cap = attributes.get('cap')
 
         if not self.db['collections'].find_one(name):
@@ -137,6 +165,8 @@ class MongodbDatastore(object):
                 'attributes': attributes
             })
 
+        self._invalidate_collection_metadata(name)
+
         db = self._get_db(name).database
 
         if name not in db.collection_names():
@@ -157,6 +187,12 @@ class MongodbDatastore(object):
 
             self.db[name].create_index([(i, pymongo.ASCENDING) for i in idx], unique_indexes=True)
 
+        for idx in indexes:
+            if isinstance(idx, str):
+                idx = [idx]
+
+            db[name].create_index([(i, pymongo.ASCENDING) for i in idx])
+
         self.db[name].create_index([('$**', pymongo.TEXT)])
 
     def collection_exists(self, name):
@@ -183,6 +219,7 @@ class MongodbDatastore(object):
         migs = item.setdefault('migrations', [])
         migs.append(migration_name)
         self.db['collections'].update({'_id': name}, item)
+        self._invalidate_collection_metadata(name)
 
     def collection_list(self):
         return [x['_id'] for x in self.db['collections'].find()]
@@ -193,20 +230,70 @@ class MongodbDatastore(object):
 
         self._get_db(name).drop()
         self.db['collections'].remove({'_id': name})
+        self.db['sequences'].remove({'_id': name})
+        self._invalidate_collection_metadata(name)
+        self.seeded_sequences.discard(name)
+        self.pkey_blocks.pop(name, None)
 
     def collection_get_pkey_type(self, name):
-        item = self.db['collections'].find_one({"_id": name})
+        item = self._get_collection_metadata(name)
         return item['pkey-type']
 
+    def collection_get_cache_stats(self):
+        stats = self.collections_cache_stats.copy()
+        stats['cached'] = len(self.collections_cache)
+        stats['saved_round_trips'] = stats['hits']
+        return stats
+
     def collection_get_next_pkey(self, name, prefix):
-        counter = 0
-        while True:
-            pkey = prefix + str(counter)
-            if not self.exists(name, ('id', '=', pkey)):
-                return pkey
+        taken = set()
+        regex = '^{0}[0-9]+$'.format(re.escape(prefix))
+        for i in self._get_db(name).find({'_id': {'$regex': regex}}, {'_id': True}):
+            taken.add(int(i['_id'][len(prefix):]))
 
+        counter = 0
+        while counter in taken:
             counter += 1
 
+        return prefix + str(counter)
+
+    def _seed_sequence(self, collection):
+        # Make sure sequence counter is not behind documents inserted
+        # with explicit keys (or before the sequence existed)
+        ret = self._get_db(collection).find_one(sort=[('_id', pymongo.DESCENDING)])
+        self.db['sequences'].update(
+            {'_id': collection},
+            {'$max': {'seq': ret['_id'] if ret else 0}},
+            upsert=True
+        )
+
+        self.seeded_sequences.add(collection)
+        self.pkey_blocks.pop(collection, None)
+
+    def _allocate_pkeys(self, collection, count=1):
+        block = self.pkey_blocks.get(collection)
+        if block and block[1] - block[0] >= count:
+            start = block[0]
+            block[0] += count
+            return list(range(start, start + count))
+
+        if collection not in self.seeded_sequences:
+            self._seed_sequence(collection)
+
+        attrs = self._get_collection_metadata(collection)['attributes']
+        size = max(count, attrs.get('pkey_block_size', 1))
+        ret = self.db['sequences'].find_and_modify(
+            {'_id': collection},
+            {'$inc': {'seq': size}},
+            upsert=True,
+            new=True
+        )
+
+        end = ret['seq'] + 1
+        start = end - size
+        self.pkey_blocks[collection] = [start + count, end]
+        return list(range(start, start + count))
+
     def query(self, collection, *args, **kwargs):
         sort = kwargs.pop('sort', None)
         limit = kwargs.pop('limit', None)
@@ -314,7 +401,7 @@ class MongodbDatastore(object):
             obj = copy.copy(obj)
 
         autopkey = pkey is None and 'id' not in obj
-        retries = 100
+        retries = 3
 
         if 'id' in obj:
             pkey = obj.pop('id')
@@ -323,8 +410,7 @@ class MongodbDatastore(object):
             if autopkey:
                 pkey_type = self.collection_get_pkey_type(collection)
                 if pkey_type in ('serial', 'integer'):
-                    ret = self._get_db(collection).find_one(sort=[('_id', pymongo.DESCENDING)])
-                    pkey = ret['_id'] + 1 if ret else 1
+                    pkey = self._allocate_pkeys(collection)[0]
                 elif pkey_type == 'uuid':
                     pkey = str(uuid.uuid4())
 
@@ -340,12 +426,134 @@ class MongodbDatastore(object):
             except pymongo.errors.DuplicateKeyError:
                 if autopkey and retries > 0:
                     retries -= 1
+                    self._seed_sequence(collection)
                     continue
 
                 raise DuplicateKeyException('Document with given key already exists')
 
             return pkey
 
+    def _prepare_object(self, obj, config=False, deep=False):
+        if hasattr(obj, '__getstate__'):
+            return obj.__getstate__()
+
+        if type(obj) is not dict or config:
+            return {'value': obj}
+
+        return copy.deepcopy(obj) if deep else copy.copy(obj)
+
+    def _execute_bulk(self, bulk, results, indexes):
+        if not indexes:
+            return
+
+        try:
+            bulk.execute()
+        except pymongo.errors.BulkWriteError as err:
+            for e in err.details.get('writeErrors', []):
+                idx = indexes[e['index']]
+                if e['code'] == 11000:
+                    exc = DuplicateKeyException('Document with given key already exists')
+                else:
+                    exc = DatastoreException(e['errmsg'])
+
+                results[idx] = (results[idx][0], exc)
+
+    def insert_many(self, collection, objects, timestamp=True, config=False):
+        db = self._get_db(collection)
+        bulk = db.initialize_unordered_bulk_op()
+        results = []
+        docs = [self._prepare_object(obj, config) for obj in objects]
+        unkeyed = [i for i in docs if i.get('id') is None]
+        pkey_type = self.collection_get_pkey_type(collection) if unkeyed else None
+        serials = None
+        t = datetime.now()
+
+        if pkey_type in ('serial', 'integer'):
+            serials = iter(self._allocate_pkeys(collection, len(unkeyed)))
+
+        for obj in docs:
+            pkey = obj.pop('id', None)
+            if pkey is None:
+                if serials:
+                    pkey = next(serials)
+                elif pkey_type == 'uuid':
+                    pkey = str(uuid.uuid4())
+
+            obj['_id'] = pkey
+            if timestamp:
+                obj['updated_at'] = t
+                obj['created_at'] = t
+
+            bulk.insert(obj)
+            results.append((pkey, None))
+
+        self._execute_bulk(bulk, results, list(range(len(results))))
+        return results
+
+    def update_many(self, collection, items, upsert=False, timestamp=True, config=False):
+        items = list(items)
+        db = self._get_db(collection)
+        bulk = db.initialize_unordered_bulk_op()
+        results = []
+        indexes = []
+        created = {}
+        t = datetime.now()
+
+        if (timestamp or not upsert) and items:
+            for i in db.find({'_id': {'$in': [pkey for pkey, _ in items]}}, {'created_at': True}):
+                created[i['_id']] = i.get('created_at', t)
+
+        for pkey, obj in items:
+            if not upsert and pkey not in created:
+                results.append((pkey, DatastoreException('Document {0} not found'.format(pkey))))
+                continue
+
+            obj = self._prepare_object(obj, config, deep=True)
+            if 'id' in obj and pkey != obj['id']:
+                # Key change cannot be expressed as a bulk operation
+                try:
+                    self.update(collection, pkey, obj, upsert=upsert, timestamp=timestamp)
+                    results.append((obj['id'], None))
+                except DatastoreException as err:
+                    results.append((pkey, err))
+
+                continue
+
+            obj.pop('id', None)
+            if timestamp:
+                obj['updated_at'] = t
+                obj['created_at'] = created.get(pkey, t)
+
+            op = bulk.find({'_id': pkey})
+            if upsert:
+                op = op.upsert()
+
+            op.replace_one(obj)
+            indexes.append(len(results))
+            results.append((pkey, None))
+
+        self._execute_bulk(bulk, results, indexes)
+        return results
+
+    def upsert_many(self, collection, items, timestamp=True, config=False):
+        return self.update_many(collection, items, upsert=True, timestamp=timestamp, config=config)
+
+    def delete_many(self, collection, pkeys):
+        pkeys = list(pkeys)
+        if pkeys:
+            self._get_db(collection).remove({'_id': {'$in': pkeys}})
+
+        return [(pkey, None) for pkey in pkeys]
+
+    @contextlib.contextmanager
+    def transaction(self):
+        # MongoDB does not provide multi-document transactions; operations
+        # are applied as they are executed
+        yield
+
+    def batch(self):
+        return DatastoreBatch(self)
+
     def update(self, collection, pkey, obj, upsert=False, timestamp=True, config=False):
         if hasattr(obj, '__getstate__'):
             obj = obj.__getstate__()
@@ -372,6 +580,15 @@ class MongodbDatastore(object):
         db = self._get_db(collection)
         db.update({'_id': pkey}, obj, upsert=upsert)
 
+    def update_fields(self, collection, pkey, fields, timestamp=True):
+        fields = dict(fields)
+        fields.pop('id', None)
+        if timestamp:
+            fields['updated_at'] = datetime.now()
+
+        db = self._get_db(collection)
+        db.update({'_id': pkey}, {'$set': fields})
+
     def upsert(self, collection, pkey, obj, config=False):
         return self.update(collection, pkey, obj, upsert=True, config=config)
 
@@ -27,9 +27,11 @@
 
 import logging
 import json
+import contextlib
+from datetime import datetime
 import psycopg2
 import psycopg2.extras
-from datastore import DuplicateKeyException
+from datastore import DatastoreException, DuplicateKeyException, DatastoreBatch
 
 class PostgresSelectQuery(object):
     ASC = 'ASC'
@@ -96,6 +98,51 @@ class PostgresSelectQuery(object):
 class PostgresDatastore(object):
     def __init__(self):
         self.logger = logging.getLogger('PostgresDatastore')
+        self.transaction_depth = 0
+
+    def __commit(self):
+        if self.transaction_depth == 0:
+            self.conn.commit()
+
+    def __rollback(self):
+        # Inside of a transaction the exception is going to abort it anyway
+        if self.transaction_depth == 0:
+            self.conn.rollback()
+
+    def __execute_values(self, cur, sql, rows, template=None):
+        # Returns a (returned id, error) tuple for each row. Whole set of rows
+        # is tried at once first; in case of failure, rows are retried one by
+        # one to pinpoint erroneous ones.
+        cur.execute('SAVEPOINT bulk')
+        try:
+            returned = psycopg2.extras.execute_values(cur, sql, rows, template=template, fetch=True)
+            cur.execute('RELEASE SAVEPOINT bulk')
+            if len(returned) == len(rows):
+                return [(i[0], None) for i in returned]
+
+            # Some rows were not matched (UPDATE). Those are keyed by their
+            # first value, so match them against the returned ids.
+            returned = set(str(i[0]) for i in returned)
+            return [(row[0] if str(row[0]) in returned else None, None) for row in rows]
+        except psycopg2.Error:
+            cur.execute('ROLLBACK TO SAVEPOINT bulk')
+
+        result = []
+        for row in rows:
+            cur.execute('SAVEPOINT bulk_item')
+            try:
+                returned = psycopg2.extras.execute_values(cur, sql, [row], template=template, fetch=True)
+                cur.execute('RELEASE SAVEPOINT bulk_item')
+                result.append((returned[0][0] if returned else None, None))
+            except psycopg2.IntegrityError as e:
+                cur.execute('ROLLBACK TO SAVEPOINT bulk_item')
+                result.append((None, DuplicateKeyException(e)))
+            except psycopg2.Error as e:
+                cur.execute('ROLLBACK TO SAVEPOINT bulk_item')
+                result.append((None, DatastoreException(e)))
+
+        cur.execute('RELEASE SAVEPOINT bulk')
+        return result
 
     def __get_column_datatype(self, table):
         with self.conn.cursor() as cur:
@@ -111,7 +158,7 @@ class PostgresDatastore(object):
             cur.execute("CREATE TABLE {0} (id {1} PRIMARY KEY, data json)".format(collection, pkey_type))
             self.insert('__collections', attributes, pkey=collection)
 
-        self.conn.commit()
+        self.__commit()
 
     def collection_get_pkey_type(self, collection):
         with self.conn.cursor() as cur:
@@ -136,7 +183,7 @@ class PostgresDatastore(object):
         with self.conn.cursor() as cur:
             cur.execute("DROP TABLE {0}".format(collection))
 
-        self.conn.commit()
+        self.__commit()
 
     def collection_list(self):
         with self.conn.cursor() as cur:
@@ -217,21 +264,151 @@ class PostgresDatastore(object):
 
         with self.conn.cursor() as cur:
             pkey = 'default' if pkey is None else cur.mogrify('%s', [pkey])
+            # Failed statement would abort the whole enclosing transaction
+            if self.transaction_depth > 0:
+                cur.execute('SAVEPOINT single')
+
             try:
                 cur.execute("INSERT INTO {0} (id, data) VALUES ({1}, %s) RETURNING id".format(
                     collection,
                     pkey
                 ), (psycopg2.extras.Json(obj),))
             except psycopg2.IntegrityError as e:
-                self.conn.rollback()
+                if self.transaction_depth > 0:
+                    cur.execute('ROLLBACK TO SAVEPOINT single')
+                else:
+                    self.__rollback()
+
                 raise DuplicateKeyException(e)
-            else:
-                self.conn.commit()
+
+            if self.transaction_depth > 0:
+                cur.execute('RELEASE SAVEPOINT single')
 
             result = cur.fetchone()
-            self.conn.commit()
+            self.__commit()
             return result[0]
 
+    def __prepare_object(self, obj, config):
+        if hasattr(obj, '__getstate__'):
+            obj = obj.__getstate__()
+
+        if config:
+            return {'value': obj}
+
+        return obj
+
+    def insert_many(self, collection, objects, timestamp=True, config=False):
+        # There are no timestamp columns, timestamp is accepted for compatibility with other drivers
+        keyed = []
+        unkeyed = []
+        for idx, obj in enumerate(objects):
+            obj = self.__prepare_object(obj, config)
+            if type(obj) is dict:
+                obj = dict(obj)
+
+            pkey = obj.pop('id', None) if type(obj) is dict else None
+            if pkey is None:
+                unkeyed.append((idx, (psycopg2.extras.Json(obj),)))
+            else:
+                keyed.append((idx, (pkey, psycopg2.extras.Json(obj))))
+
+        result = [None] * (len(keyed) + len(unkeyed))
+        with self.conn.cursor() as cur:
+            if keyed:
+                ret = self.__execute_values(
+                    cur,
+                    "INSERT INTO {0} (id, data) VALUES %s RETURNING id".format(collection),
+                    [row for _, row in keyed]
+                )
+
+                for (idx, row), (_, err) in zip(keyed, ret):
+                    result[idx] = (row[0], err)
+
+            if unkeyed:
+                ret = self.__execute_values(
+                    cur,
+                    "INSERT INTO {0} (data) VALUES %s RETURNING id".format(collection),
+                    [row for _, row in unkeyed]
+                )
+
+                for (idx, _), item in zip(unkeyed, ret):
+                    result[idx] = item
+
+        self.__commit()
+        return result
+
+    def update_many(self, collection, items, timestamp=True, config=False):
+        items = list(items)
+        if not items:
+            return []
+
+        pkey_type = self.collection_get_pkey_type(collection)
+        rows = []
+        for pkey, obj in items:
+            rows.append((pkey, psycopg2.extras.Json(self.__prepare_object(obj, config))))
+
+        with self.conn.cursor() as cur:
+            ret = self.__execute_values(
+                cur,
+                "UPDATE {0} AS t SET data = v.data FROM (VALUES %s) AS v(id, data) "
+                "WHERE t.id = v.id RETURNING t.id".format(collection),
+                rows,
+                template='(%s::{0}, %s::json)'.format(pkey_type)
+            )
+
+        self.__commit()
+        return [
+            (pkey, err if err or updated is not None else DatastoreException('Document {0} not found'.format(pkey)))
+            for (pkey, _), (updated, err) in zip(items, ret)
+        ]
+
+    def upsert_many(self, collection, items, timestamp=True, config=False):
+        rows = []
+        for pkey, obj in items:
+            rows.append((pkey, psycopg2.extras.Json(self.__prepare_object(obj, config))))
+
+        if not rows:
+            return []
+
+        with self.conn.cursor() as cur:
+            ret = self.__execute_values(
+                cur,
+                "INSERT INTO {0} (id, data) VALUES %s "
+                "ON CONFLICT (id) DO UPDATE SET data = EXCLUDED.data RETURNING id".format(collection),
+                rows
+            )
+
+        self.__commit()
+        return [(row[0], err) for row, (_, err) in zip(rows, ret)]
+
+    def delete_many(self, collection, pkeys):
+        pkeys = list(pkeys)
+        if pkeys:
+            with self.conn.cursor() as cur:
+                cur.execute("DELETE FROM {0} WHERE id = ANY(%s)".format(collection), (pkeys,))
+
+            self.__commit()
+
+        return [(pkey, None) for pkey in pkeys]
+
+    @contextlib.contextmanager
+    def transaction(self):
+        self.transaction_depth += 1
+        try:
+            yield
+        except BaseException:
+            self.transaction_depth -= 1
+            if self.transaction_depth == 0:
+                self.conn.rollback()
+            raise
+
+        self.transaction_depth -= 1
+        if self.transaction_depth == 0:
+            self.conn.commit()
+
+    def batch(self):
+        return DatastoreBatch(self)
+
     def update(self, collection, pkey, obj):
         if hasattr(obj, '__getstate__'):
             obj = obj.__getstate__()
@@ -242,7 +419,22 @@ class PostgresDatastore(object):
                 pkey
             ))
 
-            self.conn.commit()
+            self.__commit()
+
+    def update_fields(self, collection, pkey, fields, timestamp=True):
+        fields = dict(fields)
+        fields.pop('id', None)
+        if timestamp:
+            # Stored within the JSON document, so it has to be serialized
+            fields['updated_at'] = datetime.now().isoformat()
+
+        with self.conn.cursor() as cur:
+            cur.execute("UPDATE {0} SET data = (data::jsonb || %s::jsonb)::json WHERE id = %s".format(collection), (
+                psycopg2.extras.Json(fields),
+                pkey
+            ))
+
+            self.__commit()
 
     def upsert(self, collection, pkey, obj):
         if self.exists(collection, [('id', '=', pkey)]):
@@ -256,7 +448,7 @@ class PostgresDatastore(object):
                 pkey,
             ))
 
-            self.conn.commit()
+            self.__commit()
 
     def exists(self, collection, *args):
         return self.get_one(collection, *args) is not None
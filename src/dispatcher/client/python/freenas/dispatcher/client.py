@@ -160,14 +160,19 @@ class Client(object):
         ))
 
     def __send_event_burst(self):
+        # Take exactly what is going to be sent; events emitted meanwhile
+        # stay queued for the next burst
         with self.event_emission_lock:
-            self.__send(self.__pack(
-                'events',
-                'event_burst',
-                {'events': list([{'name': t[0], 'args': t[1]} for t in self.pending_events])},
-            ))
+            events, self.pending_events = self.pending_events, []
 
-            del self.pending_events[:]
+        if not events:
+            return
+
+        self.__send(self.__pack(
+            'events',
+            'event_burst',
+            {'events': list([{'name': t[0], 'args': t[1]} for t in events])},
+        ))
 
     def __send_error(self, id, errno, msg, extra=None):
         payload = {
@@ -214,11 +219,11 @@ class Client(object):
     def __event_emitter(self):
         while True:
             self.event_cv.wait()
-
-            while len(self.pending_events) > 0:
-                time.sleep(0.1)
-                with self.event_emission_lock:
-                    self.__send_event_burst()
+            # Cleared before the queue is taken, so an event emitted after
+            # that sets it again and nothing waits for the next emission
+            self.event_cv.clear()
+            time.sleep(0.1)
+            self.__send_event_burst()
 
     def wait_forever(self):
         if os.getenv("DISPATCHERCLIENT_TYPE") == "GEVENT":
@@ -467,9 +472,10 @@ class Client(object):
         if not self.use_bursts:
             self.__send_event(name, params)
         else:
-            self.pending_events.append((name, params))
+            with self.event_emission_lock:
+                self.pending_events.append((name, params))
+
             self.event_cv.set()
-            self.event_cv.clear()
 
     def register_event_handler(self, name, handler):
         if name not in self.event_handlers:
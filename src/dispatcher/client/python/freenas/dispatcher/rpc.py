@@ -30,6 +30,7 @@ import inspect
 import logging
 import six
 import sys
+import time
 import traceback
 from freenas.dispatcher import validator
 from jsonschema import RefResolver
@@ -41,6 +42,9 @@ class RpcContext(object):
         self.services = {}
         self.instances = {}
         self.schema_definitions = {}
+        self.validators = {}
+        self.validator_deps = {}
+        self.call_stats = {}
         self.register_service('discovery', DiscoveryService)
 
     def register_service(self, name, clazz):
@@ -61,13 +65,90 @@ class RpcContext(object):
 
     def register_schema_definition(self, name, definition):
         self.schema_definitions['{0}'.format(name)] = definition
+        self.invalidate_validators('{0}'.format(name))
 
     def unregister_schema_definition(self, name):
         del self.schema_definitions['{0}'.format(name)]
+        self.invalidate_validators('{0}'.format(name))
 
     def get_schema_resolver(self, schema):
         return RefResolver('', schema, self.schema_definitions)
 
+    def get_schema_refs(self, schema):
+        # Names of all definitions referenced by schema, directly or not
+        result = set()
+        stack = [schema]
+        while stack:
+            obj = stack.pop()
+            if isinstance(obj, dict):
+                ref = obj.get('$ref')
+                if isinstance(ref, six.string_types):
+                    name = ref.split('#')[0]
+                    if name and name not in result:
+                        result.add(name)
+                        if name in self.schema_definitions:
+                            stack.append(self.schema_definitions[name])
+
+                stack.extend(obj.values())
+            elif isinstance(obj, list):
+                stack.extend(obj)
+
+        return result
+
+    def get_validator(self, schema, kind):
+        """
+        Returns a validator for params schema passed as arguments list
+        (kind 'list') or dictionary (kind 'dict'). Validators are built once
+        per schema and dropped when any definition they refer to changes.
+        """
+        key = (id(schema), kind)
+        entry = self.validators.get(key)
+        if entry and entry[0] is schema:
+            return entry[1]
+
+        full = validator.schema_to_dict(schema) if kind == 'dict' else validator.schema_to_list(schema)
+        val = validator.DefaultDraft4Validator(full, resolver=self.get_schema_resolver(full))
+        self.validators[key] = (schema, val)
+        for name in self.get_schema_refs(full):
+            self.validator_deps.setdefault(name, set()).add(key)
+
+        return val
+
+    def invalidate_validators(self, name):
+        for key in self.validator_deps.pop(name, set()):
+            self.validators.pop(key, None)
+
+    def record_call(self, method, validation_time, execution_time):
+        stats = self.call_stats.get(method)
+        if not stats:
+            stats = self.call_stats[method] = {
+                'count': 0,
+                'validation_time': 0,
+                'execution_time': 0,
+                'max_time': 0
+            }
+
+        stats['count'] += 1
+        stats['validation_time'] += validation_time
+        stats['execution_time'] += execution_time
+        stats['max_time'] = max(stats['max_time'], validation_time + execution_time)
+
+    def get_call_stats(self):
+        result = []
+        for method, stats in self.call_stats.items():
+            total = stats['validation_time'] + stats['execution_time']
+            result.append({
+                'method': method,
+                'count': stats['count'],
+                'total_time': total,
+                'average_time': total / stats['count'],
+                'max_time': stats['max_time'],
+                'validation_time': stats['validation_time'],
+                'average_validation_time': stats['validation_time'] / stats['count']
+            })
+
+        return sorted(result, key=lambda s: s['total_time'], reverse=True)
+
     def get_service(self, name):
         if name not in self.instances.keys():
             return None
@@ -77,18 +158,9 @@ class RpcContext(object):
     def validate_call(self, args, schema):
         errors = []
         if type(args) is dict:
-            val = validator.DefaultDraft4Validator(
-                validator.schema_to_dict(schema),
-                resolver=self.get_schema_resolver(schema))
-
-            errors += val.iter_errors(args)
-
+            errors += self.get_validator(schema, 'dict').iter_errors(args)
         elif type(args) is list:
-            val = validator.DefaultDraft4Validator(
-                validator.schema_to_list(schema),
-                resolver=self.get_schema_resolver(schema))
-
-            errors += val.iter_errors(args)
+            errors += self.get_validator(schema, 'list').iter_errors(args)
         else:
             raise RpcException(errno.EINVAL, "Function parameters should be passed as dictionary or array")
 
@@ -119,27 +191,33 @@ class RpcContext(object):
                 if not self.user.has_role(i):
                     raise RpcException(errno.EACCES, 'Insufficent privileges')
 
+        start = time.time()
         if hasattr(func, 'params_schema'):
             self.validate_call(args, func.params_schema)
 
+        validation_time = time.time() - start
+
         if hasattr(func, 'pass_sender'):
             if type(args) is dict:
                 args['sender'] = sender
             elif type(args) is list:
                 args.append(sender)
 
+        start = time.time()
         try:
             if type(args) is dict:
                 result = func(**args)
             elif type(args) is list:
                 result = func(*args)
+
+            if inspect.isgenerator(result):
+                result = list(result)
         except RpcException:
             raise
         except Exception:
             raise RpcException(errno.EFAULT, traceback.format_exc())
-
-        if inspect.isgenerator(result):
-            result = list(result)
+        finally:
+            self.record_call(method, validation_time, time.time() - start)
 
         self.instances[service].sender = None
         return result
@@ -28,9 +28,11 @@
 import os
 import re
 import enum
+import time
 import errno
 import logging
 import gevent
+import gevent.pool
 import gevent.monkey
 from bsd import geom
 from gevent.lock import RLock
@@ -55,10 +57,57 @@ from pySMART import Device
 
 
 EXPIRE_TIMEOUT = timedelta(hours=24)
+DEFAULT_PROBE_WORKERS = 8
 multipaths = -1
-diskinfo_cache = CacheStore()
 logger = logging.getLogger('DiskPlugin')
 diskinfo_cache_lock = RLock()
+inventory_report = {}
+
+
+class DiskCacheStore(CacheStore):
+    """
+    Disk cache with path (including multipath members), lunid and serial
+    indexes. Indexes are refreshed on every put(), so cached disks that
+    were modified in place need to be put() again.
+    """
+    def __init__(self):
+        super(DiskCacheStore, self).__init__()
+        self.indexes = {'path': {}, 'lunid': {}, 'serial': {}}
+        self.indexed = {}
+
+    def __unindex(self, key):
+        for index, value in self.indexed.pop(key, []):
+            if self.indexes[index].get(value) == key:
+                del self.indexes[index][value]
+
+    def put(self, key, data):
+        super(DiskCacheStore, self).put(key, data)
+        self.__unindex(key)
+
+        entries = [('path', data['path']), ('lunid', data.get('lunid')), ('serial', data.get('serial'))]
+        if data.get('is_multipath'):
+            members = (data.get('multipath') or {}).get('members') or {}
+            entries.extend(('path', i) for i in members)
+
+        entries = [(index, value) for index, value in entries if value]
+        for index, value in entries:
+            self.indexes[index][value] = key
+
+        self.indexed[key] = entries
+
+    def remove(self, key):
+        super(DiskCacheStore, self).remove(key)
+        self.__unindex(key)
+
+    def lookup(self, index, value):
+        key = self.indexes[index].get(value)
+        if key is None or not self.is_valid(key):
+            return None
+
+        return self.store[key].data
+
+
+diskinfo_cache = DiskCacheStore()
 
 
 class AcousticLevel(enum.IntEnum):
@@ -134,6 +183,12 @@ class DiskProvider(Provider):
 
         raise RpcException(errno.ENOENT, "Partition {0} not found".format(part_name))
 
+    @description("Returns timings of the last disk inventory")
+    @accepts()
+    @returns(h.object())
+    def get_inventory_report(self):
+        return inventory_report
+
     @private
     def update_disk_cache(self, disk):
         with self.dispatcher.get_lock('diskcache:{0}'.format(disk)):
@@ -478,20 +533,25 @@ def info_from_device(devname):
     return disk_info
 
 
-def get_disk_by_path(path):
-    for disk in diskinfo_cache.validvalues():
-        if disk['path'] == path:
-            return disk
+def probe_disk(name):
+    try:
+        camdev = CamDevice(name)
+    except RuntimeError:
+        camdev = None
+
+    return info_from_device(name), camdev.__getstate__() if camdev else None
 
-        if disk['is_multipath']:
-            if path in disk['multipath.members']:
-                return disk
 
-    return None
+def get_disk_by_path(path):
+    return diskinfo_cache.lookup('path', path)
 
 
 def get_disk_by_lunid(lunid):
-    return wrap(first_or_default(lambda d: d['lunid'] == lunid, diskinfo_cache.validvalues()))
+    return wrap(diskinfo_cache.lookup('lunid', lunid))
+
+
+def get_disk_by_serial(serial):
+    return wrap(diskinfo_cache.lookup('serial', serial))
 
 
 def clean_multipaths(dispatcher):
@@ -630,8 +690,10 @@ def generate_multipath_info(gmultipath):
     }
 
 
-def update_disk_cache(dispatcher, path):
-    geom.scan()
+def update_disk_cache(dispatcher, path, disk_info=None, rescan=True, persist=True):
+    if rescan:
+        geom.scan()
+
     name = os.path.basename(path)
     gdisk = geom.geom_by_name('DISK', name)
     gpart = geom.geom_by_name('PART', name)
@@ -658,7 +720,9 @@ def update_disk_cache(dispatcher, path):
     if not gdisk:
         return
 
-    disk_info = info_from_device(gdisk.name)
+    if not disk_info:
+        disk_info = info_from_device(gdisk.name)
+
     serial = disk_info['serial']
 
     provider = gdisk.provider
@@ -693,60 +757,123 @@ def update_disk_cache(dispatcher, path):
     if old_id != identifier:
         logger.debug('Removing disk cache entry for <%s> because identifier changed', old_id)
         diskinfo_cache.remove(old_id)
-        diskinfo_cache.put(identifier, disk)
         dispatcher.datastore.delete('disks', old_id)
 
-    persist_disk(dispatcher, disk)
+    # Put the entry back even if identifier is the same, to refresh indexes
+    diskinfo_cache.put(identifier, disk)
 
+    if persist:
+        persist_disk(dispatcher, disk)
+
+
+def generate_disk_cache(dispatcher, path, probe=None, rescan=True, persist=True):
+    if rescan:
+        geom.scan()
 
-def generate_disk_cache(dispatcher, path):
-    diskinfo_cache_lock.acquire()
-    geom.scan()
     name = os.path.basename(path)
     gdisk = geom.geom_by_name('DISK', name)
     multipath_info = None
 
-    disk_info = info_from_device(gdisk.name)
+    # Hardware probes are slow, so run them before taking the cache lock
+    disk_info, controller = probe or probe_disk(gdisk.name)
     serial = disk_info['serial']
-    identifier = device_to_identifier(name, serial)
-    ds_disk = dispatcher.datastore.get_by_id('disks', identifier)
 
-    # Path repesents disk device (not multipath device) and has NAA ID attached
-    lunid = gdisk.provider.config.get('lunid')
-    if lunid:
-        # Check if device could be part of multipath configuration
-        d = get_disk_by_lunid(lunid)
-        if (d and d['path'] != path) or (ds_disk and ds_disk['is_multipath']):
-            multipath_info = attach_to_multipath(dispatcher, d, ds_disk, path)
+    with diskinfo_cache_lock:
+        identifier = device_to_identifier(name, serial)
+        ds_disk = dispatcher.datastore.get_by_id('disks', identifier)
+
+        # Path repesents disk device (not multipath device) and has NAA ID attached
+        lunid = gdisk.provider.config.get('lunid')
+        if lunid:
+            # Check if device could be part of multipath configuration
+            d = get_disk_by_lunid(lunid)
+            if (d and d['path'] != path) or (ds_disk and ds_disk['is_multipath']):
+                multipath_info = attach_to_multipath(dispatcher, d, ds_disk, path)
+
+        provider = gdisk.provider
+        disk = wrap({
+            'path': path,
+            'is_multipath': False,
+            'description': provider.config['descr'],
+            'serial': serial,
+            'lunid': provider.config.get('lunid'),
+            'model': disk_info['model'],
+            'interface': disk_info['interface'],
+            'is_ssd': disk_info['is_ssd'],
+            'id': identifier,
+            'controller': controller,
+        })
+
+        if multipath_info:
+            disk.update(multipath_info)
 
-    provider = gdisk.provider
-    try:
-        camdev = CamDevice(gdisk.name)
-    except RuntimeError:
-        camdev = None
+        diskinfo_cache.put(identifier, disk)
+        update_disk_cache(dispatcher, path, disk_info, rescan=False, persist=persist)
 
-    disk = wrap({
-        'path': path,
-        'is_multipath': False,
-        'description': provider.config['descr'],
-        'serial': serial,
-        'lunid': provider.config.get('lunid'),
-        'model': disk_info['model'],
-        'interface': disk_info['interface'],
-        'is_ssd': disk_info['is_ssd'],
-        'id': identifier,
-        'controller': camdev.__getstate__() if camdev else None,
-    })
+    if persist:
+        dispatcher.call_sync('disks.configure_disk', identifier)
 
-    if multipath_info:
-        disk.update(multipath_info)
+    logger.info('Added <%s> (%s) to disk cache', identifier, disk['description'])
+    return disk
 
-    diskinfo_cache.put(identifier, disk)
-    update_disk_cache(dispatcher, path)
-    dispatcher.call_sync('disks.configure_disk', identifier)
 
-    logger.info('Added <%s> (%s) to disk cache', identifier, disk['description'])
-    diskinfo_cache_lock.release()
+def generate_disk_inventory(dispatcher, paths):
+    """
+    Builds disk cache for all given disks at once: GEOM tree is scanned
+    once for the whole pass, hardware probes run in a bounded pool and
+    disks are persisted in a single datastore batch.
+    """
+    timings = {}
+    started_at = last = time.time()
+
+    def checkpoint(name):
+        nonlocal last
+        now = time.time()
+        timings[name] = round(now - last, 3)
+        last = now
+
+    def probe(path):
+        try:
+            return path, probe_disk(os.path.basename(path))
+        except BaseException as err:
+            logger.warning('Cannot probe disk {0}: {1}'.format(path, str(err)))
+            return path, None
+
+    pool = gevent.pool.Pool(dispatcher.configstore.get('middleware.disk_probe_workers', DEFAULT_PROBE_WORKERS))
+    geom.scan()
+    checkpoint('geom_scan')
+
+    probes = dict(pool.imap_unordered(probe, paths))
+    checkpoint('probe')
+
+    disks = []
+    for path in paths:
+        if not probes.get(path):
+            continue
+
+        with dispatcher.get_lock('diskcache:{0}'.format(path)):
+            disks.append(generate_disk_cache(dispatcher, path, probes[path], rescan=False, persist=False))
+
+    checkpoint('cache')
+
+    persist_disks(dispatcher, disks)
+    checkpoint('persist')
+
+    pool.map(lambda d: dispatcher.call_sync('disks.configure_disk', d['id']), disks)
+    checkpoint('configure')
+
+    inventory_report.update({
+        'disks': len(disks),
+        'failed': len(paths) - len(disks),
+        'total': round(time.time() - started_at, 3),
+        'timings': timings
+    })
+
+    logger.info('Disk inventory of {0} disks took {1}s ({2})'.format(
+        len(disks),
+        inventory_report['total'],
+        ', '.join('{0}: {1}s'.format(k, v) for k, v in timings.items())
+    ))
 
 
 def purge_disk_cache(dispatcher, path):
@@ -788,28 +915,49 @@ def purge_disk_cache(dispatcher, path):
 
 
 def persist_disk(dispatcher, disk):
-    ds_disk = dispatcher.datastore.get_by_id('disks', disk['id']) or {}
-    ds_disk.update({
-        'lunid': disk['lunid'],
-        'path': disk['path'],
-        'mediasize': disk['mediasize'],
-        'serial': disk['serial'],
-        'is_multipath': disk['is_multipath'],
-        'data_partition_uuid': disk['data_partition_uuid'],
-        'delete_at': None
-    })
+    persist_disks(dispatcher, [disk])
 
-    if 'smart' not in ds_disk:
-        ds_disk.update({'smart': True if disk['smart_capable'] else False})
 
-    if 'smart_options' not in ds_disk:
-        ds_disk.update({'smart_options': None})
+def persist_disks(dispatcher, disks):
+    if not disks:
+        return
 
-    dispatcher.datastore.upsert('disks', disk['id'], ds_disk)
-    dispatcher.dispatch_event('disks.changed', {
-        'operation': 'create' if not ds_disk else 'update',
-        'ids': [disk['id']]
-    })
+    existing = {d['id']: d for d in dispatcher.datastore.query('disks', ('id', 'in', [d['id'] for d in disks]))}
+    operations = {'create': [], 'update': []}
+
+    with dispatcher.datastore.batch() as batch:
+        for disk in disks:
+            ds_disk = existing.get(disk['id'])
+            operations['update' if ds_disk else 'create'].append(disk['id'])
+            ds_disk = ds_disk or {}
+            ds_disk.update({
+                'lunid': disk['lunid'],
+                'path': disk['path'],
+                'mediasize': disk['mediasize'],
+                'serial': disk['serial'],
+                'is_multipath': disk['is_multipath'],
+                'data_partition_uuid': disk['data_partition_uuid'],
+                'delete_at': None
+            })
+
+            if 'smart' not in ds_disk:
+                ds_disk.update({'smart': True if disk['smart_capable'] else False})
+
+            if 'smart_options' not in ds_disk:
+                ds_disk.update({'smart_options': None})
+
+            batch.upsert('disks', disk['id'], ds_disk)
+
+    for id, err in batch.results:
+        if err:
+            logger.warning('Cannot persist disk <{0}>: {1}'.format(id, str(err)))
+
+    for operation, ids in operations.items():
+        if ids:
+            dispatcher.dispatch_event('disks.changed', {
+                'operation': operation,
+                'ids': ids
+            })
 
 
 def _depends():
@@ -950,15 +1098,25 @@ def _init(dispatcher, plugin):
     plugin.register_event_type('disks.changed')
 
     # Start with marking all disks as unavailable
-    for i in dispatcher.datastore.query('disks'):
-        if not i.get('delete_at'):
-            i['delete_at'] = datetime.now() + EXPIRE_TIMEOUT
+    with dispatcher.datastore.batch() as batch:
+        for i in dispatcher.datastore.query('disks'):
+            if not i.get('delete_at'):
+                i['delete_at'] = datetime.now() + EXPIRE_TIMEOUT
 
-        dispatcher.datastore.update('disks', i['id'], i)
+            batch.update('disks', i['id'], i)
 
     # Destroy all existing multipaths
     clean_multipaths(dispatcher)
 
     # Generate cache for all disks
+    paths = []
     for i in dispatcher.rpc.call_sync('system.device.get_devices', 'disk'):
-        on_device_attached({'path': i['path']})
+        path = i['path']
+        if re.match(r'^/dev/(da|ada|vtbd|multipath/multipath)[0-9]+$', path):
+            if not dispatcher.resource_exists('disk:{0}'.format(path)):
+                dispatcher.register_resource(Resource('disk:{0}'.format(path)))
+
+        if re.match(r'^/dev/(da|ada|vtbd)[0-9]+$', path):
+            paths.append(path)
+
+    generate_disk_inventory(dispatcher, paths)
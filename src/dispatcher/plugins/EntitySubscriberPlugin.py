@@ -28,8 +28,42 @@
 
 import re
 import gevent
+from collections import OrderedDict
+from gevent.lock import RLock
 from event import EventSource
-from freenas.dispatcher.rpc import RpcException
+from task import Provider
+from freenas.dispatcher.rpc import RpcException, accepts, returns, description
+from freenas.dispatcher.rpc import SchemaHelper as h
+
+
+DEFAULT_WINDOW = 0.2
+DEFAULT_BATCH_SIZE = 256
+subscriber_stats = {}
+
+
+def merge_operations(old, new):
+    """
+    Collapses two consecutive operations on the same entity into one.
+    Returns None if the entity doesn't need to be reported at all.
+    """
+    if old is None or old == new:
+        return new
+
+    if old == 'create':
+        return None if new == 'delete' else 'create'
+
+    if old == 'delete' and new == 'create':
+        return 'update'
+
+    return new
+
+
+class EntitySubscriberProvider(Provider):
+    @description("Returns per-service entity subscriber counters")
+    @accepts()
+    @returns(h.object())
+    def get_stats(self):
+        return subscriber_stats
 
 
 class EntitySubscriberEventSource(EventSource):
@@ -37,6 +71,11 @@ class EntitySubscriberEventSource(EventSource):
         super(EntitySubscriberEventSource, self).__init__(dispatcher)
         self.handles = {}
         self.services = []
+        self.pending = {}
+        self.timers = {}
+        self.locks = {}
+        self.window = dispatcher.configstore.get('middleware.entity_subscriber.window', DEFAULT_WINDOW)
+        self.batch_size = dispatcher.configstore.get('middleware.entity_subscriber.batch_size', DEFAULT_BATCH_SIZE)
         dispatcher.register_event_handler('server.event.added', self.event_added)
         dispatcher.register_event_handler('server.event.removed', self.event_removed)
 
@@ -57,31 +96,82 @@ class EntitySubscriberEventSource(EventSource):
             self.services.remove(service)
 
     def changed(self, service, event):
-        ids = event['ids']
-        operation = event['operation']
-
-        if operation == 'delete':
-            self.dispatcher.dispatch_event('entity-subscriber.{0}.changed'.format(service), {
-                'service': service,
-                'operation': operation,
-                'ids': ids
-            })
-        else:
-            gevent.spawn(self.fetch, service, operation, ids)
-
-    def fetch(self, service, operation, ids):
+        pending = self.pending.setdefault(service, OrderedDict())
+        stats = subscriber_stats.setdefault(service, {
+            'events': 0,
+            'ids': 0,
+            'coalesced': 0,
+            'fetches': 0,
+            'broadcasts': 0
+        })
+
+        stats['events'] += 1
+        for i in event['ids']:
+            stats['ids'] += 1
+            old = pending.pop(i, None)
+            if old is not None:
+                stats['coalesced'] += 1
+
+            operation = merge_operations(old, event['operation'])
+            if operation:
+                pending[i] = operation
+
+        if len(pending) >= self.batch_size:
+            gevent.spawn(self.flush, service)
+            return
+
+        if service not in self.timers:
+            self.timers[service] = gevent.spawn_later(self.window, self.expire, service)
+
+    def expire(self, service):
+        del self.timers[service]
+        self.flush(service)
+
+    def flush(self, service):
+        with self.locks.setdefault(service, RLock()):
+            pending = self.pending.pop(service, None)
+            if not pending:
+                return
+
+            stats = subscriber_stats[service]
+            operations = OrderedDict()
+            for id, operation in pending.items():
+                operations.setdefault(operation, []).append(id)
+
+            deleted = operations.pop('delete', None)
+            ids = [i for i, op in pending.items() if op != 'delete']
+            entities = {}
+
+            for idx in range(0, len(ids), self.batch_size):
+                stats['fetches'] += 1
+                for i in self.fetch(service, ids[idx:idx + self.batch_size]):
+                    entities[i.get('id')] = i
+
+            for operation, ids in operations.items():
+                result = [entities[i] for i in ids if i in entities]
+                if result:
+                    stats['broadcasts'] += 1
+                    self.dispatcher.dispatch_event('entity-subscriber.{0}.changed'.format(service), {
+                        'service': service,
+                        'operation': operation,
+                        'entities': result,
+                        'nolog': True
+                    })
+
+            if deleted:
+                stats['broadcasts'] += 1
+                self.dispatcher.dispatch_event('entity-subscriber.{0}.changed'.format(service), {
+                    'service': service,
+                    'operation': 'delete',
+                    'ids': deleted
+                })
+
+    def fetch(self, service, ids):
         try:
-            entities = self.dispatcher.call_sync('{0}.query'.format(service), [('id', 'in', ids)])
+            return self.dispatcher.call_sync('{0}.query'.format(service), [('id', 'in', ids)])
         except BaseException as e:
             self.logger.warn('Cannot fetch changed entities from service {0}: {1}'.format(service, str(e)))
-            return
-
-        self.dispatcher.dispatch_event('entity-subscriber.{0}.changed'.format(service), {
-            'service': service,
-            'operation': operation,
-            'entities': entities,
-            'nolog': True
-        })
+            return []
 
     def enable(self, event):
         service = re.match(r'^entity-subscriber\.([\.\w]+)\.changed$', event).group(1)
@@ -107,4 +197,5 @@ class EntitySubscriberEventSource(EventSource):
 
 
 def _init(dispatcher, plugin):
+    plugin.register_provider('entity_subscriber', EntitySubscriberProvider)
     plugin.register_event_source('entity-subscriber', EntitySubscriberEventSource)
@@ -78,8 +78,8 @@ class NTPServerCreateTask(Task):
     def run(self, ntp, force=False):
         try:
             pkey = self.datastore.insert('ntpservers', ntp)
-            self.dispatcher.call_sync('etcd.generation.generate_group', 'ntpd')
-            self.dispatcher.call_sync('services.restart', 'ntpd')
+            if self.dispatcher.call_sync('etcd.generation.generate_group', 'ntpd'):
+                self.dispatcher.call_sync('services.restart', 'ntpd')
             self.dispatcher.dispatch_event('ntpservers.changed', {
                 'operation': 'create',
                 'ids': [pkey]
@@ -128,8 +128,8 @@ class NTPServerUpdateTask(Task):
             ntp = self.datastore.get_by_id('ntpservers', id)
             ntp.update(updated_fields)
             self.datastore.update('ntpservers', id, ntp)
-            self.dispatcher.call_sync('etcd.generation.generate_group', 'ntpd')
-            self.dispatcher.call_sync('services.restart', 'ntpd')
+            if self.dispatcher.call_sync('etcd.generation.generate_group', 'ntpd'):
+                self.dispatcher.call_sync('services.restart', 'ntpd')
             self.dispatcher.dispatch_event('ntpservers.changed', {
                 'operation': 'update',
                 'ids': [id]
@@ -153,8 +153,8 @@ class NTPServerDeleteTask(Task):
     def run(self, id):
         try:
             self.datastore.delete('ntpservers', id)
-            self.dispatcher.call_sync('etcd.generation.generate_group', 'ntpd')
-            self.dispatcher.call_sync('services.restart', 'ntpd')
+            if self.dispatcher.call_sync('etcd.generation.generate_group', 'ntpd'):
+                self.dispatcher.call_sync('services.restart', 'ntpd')
             self.dispatcher.dispatch_event('ntpservers.changed', {
                 'operation': 'delete',
                 'ids': [id]
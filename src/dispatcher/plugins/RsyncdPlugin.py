@@ -115,8 +115,8 @@ class RsyncdModuleCreateTask(Task):
 
         try:
             uuid = self.datastore.insert('rsyncd-module', rsyncmod)
-            self.dispatcher.call_sync('etcd.generation.generate_group', 'rsyncd')
-            self.dispatcher.call_sync('services.restart', 'rsyncd')
+            if self.dispatcher.call_sync('etcd.generation.generate_group', 'rsyncd'):
+                self.dispatcher.call_sync('services.restart', 'rsyncd')
         except DatastoreException as e:
             raise TaskException(errno.EBADMSG, 'Cannot add rsync module: {0}'.format(str(e)))
         except RpcException as e:
@@ -159,8 +159,8 @@ class RsyncdModuleUpdateTask(Task):
         try:
             rsyncmod.update(updated_fields)
             self.datastore.update('rsyncd-module', uuid, rsyncmod)
-            self.dispatcher.call_sync('etcd.generation.generate_group', 'rsyncd')
-            self.dispatcher.call_sync('services.restart', 'rsyncd')
+            if self.dispatcher.call_sync('etcd.generation.generate_group', 'rsyncd'):
+                self.dispatcher.call_sync('services.restart', 'rsyncd')
         except DatastoreException as e:
             raise TaskException(errno.EBADMSG, 'Cannot update rsync module: {0}'.format(str(e)))
         except RpcException as e:
@@ -190,8 +190,8 @@ class RsyncdModuleDeleteTask(Task):
 
         try:
             self.datastore.delete('rsyncd-module', uuid)
-            self.dispatcher.call_sync('etcd.generation.generate_group', 'rsyncd')
-            self.dispatcher.call_sync('services.restart', 'rsyncd')
+            if self.dispatcher.call_sync('etcd.generation.generate_group', 'rsyncd'):
+                self.dispatcher.call_sync('services.restart', 'rsyncd')
         except DatastoreException as e:
             raise TaskException(errno.EBADMSG, 'Cannot delete rsync module: {0}'.format(str(e)))
         except RpcException as e:
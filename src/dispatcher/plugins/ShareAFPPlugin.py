@@ -81,8 +81,8 @@ class CreateAFPShareTask(Task):
         })
 
         id = self.datastore.insert('shares', share)
-        self.dispatcher.call_sync('etcd.generation.generate_group', 'afp')
-        self.dispatcher.call_sync('services.reload', 'afp')
+        if self.dispatcher.call_sync('etcd.generation.generate_group', 'afp'):
+            self.dispatcher.call_sync('services.reload', 'afp')
         self.dispatcher.dispatch_event('shares.afp.changed', {
             'operation': 'create',
             'ids': [id]
@@ -104,8 +104,8 @@ class UpdateAFPShareTask(Task):
         share = self.datastore.get_by_id('shares', id)
         share.update(updated_fields)
         self.datastore.update('shares', id, share)
-        self.dispatcher.call_sync('etcd.generation.generate_group', 'afp')
-        self.dispatcher.call_sync('services.reload', 'afp')
+        if self.dispatcher.call_sync('etcd.generation.generate_group', 'afp'):
+            self.dispatcher.call_sync('services.reload', 'afp')
         self.dispatcher.dispatch_event('shares.afp.changed', {
             'operation': 'update',
             'ids': [id]
@@ -123,8 +123,8 @@ class DeleteAFPShareTask(Task):
 
     def run(self, id):
         self.datastore.delete('shares', id)
-        self.dispatcher.call_sync('etcd.generation.generate_group', 'afp')
-        self.dispatcher.call_sync('services.reload', 'afp')
+        if self.dispatcher.call_sync('etcd.generation.generate_group', 'afp'):
+            self.dispatcher.call_sync('services.reload', 'afp')
         self.dispatcher.dispatch_event('shares.afp.changed', {
             'operation': 'delete',
             'ids': [id]
@@ -125,8 +125,8 @@ class CreateISCSIShareTask(Task):
 
         props['naa'] = self.dispatcher.call_sync('shares.iscsi.generate_naa')
         id = self.datastore.insert('shares', share)
-        self.dispatcher.call_sync('etcd.generation.generate_group', 'ctl')
-        self.dispatcher.call_sync('services.reload', 'ctl')
+        if self.dispatcher.call_sync('etcd.generation.generate_group', 'ctl'):
+            self.dispatcher.call_sync('services.reload', 'ctl')
 
         self.dispatcher.dispatch_event('shares.iscsi.changed', {
             'operation': 'create',
@@ -177,8 +177,8 @@ class DeleteiSCSIShareTask(Task):
         self.join_subtasks(subtasks)
 
         self.datastore.delete('shares', id)
-        self.dispatcher.call_sync('etcd.generation.generate_group', 'ctl')
-        self.dispatcher.call_sync('services.reload', 'ctl')
+        if self.dispatcher.call_sync('etcd.generation.generate_group', 'ctl'):
+            self.dispatcher.call_sync('services.reload', 'ctl')
 
         self.dispatcher.dispatch_event('shares.iscsi.changed', {
             'operation': 'delete',
@@ -235,8 +235,8 @@ class UpdateISCSITargetTask(Task):
         target = self.datastore.get_by_id('iscsi.targets', id)
         target.update(updated_params)
         self.datastore.update('iscsi.targets', id, target)
-        self.dispatcher.call_sync('etcd.generation.generate_group', 'ctl')
-        self.dispatcher.call_sync('services.reload', 'ctl')
+        if self.dispatcher.call_sync('etcd.generation.generate_group', 'ctl'):
+            self.dispatcher.call_sync('services.reload', 'ctl')
         self.dispatcher.dispatch_event('iscsi.target.changed', {
             'operation': 'update',
             'ids': [id]
@@ -253,8 +253,8 @@ class DeleteISCSITargetTask(Task):
 
     def run(self, id):
         self.datastore.delete('iscsi.targets', id)
-        self.dispatcher.call_sync('etcd.generation.generate_group', 'ctl')
-        self.dispatcher.call_sync('services.reload', 'ctl')
+        if self.dispatcher.call_sync('etcd.generation.generate_group', 'ctl'):
+            self.dispatcher.call_sync('services.reload', 'ctl')
         self.dispatcher.dispatch_event('iscsi.target.changed', {
             'operation': 'delete',
             'ids': [id]
@@ -280,8 +280,8 @@ class CreateISCSIAuthGroupTask(Task):
         })
 
         id = self.datastore.insert('iscsi.auth', auth_group)
-        self.dispatcher.call_sync('etcd.generation.generate_group', 'ctl')
-        self.dispatcher.call_sync('services.reload', 'ctl')
+        if self.dispatcher.call_sync('etcd.generation.generate_group', 'ctl'):
+            self.dispatcher.call_sync('services.reload', 'ctl')
         self.dispatcher.dispatch_event('iscsi.auth.changed', {
             'operation': 'create',
             'ids': [id]
@@ -301,8 +301,8 @@ class UpdateISCSIAuthGroupTask(Task):
         ag = self.datastore.get_by_id('iscsi.auth', id)
         ag.update(updated_params)
         self.datastore.update('iscsi.auth', id, ag)
-        self.dispatcher.call_sync('etcd.generation.generate_group', 'ctl')
-        self.dispatcher.call_sync('services.reload', 'ctl')
+        if self.dispatcher.call_sync('etcd.generation.generate_group', 'ctl'):
+            self.dispatcher.call_sync('services.reload', 'ctl')
         self.dispatcher.dispatch_event('iscsi.auth.changed', {
             'operation': 'update',
             'ids': [id]
@@ -319,8 +319,8 @@ class DeleteISCSIAuthGroupTask(Task):
 
     def run(self, id):
         self.datastore.delete('iscsi.auth', id)
-        self.dispatcher.call_sync('etcd.generation.generate_group', 'ctl')
-        self.dispatcher.call_sync('services.reload', 'ctl')
+        if self.dispatcher.call_sync('etcd.generation.generate_group', 'ctl'):
+            self.dispatcher.call_sync('services.reload', 'ctl')
         self.dispatcher.dispatch_event('iscsi.auth.changed', {
             'operation': 'delete',
             'ids': [id]
@@ -341,8 +341,8 @@ class CreateISCSIPortalTask(Task):
         })
 
         id = self.datastore.insert('iscsi.portals', portal)
-        self.dispatcher.call_sync('etcd.generation.generate_group', 'ctl')
-        self.dispatcher.call_sync('services.reload', 'ctl')
+        if self.dispatcher.call_sync('etcd.generation.generate_group', 'ctl'):
+            self.dispatcher.call_sync('services.reload', 'ctl')
         self.dispatcher.dispatch_event('iscsi.portal.changed', {
             'operation': 'create',
             'ids': [id]
@@ -362,8 +362,8 @@ class UpdateISCSIPortalTask(Task):
         ag = self.datastore.get_by_id('iscsi.portals', id)
         ag.update(updated_params)
         self.datastore.update('iscsi.portals', id, ag)
-        self.dispatcher.call_sync('etcd.generation.generate_group', 'ctl')
-        self.dispatcher.call_sync('services.reload', 'ctl')
+        if self.dispatcher.call_sync('etcd.generation.generate_group', 'ctl'):
+            self.dispatcher.call_sync('services.reload', 'ctl')
         self.dispatcher.dispatch_event('iscsi.portal.changed', {
             'operation': 'update',
             'ids': [id]
@@ -380,8 +380,8 @@ class DeleteISCSIPortalTask(Task):
 
     def run(self, id):
         self.datastore.delete('iscsi.portals', id)
-        self.dispatcher.call_sync('etcd.generation.generate_group', 'ctl')
-        self.dispatcher.call_sync('services.reload', 'ctl')
+        if self.dispatcher.call_sync('etcd.generation.generate_group', 'ctl'):
+            self.dispatcher.call_sync('services.reload', 'ctl')
         self.dispatcher.dispatch_event('iscsi.portal.changed', {
             'operation': 'delete',
             'ids': [id]
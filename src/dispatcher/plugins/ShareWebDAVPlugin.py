@@ -91,8 +91,8 @@ class CreateWebDAVShareTask(Task):
             'permission': False,
         })
         id = self.datastore.insert('shares', share)
-        self.dispatcher.call_sync('etcd.generation.generate_group', 'webdav')
-        self.dispatcher.call_sync('services.reload', 'webdav')
+        if self.dispatcher.call_sync('etcd.generation.generate_group', 'webdav'):
+            self.dispatcher.call_sync('services.reload', 'webdav')
         self.dispatcher.dispatch_event('shares.webdav.changed', {
             'operation': 'create',
             'ids': [id]
@@ -114,8 +114,8 @@ class UpdateWebDAVShareTask(Task):
         share = self.datastore.get_by_id('shares', name)
         share.update(updated_fields)
         self.datastore.update('shares', name, share)
-        self.dispatcher.call_sync('etcd.generation.generate_group', 'webdav')
-        self.dispatcher.call_sync('services.reload', 'webdav')
+        if self.dispatcher.call_sync('etcd.generation.generate_group', 'webdav'):
+            self.dispatcher.call_sync('services.reload', 'webdav')
         self.dispatcher.dispatch_event('shares.webdav.changed', {
             'operation': 'update',
             'ids': [name]
@@ -134,8 +134,8 @@ class DeleteWebDAVShareTask(Task):
     def run(self, name):
         share = self.datastore.get_by_id('shares', name)
         self.datastore.delete('shares', name)
-        self.dispatcher.call_sync('etcd.generation.generate_group', 'webdav')
-        self.dispatcher.call_sync('services.reload', 'webdav')
+        if self.dispatcher.call_sync('etcd.generation.generate_group', 'webdav'):
+            self.dispatcher.call_sync('services.reload', 'webdav')
         self.dispatcher.dispatch_event('shares.webdav.changed', {
             'operation': 'delete',
             'ids': [name]
@@ -67,8 +67,8 @@ class CreateFakeDisk(Task):
                 f.truncate(disk['mediasize'])
 
         self.datastore.insert('simulator.disks', disk)
-        self.dispatcher.call_sync('etcd.generation.generate_group', 'ctl')
-        self.dispatcher.call_sync('services.reload', 'ctl')
+        if self.dispatcher.call_sync('etcd.generation.generate_group', 'ctl'):
+            self.dispatcher.call_sync('services.reload', 'ctl')
 
 
 class ConfigureFakeDisk(Task):
@@ -82,8 +82,8 @@ class ConfigureFakeDisk(Task):
         disk = self.datastore.get_by_id('simulator.disks', id)
         disk.update(updated_params)
         self.datastore.update('simulator.disks', id, disk)
-        self.dispatcher.call_sync('etcd.generation.generate_group', 'ctl')
-        self.dispatcher.call_sync('services.reload', 'ctl')
+        if self.dispatcher.call_sync('etcd.generation.generate_group', 'ctl'):
+            self.dispatcher.call_sync('services.reload', 'ctl')
 
 
 class DeleteFakeDisk(Task):
@@ -95,8 +95,8 @@ class DeleteFakeDisk(Task):
 
     def run(self, id):
         self.datastore.delete('simulator.disks', id)
-        self.dispatcher.call_sync('etcd.generation.generate_group', 'ctl')
-        self.dispatcher.call_sync('services.reload', 'ctl')
+        if self.dispatcher.call_sync('etcd.generation.generate_group', 'ctl'):
+            self.dispatcher.call_sync('services.reload', 'ctl')
 
 
 def _depends():
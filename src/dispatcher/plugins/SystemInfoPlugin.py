@@ -267,8 +267,8 @@ class SystemGeneralConfigureTask(Task):
         try:
             self.dispatcher.call_sync('etcd.generation.generate_group', 'localtime')
             if syslog_changed:
-                self.dispatcher.call_sync('etcd.generation.generate_group', 'syslog')
-                self.dispatcher.call_sync('services.reload', 'syslog')
+                if self.dispatcher.call_sync('etcd.generation.generate_group', 'syslog'):
+                    self.dispatcher.call_sync('services.reload', 'syslog')
         except RpcException as e:
             raise TaskException(
                 errno.ENXIO,
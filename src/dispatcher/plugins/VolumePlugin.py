@@ -42,11 +42,16 @@ from freenas.dispatcher.rpc import (
 from utils import first_or_default
 from datastore import DuplicateKeyException
 from freenas.utils import include, exclude, normalize
-from freenas.utils.query import wrap
+from freenas.utils.query import wrap, run_query
 from freenas.utils.copytree import count_files, copytree
 
 
 VOLUMES_ROOT = '/mnt'
+SNAPSHOT_PUSHDOWN_FIELDS = {
+    'id': 'name',
+    'pool': 'pool',
+    'dataset': 'dataset'
+}
 DEFAULT_ACLS = [
     {'text': 'owner@:rwxpDdaARWcCos:fd:allow'},
     {'text': 'group@:rwxpDdaARWcCos:fd:allow'},
@@ -358,7 +363,15 @@ class SnapshotProvider(Provider):
                 'holds': snapshot['holds']
             }
 
-        return wrap(self.dispatcher.call_sync('zfs.snapshot.query')).query(
+        # Equality rules on indexed fields are passed down to zfs.snapshot.query,
+        # so that only the matching snapshots are fetched from the inventory
+        pushdown = [
+            (SNAPSHOT_PUSHDOWN_FIELDS[f[0]], '=', f[2]) for f in filter or []
+            if isinstance(f, (list, tuple)) and len(f) == 3 and f[1] == '=' and f[0] in SNAPSHOT_PUSHDOWN_FIELDS
+        ]
+
+        return run_query(
+            self.dispatcher.call_sync('zfs.snapshot.query', pushdown),
             *(filter or []),
             callback=extend,
             **(params or {})
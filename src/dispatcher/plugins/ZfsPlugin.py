@@ -26,22 +26,230 @@
 #####################################################################
 
 import os
+import copy
 import errno
 import logging
+import gevent
 import libzfs
 from datetime import datetime
 from threading import Event
+from gevent.lock import RLock
 from task import (Provider, Task, TaskStatus, TaskException,
                   VerifyException, TaskAbortException, query)
-from freenas.dispatcher.rpc import RpcException, accepts, returns, description
+from freenas.dispatcher.rpc import RpcException, accepts, returns, description, private
 from freenas.dispatcher.rpc import SchemaHelper as h
 from balancer import TaskState
 from resources import Resource
 from freenas.utils import first_or_default
-from freenas.utils.query import wrap
+from freenas.utils.query import run_query
 
 
 logger = logging.getLogger('ZfsPlugin')
+DEFAULT_RECONCILE_INTERVAL = 600
+
+
+class ZfsInventory(object):
+    """
+    In-memory copy of all ZFS datasets and snapshots, indexed by name,
+    by pool and (for snapshots) by parent dataset. It is updated
+    incrementally from fs.zfs.* events and by the tasks in this plugin,
+    and rebuilt from scratch periodically to pick up changes made
+    outside of middleware.
+    """
+    INDEXES = {
+        'dataset': ('name', 'pool'),
+        'snapshot': ('name', 'dataset', 'pool')
+    }
+
+    def __init__(self):
+        self.lock = RLock()
+        self.ready = False
+        self.objects = {'dataset': {}, 'snapshot': {}}
+        self.by_pool = {'dataset': {}, 'snapshot': {}}
+        self.by_dataset = {}
+        self.stats = {
+            'hits': 0,
+            'misses': 0,
+            'index_lookups': 0,
+            'scans': 0,
+            'updates': 0,
+            'reconciliations': 0,
+            'drift': 0,
+            'last_reconcile': None
+        }
+
+    @staticmethod
+    def kind_of(name):
+        return 'snapshot' if '@' in name else 'dataset'
+
+    def __put(self, kind, obj):
+        name = obj['name']
+        dataset = name.partition('@')[0]
+        self.objects[kind][name] = obj
+        self.by_pool[kind].setdefault(dataset.partition('/')[0], set()).add(name)
+        if kind == 'snapshot':
+            self.by_dataset.setdefault(dataset, set()).add(name)
+
+    def __drop(self, kind, name):
+        if self.objects[kind].pop(name, None) is None:
+            return
+
+        dataset = name.partition('@')[0]
+        pool = dataset.partition('/')[0]
+        names = self.by_pool[kind][pool]
+        names.discard(name)
+        if not names:
+            del self.by_pool[kind][pool]
+
+        if kind == 'snapshot':
+            names = self.by_dataset[dataset]
+            names.discard(name)
+            if not names:
+                del self.by_dataset[dataset]
+
+    def __drop_snapshots(self, dataset):
+        for name in list(self.by_dataset.get(dataset, [])):
+            self.__drop('snapshot', name)
+
+    def __drop_tree(self, name):
+        pool = name.partition('/')[0]
+        for i in list(self.by_pool['dataset'].get(pool, [])):
+            if i == name or i.startswith(name + '/'):
+                self.__drop('dataset', i)
+                self.__drop_snapshots(i)
+
+    def __load(self, ds, recursive):
+        self.__put('dataset', ds.__getstate__(recursive=False))
+        self.__drop_snapshots(ds.name)
+        for snap in ds.snapshots:
+            self.__put('snapshot', snap.__getstate__(recursive=False))
+
+        if recursive:
+            for i in ds.children:
+                self.__load(i, True)
+
+    def __lookup(self, kind, filter):
+        for rule in filter:
+            if not isinstance(rule, (list, tuple)) or len(rule) != 3:
+                continue
+
+            field, op, value = rule
+            if op != '=' or field not in self.INDEXES[kind] or not isinstance(value, str):
+                continue
+
+            self.stats['index_lookups'] += 1
+            if field == 'name':
+                obj = self.objects[kind].get(value)
+                if obj is None:
+                    # Object may have been created behind our back
+                    self.sync([value])
+                    obj = self.objects[kind].get(value)
+                    return [obj] if obj else [], False
+
+                return [obj], True
+
+            index = self.by_dataset if field == 'dataset' else self.by_pool[kind]
+            return [self.objects[kind][i] for i in index.get(value, [])], True
+
+        self.stats['scans'] += 1
+        return list(self.objects[kind].values()), True
+
+    def sync(self, names, recursive=False):
+        with self.lock:
+            zfs = libzfs.ZFS()
+            for name in names:
+                self.stats['updates'] += 1
+                if self.kind_of(name) == 'snapshot':
+                    try:
+                        self.__put('snapshot', zfs.get_snapshot(name).__getstate__(recursive=False))
+                    except libzfs.ZFSException:
+                        self.__drop('snapshot', name)
+
+                    continue
+
+                try:
+                    ds = zfs.get_dataset(name)
+                except libzfs.ZFSException:
+                    self.__drop_tree(name)
+                    continue
+
+                if recursive:
+                    self.__drop_tree(name)
+
+                self.__load(ds, recursive)
+
+    def rename(self, name, new_name):
+        with self.lock:
+            if self.kind_of(name) == 'snapshot':
+                self.__drop('snapshot', name)
+                self.sync([new_name])
+                return
+
+            self.__drop_tree(name)
+            self.sync([new_name], recursive=True)
+
+    def remove_pool(self, name):
+        with self.lock:
+            self.stats['updates'] += 1
+            for kind in ('dataset', 'snapshot'):
+                for i in list(self.by_pool[kind].get(name, [])):
+                    self.__drop(kind, i)
+
+    def has_pool(self, name):
+        return name in self.by_pool['dataset']
+
+    def reconcile(self):
+        with self.lock:
+            zfs = libzfs.ZFS()
+            old = {k: set(v) for k, v in self.objects.items()}
+            self.objects = {'dataset': {}, 'snapshot': {}}
+            self.by_pool = {'dataset': {}, 'snapshot': {}}
+            self.by_dataset = {}
+
+            for i in zfs.datasets:
+                self.__put('dataset', i.__getstate__(recursive=False))
+
+            for i in zfs.snapshots:
+                self.__put('snapshot', i.__getstate__(recursive=False))
+
+            if self.ready:
+                self.stats['drift'] += sum(len(old[k] ^ set(v)) for k, v in self.objects.items())
+
+            self.ready = True
+            self.stats['reconciliations'] += 1
+            self.stats['last_reconcile'] = datetime.utcnow()
+
+    def query(self, kind, filter=None, params=None):
+        filter = filter or []
+        params = dict(params or {})
+
+        with self.lock:
+            cached = self.ready
+            if not cached:
+                self.reconcile()
+
+            result, found = self.__lookup(kind, filter)
+            self.stats['hits' if cached and found else 'misses'] += 1
+
+        # Never hand out cached objects, callers are free to modify results
+        callback = params.pop('callback', None)
+        params['callback'] = (lambda o: callback(copy.deepcopy(o))) if callback else copy.deepcopy
+        return run_query(result, *filter, **params)
+
+    def get_stats(self):
+        with self.lock:
+            result = dict(self.stats)
+            result.update({
+                'ready': self.ready,
+                'datasets': len(self.objects['dataset']),
+                'snapshots': len(self.objects['snapshot']),
+                'pools': len(self.by_pool['dataset'])
+            })
+
+            return result
+
+
+zfs_inventory = ZfsInventory()
 
 
 @description("Provides information about ZFS pools")
@@ -50,7 +258,7 @@ class ZpoolProvider(Provider):
     @query('zfs-pool')
     def query(self, filter=None, params=None):
         zfs = libzfs.ZFS()
-        return wrap(zfs).query(*(filter or []), **(params or {}))
+        return run_query(zfs, *(filter or []), **(params or {}))
 
     @accepts()
     @returns(h.array(h.ref('zfs-pool')))
@@ -145,9 +353,21 @@ class ZfsDatasetProvider(Provider):
     @query('zfs-dataset')
     def query(self, filter=None, params=None):
         try:
-            zfs = libzfs.ZFS()
-            result = [o.__getstate__(recursive=False) for o in list(zfs.datasets)]
-            return wrap(result).query(*(filter or []), **(params or {}))
+            return zfs_inventory.query('dataset', filter, params)
+        except libzfs.ZFSException as err:
+            raise RpcException(errno.EFAULT, str(err))
+
+    @description("Returns ZFS inventory cache statistics")
+    @accepts()
+    @returns(h.object())
+    def get_cache_stats(self):
+        return zfs_inventory.get_stats()
+
+    @private
+    @accepts(h.array(str), bool)
+    def sync_cache(self, names, recursive=False):
+        try:
+            zfs_inventory.sync(names, recursive)
         except libzfs.ZFSException as err:
             raise RpcException(errno.EFAULT, str(err))
 
@@ -202,9 +422,7 @@ class ZfsSnapshotProvider(Provider):
     @query('zfs-snapshot')
     def query(self, filter=None, params=None):
         try:
-            zfs = libzfs.ZFS()
-            result = [o.__getstate__(recursive=False) for o in list(zfs.snapshots)]
-            return wrap(result).query(*(filter or []), **(params or {}))
+            return zfs_inventory.query('snapshot', filter, params)
         except libzfs.ZFSException as err:
             raise RpcException(errno.EFAULT, str(err))
 
@@ -606,6 +824,8 @@ class ZfsDatasetMountTask(ZfsBaseTask):
         except libzfs.ZFSException as err:
             raise TaskException(errno.EFAULT, str(err))
 
+        zfs_sync_cache(self.dispatcher, [name], recursive)
+
 
 @accepts(str)
 class ZfsDatasetUmountTask(ZfsBaseTask):
@@ -617,6 +837,8 @@ class ZfsDatasetUmountTask(ZfsBaseTask):
         except libzfs.ZFSException as err:
             raise TaskException(errno.EFAULT, str(err))
 
+        zfs_sync_cache(self.dispatcher, [name])
+
 
 @accepts(str, str, h.object())
 class ZfsDatasetCreateTask(Task):
@@ -649,6 +871,8 @@ class ZfsDatasetCreateTask(Task):
         except libzfs.ZFSException as err:
             raise TaskException(errno.EFAULT, str(err))
 
+        zfs_sync_cache(self.dispatcher, [path])
+
 
 class ZfsSnapshotCreateTask(ZfsBaseTask):
     def run(self, pool_name, path, snapshot_name, recursive=False, params=None):
@@ -662,6 +886,11 @@ class ZfsSnapshotCreateTask(ZfsBaseTask):
         except libzfs.ZFSException as err:
             raise TaskException(errno.EFAULT, str(err))
 
+        if recursive:
+            zfs_sync_cache(self.dispatcher, [path], True)
+        else:
+            zfs_sync_cache(self.dispatcher, ['{0}@{1}'.format(path, snapshot_name)])
+
 
 class ZfsSnapshotDeleteTask(ZfsBaseTask):
     def run(self, pool_name, path, snapshot_name, recursive=False):
@@ -672,6 +901,11 @@ class ZfsSnapshotDeleteTask(ZfsBaseTask):
         except libzfs.ZFSException as err:
             raise TaskException(errno.EFAULT, str(err))
 
+        if recursive:
+            zfs_sync_cache(self.dispatcher, [path], True)
+        else:
+            zfs_sync_cache(self.dispatcher, ['{0}@{1}'.format(path, snapshot_name)])
+
 
 class ZfsSnapshotDeleteMultipleTask(ZfsBaseTask):
     def run(self, pool_name, path, snapshot_names, recursive=False):
@@ -683,6 +917,11 @@ class ZfsSnapshotDeleteMultipleTask(ZfsBaseTask):
         except libzfs.ZFSException as err:
             raise TaskException(errno.EFAULT, str(err))
 
+        if recursive:
+            zfs_sync_cache(self.dispatcher, [path], True)
+        else:
+            zfs_sync_cache(self.dispatcher, ['{0}@{1}'.format(path, i) for i in snapshot_names])
+
 
 class ZfsConfigureTask(ZfsBaseTask):
     def run(self, pool_name, name, properties):
@@ -701,6 +940,8 @@ class ZfsConfigureTask(ZfsBaseTask):
         except libzfs.ZFSException as err:
             raise TaskException(errno.EFAULT, str(err))
 
+        zfs_sync_cache(self.dispatcher, [name], True)
+
 
 class ZfsDestroyTask(ZfsBaseTask):
     def run(self, name):
@@ -711,6 +952,8 @@ class ZfsDestroyTask(ZfsBaseTask):
         except libzfs.ZFSException as err:
             raise TaskException(errno.EFAULT, str(err))
 
+        zfs_sync_cache(self.dispatcher, [name])
+
 
 class ZfsRenameTask(ZfsBaseTask):
     def run(self, name, new_name):
@@ -721,6 +964,8 @@ class ZfsRenameTask(ZfsBaseTask):
         except libzfs.ZFSException as err:
             raise TaskException(errno.EFAULT, str(err))
 
+        zfs_sync_cache(self.dispatcher, [name, new_name], True)
+
 
 class ZfsCloneTask(ZfsBaseTask):
     def run(self, path):
@@ -731,6 +976,8 @@ class ZfsCloneTask(ZfsBaseTask):
         except libzfs.ZFSException as err:
             raise TaskException(errno.EFAULT, str(err))
 
+        zfs_sync_cache(self.dispatcher, [path])
+
 
 def convert_topology(zfs, topology):
     nvroot = {}
@@ -779,16 +1026,21 @@ def get_disk_names(dispatcher, pool):
     return ret
 
 
+def zfs_sync_cache(dispatcher, names, recursive=False):
+    try:
+        dispatcher.call_sync('zfs.dataset.sync_cache', names, recursive)
+    except RpcException as err:
+        logger.warning('Cannot update ZFS inventory for {0}: {1}'.format(', '.join(names), str(err)))
+
+
 def zpool_sync_resources(dispatcher, name, datasets=False):
     res_name = 'zpool:{0}'.format(name)
 
     def iter_dataset(ds):
-        dispatcher.register_resource(
-            Resource('zfs:{0}'.format(ds.name)),
-            parents=[res_name])
+        yield Resource('zfs:{0}'.format(ds.name)), [res_name]
 
         for i in ds.children:
-            iter_dataset(i)
+            yield from iter_dataset(i)
 
     try:
         zfs = libzfs.ZFS()
@@ -807,7 +1059,7 @@ def zpool_sync_resources(dispatcher, name, datasets=False):
             parents=get_disk_names(dispatcher, pool))
 
     if datasets:
-        iter_dataset(pool.root_dataset)
+        dispatcher.register_resources(list(iter_dataset(pool.root_dataset)))
 
 
 def _depends():
@@ -857,6 +1109,7 @@ def _init(dispatcher, plugin):
     def on_pool_create(args):
         guid = args['guid']
         zpool_sync_resources(dispatcher, args['pool'], datasets=True)
+        zfs_inventory.sync([args['pool']], recursive=True)
         dispatcher.dispatch_event('zfs.pool.changed', {
             'operation': 'create',
             'ids': [guid]
@@ -865,6 +1118,7 @@ def _init(dispatcher, plugin):
     def on_pool_destroy(args):
         guid = args['guid']
         zpool_sync_resources(dispatcher, args['pool'])
+        zfs_inventory.remove_pool(args['pool'])
         dispatcher.dispatch_event('zfs.pool.changed', {
             'operation': 'delete',
             'ids': [guid]
@@ -873,6 +1127,13 @@ def _init(dispatcher, plugin):
     def on_pool_updated(args):
         guid = args['guid']
         zpool_sync_resources(dispatcher, args['pool'])
+
+        # Config sync is also posted on pool import and export
+        if not pool_exists(args['pool']):
+            zfs_inventory.remove_pool(args['pool'])
+        elif not zfs_inventory.has_pool(args['pool']):
+            zfs_inventory.sync([args['pool']], recursive=True)
+
         dispatcher.dispatch_event('zfs.pool.changed', {
             'operation': 'update',
             'ids': [guid]
@@ -883,6 +1144,7 @@ def _init(dispatcher, plugin):
         plugin.register_resource(
             Resource('zfs:{0}'.format(args['ds'])),
             parents=['zpool:{0}'.format(args['pool'])])
+        zfs_inventory.sync([args['ds']])
         dispatcher.dispatch_event('zfs.pool.changed', {
             'operation': 'update',
             'ids': [guid]
@@ -891,6 +1153,7 @@ def _init(dispatcher, plugin):
     def on_dataset_delete(args):
         guid = args['guid']
         plugin.unregister_resource('zfs:{0}'.format(args['ds']))
+        zfs_inventory.sync([args['ds']])
         dispatcher.dispatch_event('zfs.pool.changed', {
             'operation': 'update',
             'ids': [guid]
@@ -898,11 +1161,25 @@ def _init(dispatcher, plugin):
 
     def on_dataset_rename(args):
         guid = args['guid']
+        zfs_inventory.rename(args['ds'], args['new_ds'])
         dispatcher.dispatch_event('zfs.pool.changed', {
             'operation': 'update',
             'ids': [guid]
         })
 
+    def reconcile_worker():
+        interval = dispatcher.configstore.get(
+            'middleware.zfs_reconcile_interval',
+            DEFAULT_RECONCILE_INTERVAL
+        )
+
+        while True:
+            gevent.sleep(interval)
+            try:
+                zfs_inventory.reconcile()
+            except libzfs.ZFSException as err:
+                logger.warning('ZFS inventory reconciliation failed: {0}'.format(str(err)))
+
     plugin.register_schema_definition('zfs-vdev', {
         'type': 'object',
         'additionalProperties': False,
@@ -1274,6 +1551,10 @@ def _init(dispatcher, plugin):
         for pool in zfs.pools:
             zpool_sync_resources(dispatcher, pool.name, datasets=True)
 
+        zfs_inventory.reconcile()
+
     except libzfs.ZFSException as err:
         # Log what happened
         logger.error('ZfsPlugin init error: {0}'.format(str(err)))
+
+    gevent.spawn(reconcile_worker)
@@ -25,6 +25,7 @@
 #
 #####################################################################
 
+import time
 import gevent
 import logging
 import traceback
@@ -49,6 +50,15 @@ import collections
 
 
 TASKWORKER_PATH = '/usr/local/libexec/taskworker'
+DEFAULT_TASK_RETENTION = 300
+PROGRESS_LIVENESS_INTERVAL = 10
+DEFAULT_EXECUTORS_MAX = 16
+DEFAULT_EXECUTORS_SPARE = 1
+DEFAULT_EXECUTORS_IDLE_TIMEOUT = 300
+OUTPUT_TAIL_LINES = 100
+OUTPUT_CHUNK_SIZE = 16384
+OUTPUT_FLUSH_INTERVAL = 1
+TERMINAL_STATES = (TaskState.FINISHED, TaskState.FAILED, TaskState.ABORTED)
 
 
 class WorkerState(object):
@@ -65,17 +75,54 @@ class TaskExecutor(object):
         self.proc = None
         self.pid = None
         self.conn = None
-        self.state = None
+        self.state = WorkerState.STARTING
+        self.push_mode = False
+        self.exiting = False
+        self.reserved = False
         self.key = str(uuid.uuid4())
         self.checked_in = Event()
         self.result = AsyncResult()
+        self.created_at = time.time()
+        self.spawned_at = None
+        self.spawn_latency = None
+        self.idle_since = None
+        self.busy_since = None
+        self.busy_time = 0
+        self.tasks_count = 0
         gevent.spawn(self.executor)
 
+    @property
+    def utilization(self):
+        busy = self.busy_time
+        if self.busy_since:
+            busy += time.time() - self.busy_since
+
+        return busy / max(time.time() - self.created_at, 1)
+
     def checkin(self, conn):
         self.balancer.logger.debug('Check-in of worker #{0} (key {1})'.format(self.index, self.key))
         self.conn = conn
-        self.state = WorkerState.IDLE
+        self.spawn_latency = time.time() - self.spawned_at
         self.checked_in.set()
+        self.set_idle()
+
+        # Let the worker warm up by preloading plugin modules while it's idle
+        return list({inspect.getsourcefile(t) for t in self.balancer.dispatcher.tasks.values()})
+
+    def set_busy(self):
+        self.state = WorkerState.EXECUTING
+        self.idle_since = None
+        self.busy_since = time.time()
+        self.tasks_count += 1
+
+    def set_idle(self):
+        if self.busy_since:
+            self.busy_time += time.time() - self.busy_since
+            self.busy_since = None
+
+        self.state = WorkerState.IDLE
+        self.idle_since = time.time()
+        self.balancer.schedule_tasks()
 
     def get_status(self):
         if not self.conn:
@@ -89,6 +136,16 @@ class TaskExecutor(object):
             self.balancer.logger.error("Cannot obtain status from task #{0}: {1}".format(self.task.id, str(err)))
             self.proc.terminate()
 
+    def put_progress(self, status):
+        if not self.task or self.task.state != TaskState.EXECUTING:
+            return
+
+        # Worker pushes progress by itself, polling is needed only to check it's alive
+        self.push_mode = True
+        progress = TaskStatus(0)
+        progress.__setstate__(status)
+        self.task.update_progress(progress)
+
     def put_status(self, status):
         # Try to collect rusage at this point, when process is still alive
         try:
@@ -112,6 +169,7 @@ class TaskExecutor(object):
     def run(self, task):
         self.result = AsyncResult()
         self.task = task
+        self.push_mode = False
         self.task.set_state(TaskState.EXECUTING)
 
         self.conn.call_client_sync('taskproxy.run', {
@@ -137,15 +195,15 @@ class TaskExecutor(object):
             }))
 
             self.task.ended.set()
-            self.balancer.task_exited(self.task)
-            self.state = WorkerState.IDLE
+            self.set_idle()
+            self.balancer.task_exited(task)
             return
 
         self.task.result = self.result.value
         self.task.set_state(TaskState.FINISHED, TaskStatus(100, ''))
         self.task.ended.set()
-        self.balancer.task_exited(self.task)
-        self.state = WorkerState.IDLE
+        self.set_idle()
+        self.balancer.task_exited(task)
 
     def abort(self):
         self.balancer.logger.info("Trying to abort task #{0}".format(self.task.id))
@@ -158,8 +216,10 @@ class TaskExecutor(object):
             self.proc.terminate()
 
     def executor(self):
-        while True:
+        while not self.exiting:
             try:
+                self.state = WorkerState.STARTING
+                self.spawned_at = time.time()
                 self.proc = Popen(
                     [TASKWORKER_PATH, self.key],
                     close_fds=True,
@@ -176,9 +236,13 @@ class TaskExecutor(object):
                 line = line.decode('utf8')
                 self.balancer.logger.debug('Executor #{0}: {1}'.format(self.index, line.strip()))
                 if self.task:
-                    self.task.output += line
+                    self.task.append_output(line)
 
             self.proc.wait()
+            if self.exiting:
+                self.balancer.logger.debug('Executor #{0} exited'.format(self.index))
+                return
+
             self.balancer.logger.error('Executor process with PID {0} died abruptly with exit code {1}'.format(
                 self.proc.pid,
                 self.proc.returncode)
@@ -188,6 +252,7 @@ class TaskExecutor(object):
             gevent.sleep(1)
 
     def die(self):
+        self.exiting = True
         if self.proc:
             self.proc.terminate()
 
@@ -208,17 +273,28 @@ class Task(object):
         self.state = TaskState.CREATED
         self.progress = None
         self.resources = []
+        self.blocked_on = []
         self.thread = None
         self.instance = None
         self.parent = None
         self.result = None
-        self.output = ''
+        self.output_tail = collections.deque(maxlen=OUTPUT_TAIL_LINES)
+        self.output_pending = []
+        self.output_pending_size = 0
+        self.output_seq = 0
+        self.output_flushed_at = time.time()
         self.rusage = None
         self.ended = Event()
         self.debugger = None
         self.executor = None
 
     def __getstate__(self):
+        state = self.__get_header()
+        state['args'] = remove_dots(self.args)
+        return state
+
+    def __get_header(self):
+        # Everything but arguments, which never change, and output, which is stored separately
         return {
             "created_at": self.created_at,
             "started_at": self.started_at,
@@ -228,15 +304,17 @@ class Task(object):
             "session": self.session_id,
             "name": self.name,
             "parent": self.parent.id if self.parent else None,
-            "args": remove_dots(self.args),
             "result": self.result,
             "state": self.state,
-            "output": self.output,
             "rusage": self.rusage,
             "error": self.error,
             "debugger": self.debugger
         }
 
+    @property
+    def output(self):
+        return ''.join(self.output_tail)
+
     def __emit_progress(self):
         self.dispatcher.dispatch_event("task.progress", {
             "id": self.id,
@@ -249,6 +327,13 @@ class Task(object):
             "abortable": True if (hasattr(self.instance, 'abort') and isinstance(self.instance.abort, collections.Callable)) else False
         })
 
+    def update_progress(self, progress):
+        if self.progress and self.progress.__getstate__() == progress.__getstate__():
+            return
+
+        self.progress = progress
+        self.__emit_progress()
+
     def run(self):
         self.set_state(TaskState.EXECUTING)
         try:
@@ -279,13 +364,6 @@ class Task(object):
         self.dispatcher.balancer.task_exited(self)
 
     def start(self):
-        try:
-            self.dispatcher.balancer.assign_executor(self)
-        except OverflowError:
-            self.set_state(TaskState.FAILED, error='Out of executors')
-            self.ended.set()
-            self.dispatcher.balancer.task_exited(self)
-
         # Start actual task
         gevent.spawn(self.executor.run, self)
 
@@ -299,7 +377,9 @@ class Task(object):
 
     def set_state(self, state, progress=None, error=None):
         event = {'id': self.id, 'name': self.name, 'state': state}
+        old_state = self.state
         self.state = state
+        self.dispatcher.balancer.task_state_changed(self, old_state)
 
         if error:
             self.error = error
@@ -313,8 +393,11 @@ class Task(object):
             event['finished_at'] = self.finished_at
             event['result'] = self.result
 
+        if state in TERMINAL_STATES:
+            self.flush_output()
+
         self.dispatcher.dispatch_event('task.created' if state == TaskState.CREATED else 'task.updated', event)
-        self.dispatcher.datastore.update('tasks', self.id, self)
+        self.dispatcher.datastore.update_fields('tasks', self.id, self.__get_header())
         self.dispatcher.dispatch_event('task.changed', {
             'operation': 'create' if state == TaskState.CREATED else 'update',
             'ids': [self.id]
@@ -324,11 +407,40 @@ class Task(object):
             self.progress = progress
             self.__emit_progress()
 
-    def set_output(self, output):
-        self.output = output
-        self.dispatcher.datastore.update('tasks', self.id, self)
+    def append_output(self, data):
+        self.output_tail.append(data)
+        self.output_pending.append(data)
+        self.output_pending_size += len(data)
+
+        if self.output_pending_size >= OUTPUT_CHUNK_SIZE or time.time() - self.output_flushed_at >= OUTPUT_FLUSH_INTERVAL:
+            self.flush_output()
+
+    def flush_output(self):
+        self.output_flushed_at = time.time()
+        if not self.output_pending:
+            return
+
+        data = ''.join(self.output_pending)
+        seq = self.output_seq
+        self.output_pending = []
+        self.output_pending_size = 0
+        self.output_seq += 1
+
+        self.dispatcher.datastore.insert('tasks.output', {
+            'task_id': self.id,
+            'seq': seq,
+            'data': data
+        })
+
+        self.dispatcher.dispatch_event('task.output', {
+            'id': self.id,
+            'seq': seq,
+            'data': data,
+            'nolog': True
+        })
 
     def progress_watcher(self):
+        ticks = 0
         while True:
             if self.ended.wait(1):
                 return
@@ -346,29 +458,59 @@ class Task(object):
             #    self.dispatcher.balancer.task_exited(self)
             #    self.dispatcher.balancer.logger.debug("Task ID: %d, Name: %s was TIMEDOUT", self.id, self.name)
             else:
+                # Output which arrived just before the task went quiet
+                # would otherwise wait until more of it shows up
+                if self.output_pending and time.time() - self.output_flushed_at >= OUTPUT_FLUSH_INTERVAL:
+                    self.flush_output()
+
+                ticks += 1
+                if self.executor.push_mode and ticks % PROGRESS_LIVENESS_INTERVAL:
+                    continue
+
                 progress = self.executor.get_status()
                 if progress:
-                    self.progress = progress
-                    self.__emit_progress()
+                    self.update_progress(progress)
 
 
 class Balancer(object):
     def __init__(self, dispatcher):
         self.dispatcher = dispatcher
-        self.task_list = []
+        self.tasks = {}
+        self.task_states = {s: collections.OrderedDict() for s in (
+            TaskState.CREATED,
+            TaskState.WAITING,
+            TaskState.EXECUTING,
+            TaskState.FINISHED,
+            TaskState.FAILED,
+            TaskState.ABORTED
+        )}
+        self.runnable = collections.OrderedDict()
+        self.parked = {}
+        self.finished = collections.deque()
+        self.task_retention = self.dispatcher.configstore.get('middleware.task_retention', DEFAULT_TASK_RETENTION)
         self.task_queue = Queue()
         self.resource_graph = dispatcher.resource_graph
         self.queues = {}
         self.threads = []
         self.executors = []
+        self.executor_index = 0
+        self.executors_min = self.dispatcher.configstore.get('middleware.executors_count')
+        self.executors_max = self.dispatcher.configstore.get('middleware.executors_max', DEFAULT_EXECUTORS_MAX)
+        self.executors_spare = self.dispatcher.configstore.get('middleware.executors_spare', DEFAULT_EXECUTORS_SPARE)
+        self.executors_idle_timeout = self.dispatcher.configstore.get(
+            'middleware.executors_idle_timeout',
+            DEFAULT_EXECUTORS_IDLE_TIMEOUT
+        )
         self.logger = logging.getLogger('Balancer')
         self.dispatcher.require_collection('tasks', 'serial', type='log')
+        self.dispatcher.require_collection('tasks.output', 'serial', type='log', indexes=[['task_id', 'seq']])
         self.create_initial_queues()
         self.start_executors()
         self.distribution_lock = RLock()
         self.debugger = None
         self.debugged_tasks = None
         self.dispatcher.register_event_type('task.changed')
+        self.dispatcher.register_event_type('task.output')
 
         # Lets try to get `EXECUTING|WAITING|CREATED` state tasks
         # from the previous dispatcher instance and set their
@@ -394,36 +536,64 @@ class Balancer(object):
         self.resource_graph.add_resource(Resource('system'))
 
     def start_executors(self):
-        for i in range(0, self.dispatcher.configstore.get('middleware.executors_count')):
-            self.logger.info('Starting task executor #{0}...'.format(i))
-            self.executors.append(TaskExecutor(self, i))
+        for i in range(0, self.executors_min):
+            self.spawn_executor()
+
+    def spawn_executor(self):
+        self.logger.info('Starting task executor #{0}...'.format(self.executor_index))
+        executor = TaskExecutor(self, self.executor_index)
+        self.executor_index += 1
+        self.executors.append(executor)
+        return executor
+
+    def ensure_spare_executors(self):
+        # Keep some executors idle or starting up ahead of demand
+        spare = len([e for e in self.executors if e.state in (WorkerState.IDLE, WorkerState.STARTING)])
+        count = min(self.executors_spare - spare, self.executors_max - len(self.executors))
+        for i in range(0, count):
+            self.spawn_executor()
+
+    def reap_executors(self):
+        now = time.time()
+        for e in sorted(self.executors, key=lambda e: e.idle_since or now):
+            if len(self.executors) <= self.executors_min:
+                return
+
+            if e.state != WorkerState.IDLE or now - e.idle_since < self.executors_idle_timeout:
+                continue
+
+            self.logger.info('Stopping idle task executor #{0}'.format(e.index))
+            self.executors.remove(e)
+            e.die()
+
+    def reaper_thread(self):
+        while True:
+            gevent.sleep(min(self.executors_idle_timeout, 10))
+            self.reap_executors()
 
     def start(self):
         self.threads.append(gevent.spawn(self.distribution_thread))
+        self.threads.append(gevent.spawn(self.reaper_thread))
         self.logger.info("Started")
 
-    def schema_to_list(self, schema):
-        return {
-            'type': 'array',
-            'items': schema,
-            'minItems': sum([1 for x in schema if 'mandatory' in x and x['mandatory']]),
-            'maxItems': len(schema)
-        }
-
-    def verify_schema(self, clazz, args):
+    def verify_schema(self, clazz, args, name=None):
         if not hasattr(clazz, 'params_schema'):
             return []
 
-        schema = self.schema_to_list(clazz.params_schema)
-        val = validator.DefaultDraft4Validator(schema, resolver=self.dispatcher.rpc.get_schema_resolver(schema))
-        return list(val.iter_errors(args))
+        start = time.time()
+        val = self.dispatcher.rpc.get_validator(clazz.params_schema, 'list')
+        errors = list(val.iter_errors(args))
+        if name:
+            self.dispatcher.rpc.record_call('task:{0}'.format(name), time.time() - start, 0)
+
+        return errors
 
     def submit(self, name, args, sender):
         if name not in self.dispatcher.tasks:
             self.logger.warning("Cannot submit task: unknown task type %s", name)
             raise RpcException(errno.EINVAL, "Unknown task type {0}".format(name))
 
-        errors = self.verify_schema(self.dispatcher.tasks[name], args)
+        errors = self.verify_schema(self.dispatcher.tasks[name], args, name)
         if len(errors) > 0:
             errors = list(validator.serialize_errors(errors))
             self.logger.warning(
@@ -470,7 +640,7 @@ class Balancer(object):
                     task.debugger = self.debugger
 
         task.set_state(TaskState.CREATED)
-        self.task_list.append(task)
+        self.assign_executor(task, force=True)
         task.start()
         return task
 
@@ -499,20 +669,104 @@ class Balancer(object):
 
     def task_exited(self, task):
         self.resource_graph.release(*task.resources)
+        self.wake_tasks(self.resource_graph.get_affected_resources(*task.resources))
+        self.evict_tasks()
         self.schedule_tasks()
 
+    def task_state_changed(self, task, old_state):
+        self.tasks[task.id] = task
+        self.task_states[old_state].pop(task.id, None)
+        self.task_states[task.state][task.id] = task
+
+        if old_state == TaskState.WAITING:
+            self.unpark_task(task)
+
+        if task.state in TERMINAL_STATES and old_state not in TERMINAL_STATES:
+            self.finished.append((time.time(), task.id))
+
+    def park_task(self, task, resources):
+        task.blocked_on = resources
+        for i in resources:
+            self.parked.setdefault(i, collections.OrderedDict())[task.id] = task
+
+    def unpark_task(self, task):
+        for i in task.blocked_on:
+            tasks = self.parked.get(i)
+            if tasks is None:
+                continue
+
+            tasks.pop(task.id, None)
+            if not tasks:
+                del self.parked[i]
+
+        task.blocked_on = []
+
+    def wake_tasks(self, resources=None):
+        """
+        Move tasks parked on given resources (or all parked tasks) back
+        to the runnable queue, oldest first.
+        """
+        if resources is None:
+            resources = list(self.parked.keys())
+
+        woken = {}
+        for i in resources:
+            woken.update(self.parked.get(i, {}))
+
+        for tid in sorted(woken):
+            task = woken[tid]
+            self.unpark_task(task)
+            self.runnable[tid] = task
+
+    def evict_tasks(self):
+        cutoff = time.time() - self.task_retention
+        deferred = []
+
+        while self.finished and self.finished[0][0] < cutoff:
+            _, tid = self.finished.popleft()
+            task = self.tasks.get(tid)
+            if not task or task.state not in TERMINAL_STATES:
+                continue
+
+            # Parent may still want to join it
+            if task.parent and not task.parent.ended.is_set():
+                deferred.append((time.time(), tid))
+                continue
+
+            del self.tasks[tid]
+            self.task_states[task.state].pop(tid, None)
+
+        self.finished.extend(deferred)
+
     def schedule_tasks(self):
         """
         This function is called when:
         1) any new task is submitted to any of the queues
         2) any task exists
 
+        Only tasks which were just submitted or woken up by resources
+        being released are considered. Tasks which still cannot run are
+        parked on the resources they are blocked on.
+
         :return:
         """
-        for task in [t for t in self.task_list if t.state == TaskState.WAITING]:
-            if not self.resource_graph.can_acquire(*task.resources):
+        while self.runnable:
+            tid, task = self.runnable.popitem(last=False)
+            if task.state != TaskState.WAITING:
                 continue
 
+            blocked = [r for r in task.resources if not self.resource_graph.can_acquire(r)]
+            if blocked:
+                self.park_task(task, blocked)
+                continue
+
+            if not self.assign_executor(task):
+                # Keep the task at the head of the queue, scheduling
+                # resumes as soon as some executor becomes idle
+                self.runnable[tid] = task
+                self.runnable.move_to_end(tid, last=False)
+                return
+
             self.resource_graph.acquire(*task.resources)
             self.threads.append(task.start())
 
@@ -533,7 +787,6 @@ class Balancer(object):
             except Exception as err:
                 self.logger.warning("Cannot verify task %d: %s", task.id, err)
                 task.set_state(TaskState.FAILED, TaskStatus(0), serialize_error(err))
-                self.task_list.append(task)
                 task.ended.set()
                 self.distribution_lock.release()
 
@@ -543,51 +796,65 @@ class Balancer(object):
                 continue
 
             task.set_state(TaskState.WAITING)
-            self.task_list.append(task)
+            self.runnable[task.id] = task
             self.distribution_lock.release()
             self.schedule_tasks()
             self.logger.debug("Task %d assigned to resources %s", task.id, ','.join(task.resources))
 
-    def assign_executor(self, task):
-        for i in self.executors:
-            if i.state == WorkerState.IDLE:
-                self.logger.info("Task %d assigned to executor #%d", task.id, i.index)
-                task.executor = i
-                i.state = WorkerState.EXECUTING
-                return
+    def assign_executor(self, task, force=False):
+        """
+        Assigns an idle executor to the task. Never blocks for queued tasks:
+        if none is available, None is returned (spawning a new executor if
+        the pool is not at its limit yet) and the task is picked up again
+        once an executor becomes idle.
+
+        With ``force``, used for subtasks, a new executor is spawned past
+        ``executors_max`` and waited for. Parent task holds an executor while
+        waiting for its subtask, so making subtasks queue for the pool could
+        deadlock it.
+        """
+        executor = first_or_default(lambda e: e.state == WorkerState.IDLE and not e.reserved, self.executors)
+        if not executor and force:
+            executor = self.spawn_executor()
+            executor.reserved = True
+            executor.checked_in.wait()
+            executor.reserved = False
+
+        if not executor:
+            # Out of executors! Spawn new ones for the demand, unless pool is already at its limit
+            starting = len([e for e in self.executors if e.state == WorkerState.STARTING and not e.reserved])
+            if starting < len(self.runnable) + 1 and len(self.executors) < self.executors_max:
+                self.spawn_executor()
+            elif not starting:
+                self.logger.info("All %d executors busy, task %d waiting", len(self.executors), task.id)
 
-        # Out of executors! Need to spawn new one
-        executor = TaskExecutor(self, len(self.executors))
-        self.executors.append(executor)
-        executor.checked_in.wait()
-        executor.state = WorkerState.EXECUTING
+            return None
+
+        executor.set_busy()
         task.executor = executor
         self.logger.info("Task %d assigned to executor #%d", task.id, executor.index)
+        self.ensure_spare_executors()
+        return executor
 
     def dispose_executors(self):
         for i in self.executors:
             i.die()
 
     def get_active_tasks(self):
-        return [x for x in self.task_list if x.state in (
-            TaskState.CREATED,
-            TaskState.WAITING,
-            TaskState.EXECUTING)]
+        result = []
+        for i in (TaskState.CREATED, TaskState.WAITING, TaskState.EXECUTING):
+            result.extend(self.task_states[i].values())
+
+        return result
 
     def get_tasks(self, type=None):
         if type is None:
-            return self.task_list
+            return list(self.tasks.values())
 
-        return [x for x in self.task_list if x.state == type]
+        return list(self.task_states[type].values())
 
     def get_task(self, id):
-        self.distribution_lock.acquire()
-        t = first_or_default(lambda x: x.id == id, self.task_list)
-        if not t:
-            t = first_or_default(lambda x: x.id == id, self.task_queue.queue)
-
-        self.distribution_lock.release()
-        return t
+        return self.tasks.get(id)
 
     def get_executor_by_key(self, key):
         return first_or_default(lambda t: t.key == key, self.executors)
@@ -0,0 +1,163 @@
+#+
+# Copyright 2015 iXsystems, Inc.
+# All rights reserved
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted providing that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR ``AS IS'' AND ANY EXPRESS OR
+# IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT,
+# STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING
+# IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+#####################################################################
+
+import time
+import logging
+import collections
+import gevent
+from gevent.event import Event
+
+
+class OverflowPolicy(object):
+    DROP_OLDEST = 'DROP_OLDEST'
+    DROP_NEWEST = 'DROP_NEWEST'
+    BLOCK = 'BLOCK'
+
+    ALL = (DROP_OLDEST, DROP_NEWEST, BLOCK)
+
+
+class EventJournal(object):
+    """
+    Background writer persisting dispatched events to the datastore.
+
+    Events are appended to a bounded in-memory queue and written out by
+    a single greenlet using bulk inserts, either when ``batch_size``
+    events are pending or ``flush_interval`` seconds have passed since
+    the last flush. Event delivery therefore never waits on the
+    datastore, unless the queue is full and ``BLOCK`` policy is used.
+    """
+    def __init__(self, datastore, collection='events', queue_size=10000, batch_size=256,
+                 flush_interval=1.0, overflow_policy=OverflowPolicy.DROP_OLDEST):
+        self.datastore = datastore
+        self.collection = collection
+        self.queue_size = queue_size
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        if overflow_policy not in OverflowPolicy.ALL:
+            raise ValueError('Invalid overflow policy: {0}'.format(overflow_policy))
+
+        self.overflow_policy = overflow_policy
+        self.logger = logging.getLogger('EventJournal')
+        self.queue = collections.deque()
+        self.pending = Event()
+        self.not_full = Event()
+        self.not_full.set()
+        self.thread = None
+        self.running = False
+        self.stats = {
+            'enqueued': 0,
+            'persisted': 0,
+            'dropped': 0,
+            'failed': 0,
+            'flushes': 0,
+            'blocked': 0,
+            'high_watermark': 0,
+            'last_flush_size': 0,
+            'last_flush_duration': 0,
+        }
+
+    def start(self):
+        self.running = True
+        self.thread = gevent.spawn(self.run)
+
+    def stop(self):
+        self.running = False
+        self.pending.set()
+        if self.thread:
+            self.thread.join()
+
+        # Drain whatever is left
+        while self.queue:
+            self.flush()
+
+    def put(self, event):
+        if len(self.queue) >= self.queue_size:
+            if self.overflow_policy == OverflowPolicy.BLOCK:
+                self.stats['blocked'] += 1
+                self.pending.set()
+                while len(self.queue) >= self.queue_size:
+                    self.not_full.clear()
+                    self.not_full.wait()
+            elif self.overflow_policy == OverflowPolicy.DROP_OLDEST:
+                self.queue.popleft()
+                self.stats['dropped'] += 1
+            else:
+                self.stats['dropped'] += 1
+                return
+
+        self.queue.append(event)
+        self.stats['enqueued'] += 1
+        self.stats['high_watermark'] = max(self.stats['high_watermark'], len(self.queue))
+
+        if len(self.queue) >= self.batch_size:
+            self.pending.set()
+
+    def run(self):
+        while self.running:
+            self.pending.wait(self.flush_interval)
+            self.pending.clear()
+            if self.queue:
+                self.flush()
+
+    def flush(self):
+        batch = []
+        while self.queue and len(batch) < self.batch_size:
+            batch.append(self.queue.popleft())
+
+        self.not_full.set()
+        if not batch:
+            return
+
+        started_at = time.time()
+        try:
+            result = self.datastore.insert_many(self.collection, batch)
+            errors = [err for _, err in result if err]
+            self.stats['persisted'] += len(batch) - len(errors)
+            self.stats['failed'] += len(errors)
+            if errors:
+                self.logger.warning('Cannot persist {0} events: {1}'.format(len(errors), str(errors[0])))
+        except Exception as err:
+            self.stats['failed'] += len(batch)
+            self.logger.warning('Cannot persist {0} events: {1}'.format(len(batch), str(err)))
+
+        self.stats['flushes'] += 1
+        self.stats['last_flush_size'] = len(batch)
+        self.stats['last_flush_duration'] = time.time() - started_at
+
+        # More than one batch pending - keep flushing without waiting
+        if len(self.queue) >= self.batch_size:
+            self.pending.set()
+
+    def get_stats(self):
+        stats = self.stats.copy()
+        stats.update({
+            'queued': len(self.queue),
+            'queue_size': self.queue_size,
+            'overflow_policy': self.overflow_policy
+        })
+
+        return stats
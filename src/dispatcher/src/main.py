@@ -29,7 +29,7 @@
 
 import os
 import sys
-import fnmatch
+import copy
 import glob
 import imp
 import json
@@ -68,6 +68,8 @@ from datastore.config import ConfigStore
 from freenas.dispatcher.jsonenc import loads, dumps
 from freenas.dispatcher.rpc import RpcContext, RpcException, ServerLockProxy, convert_schema
 from resources import ResourceGraph
+from router import EventRouter
+from journal import EventJournal
 from services import ManagementService, DebugService, EventService, TaskService, PluginService, ShellService, LockService
 from schemas import register_general_purpose_schemas
 from api.handler import ApiHandler
@@ -79,12 +81,13 @@ from freenas.utils import FaultTolerantLogHandler
 DEFAULT_CONFIGFILE = '/usr/local/etc/middleware.conf'
 LOGGING_FORMAT = '%(asctime)s %(levelname)s %(filename)s:%(lineno)d %(message)s'
 trace_log_file = None
+trace_enabled = bool(os.getenv('DISPATCHER_TRACE'))
 
 
 def trace_log(message, *args):
     global trace_log_file
 
-    if os.getenv('DISPATCHER_TRACE'):
+    if trace_enabled:
         if not trace_log_file:
             try:
                 trace_log_file = open('/var/tmp/dispatcher-trace.{0}.log'.format(os.getpid()), 'w')
@@ -95,6 +98,26 @@ def trace_log(message, *args):
         trace_log_file.flush()
 
 
+class EncodedFrame(object):
+    """
+    Message encoded once and shared between all recipient connections.
+    Text form is used by WebSocket clients, UTF-8 bytes form (computed
+    on first use) by Unix domain socket clients.
+    """
+    __slots__ = ('text', '_data')
+
+    def __init__(self, obj):
+        self.text = dumps(obj)
+        self._data = None
+
+    @property
+    def data(self):
+        if self._data is None:
+            self._data = self.text.encode('utf-8')
+
+        return self._data
+
+
 class Plugin(object):
     UNLOADED = 1
     LOADED = 2
@@ -200,6 +223,10 @@ class Plugin(object):
         self.dispatcher.register_resource(res, parents)
         self.registers['resources'].append((res, parents))
 
+    def register_resources(self, resources):
+        self.dispatcher.register_resources(resources)
+        self.registers['resources'].extend(resources)
+
     def unregister_resource(self, res):
         self.dispatcher.unregister_resource(res)
         self.registers['resources'].remove(res)
@@ -262,12 +289,12 @@ class EventType(object):
         self.refcount = 0
         self.logger = logging.getLogger('EventType:{0}'.format(name))
 
-    def incref(self):
+    def incref(self, count=1):
         if self.refcount == 0 and self.source:
             self.source.enable(self.name)
             self.logger.debug('Enabling event source: {0}'.format(self.name))
 
-        self.refcount += 1
+        self.refcount += count
 
     def decref(self):
         # lets not go below 0!!!
@@ -303,9 +330,11 @@ class Dispatcher(object):
         self.providers = {}
         self.tasks = {}
         self.resource_graph = ResourceGraph()
+        self.event_router = EventRouter()
         self.logger = logging.getLogger('Main')
         self.token_store = TokenStore(self)
         self.event_delivery_lock = RLock()
+        self.event_journal = None
         self.rpc = None
         self.balancer = None
         self.datastore = None
@@ -326,13 +355,23 @@ class Dispatcher(object):
             self.config['datastore']['dsn']
         )
 
-        self.configstore = ConfigStore(self.datastore)
+        self.configstore = ConfigStore(self.datastore, cached=True, notify=self.__on_config_set)
         self.logger.info('Connected to datastore')
         self.require_collection('events', 'serial', type='log')
         self.require_collection('sessions', 'serial', type='log')
         self.require_collection('tasks', 'serial', type='log')
         self.require_collection('logs', 'uuid', type='log')
 
+        self.event_journal = EventJournal(
+            self.datastore,
+            'events',
+            queue_size=self.configstore.get('middleware.event_journal.queue_size', 10000),
+            batch_size=self.configstore.get('middleware.event_journal.batch_size', 256),
+            flush_interval=self.configstore.get('middleware.event_journal.flush_interval', 1),
+            overflow_policy=self.configstore.get('middleware.event_journal.overflow_policy', 'DROP_OLDEST')
+        )
+        self.event_journal.start()
+
         self.balancer = Balancer(self)
         self.auth = PasswordAuthenticator(self)
         self.rpc = ServerRpcContext(self)
@@ -357,6 +396,8 @@ class Dispatcher(object):
         self.register_event_type('server.plugin.loaded')
         self.register_event_type('server.ready')
         self.register_event_type('server.shutdown')
+        self.register_event_type('config.changed')
+        self.register_event_handler('config.changed', self.__on_config_changed)
 
     def start(self):
         self.started_at = time.time()
@@ -500,6 +541,19 @@ class Dispatcher(object):
             except IOError as err:
                 self.logger.warning('Cannot initialize syslog: %s', str(err))
 
+    def __on_config_set(self, keys):
+        self.dispatch_event('config.changed', {
+            'keys': keys,
+            'pid': os.getpid(),
+            'nolog': True
+        })
+
+    def __on_config_changed(self, args):
+        if args.get('pid') == os.getpid():
+            return
+
+        self.configstore.invalidate(args['keys'])
+
     def __init_syslog(self):
         handler = logging.handlers.SysLogHandler('/var/run/log', facility='local3')
         logging.root.setLevel(logging.DEBUG)
@@ -511,8 +565,25 @@ class Dispatcher(object):
                 # If there's no timestamp, assume event fired right now
                 args['timestamp'] = time.time()
 
-            for srv in self.ws_servers:
-                srv.broadcast_event(name, args)
+            subscribers = self.event_router.route(name)
+            if subscribers:
+                try:
+                    frame = EncodedFrame({
+                        "namespace": "events",
+                        "name": "event",
+                        "id": None,
+                        "args": {
+                            "name": name,
+                            "args": args
+                        }
+                    })
+                except UnicodeDecodeError:
+                    self.logger.error('Error encoding payload of event %s to JSON: %r', name, args)
+                    frame = None
+
+                if frame:
+                    for conn in subscribers:
+                        conn.send_frame(frame)
 
             if name in self.event_handlers:
                 for h in self.event_handlers[name]:
@@ -525,15 +596,16 @@ class Dispatcher(object):
             if 'nolog' in args and args['nolog']:
                 return
 
-            # Persist event
-            event_data = args.copy()
-            del event_data['timestamp']
+            # Journal is written later, take a snapshot before any handler gets to run
+            event_data = copy.deepcopy(args)
+            timestamp = event_data.pop('timestamp')
 
-            self.datastore.insert('events', {
-                'name': name,
-                'timestamp': args['timestamp'],
-                'args': event_data
-            })
+        # Persist event (asynchronously), outside of the lock as put() may block
+        self.event_journal.put({
+            'name': name,
+            'timestamp': timestamp,
+            'args': event_data
+        })
 
     def call_sync(self, name, *args, **kwargs):
         return self.rpc.call_sync(name, *args)
@@ -568,11 +640,18 @@ class Dispatcher(object):
         self.threads.append(greenlet)
 
     def register_event_type(self, name, source=None, schema=None):
-        self.event_types[name] = EventType(name, source, schema)
+        ev = EventType(name, source, schema)
+        self.event_router.add_name(name)
+        refcount = self.event_router.refcount(name)
+        if refcount > 0:
+            ev.incref(refcount)
+
+        self.event_types[name] = ev
         self.dispatch_event('server.event.added', {'name': name})
 
     def unregister_event_type(self, name):
         del self.event_types[name]
+        self.event_router.remove_name(name)
         self.dispatch_event('server.event.removed', {'name': name})
 
     def register_task_handler(self, name, clazz):
@@ -604,14 +683,33 @@ class Dispatcher(object):
     def register_resource(self, res, parents=None):
         self.logger.debug('Resource added: {0}'.format(res.name))
         self.resource_graph.add_resource(res, parents)
+        self.resources_changed([res.name])
+
+    def register_resources(self, resources):
+        self.logger.debug('Resources added: {0}'.format(len(resources)))
+        self.resource_graph.add_resources(resources)
+        self.resources_changed([res.name for res, _ in resources])
 
     def update_resource(self, name, new_parents):
         self.logger.debug('Resource updated: {0}, new parents: {1}'.format(name, ', '.join(new_parents)))
         self.resource_graph.update_resource(name, new_parents)
+        self.resources_changed()
 
     def unregister_resource(self, name):
         self.logger.debug('Resource removed: {0}'.format(name))
         self.resource_graph.remove_resource(name)
+        self.resources_changed()
+
+    def unregister_resources(self, names):
+        self.logger.debug('Resources removed: {0}'.format(len(names)))
+        self.resource_graph.remove_resources(names)
+        self.resources_changed()
+
+    def resources_changed(self, names=None):
+        # Tasks might be parked on resources that just appeared or had busy descendants removed
+        if self.balancer and self.balancer.parked:
+            self.balancer.wake_tasks(names)
+            self.balancer.schedule_tasks()
 
     def resource_exists(self, name):
         return self.resource_graph.get_resource(name) is not None
@@ -719,6 +817,8 @@ class Dispatcher(object):
         gevent.killall(self.threads)
         self.logger.warning('Unloading plugins')
         self.unload_plugins()
+        self.logger.warning('Flushing event journal')
+        self.event_journal.stop()
         sys.exit(0)
 
 
@@ -767,10 +867,6 @@ class Server(WebSocketServer):
         super(Server, self).__init__(*args, **kwargs)
         self.connections = []
 
-    def broadcast_event(self, event, args):
-        for i in self.connections:
-            i.emit_event(event, args)
-
 
 class UnixSocketServer(object):
     class UnixSocketHandler(object):
@@ -786,7 +882,7 @@ class UnixSocketServer(object):
             self.conn = None
 
         def send(self, message):
-            data = message.encode('utf-8')
+            data = message if isinstance(message, bytes) else message.encode('utf-8')
             header = struct.pack('II', 0xdeadbeef, len(data))
             self.fd.write(header)
             self.fd.write(data)
@@ -825,10 +921,6 @@ class UnixSocketServer(object):
         self.logger = logging.getLogger('UnixSocketServer')
         self.connections = []
 
-    def broadcast_event(self, event, args):
-        for i in self.connections:
-            i.emit_event(event, args)
-
     def serve_forever(self):
         try:
             if os.path.exists(self.path):
@@ -888,10 +980,11 @@ class ServerConnection(WebSocketApplication, EventEmitter):
         if self.user:
             self.close_session()
 
-        for mask in self.event_masks:
-            for name, ev in list(self.dispatcher.event_types.items()):
-                if fnmatch.fnmatch(name, mask):
-                    ev.decref()
+        with self.event_subscription_lock:
+            for mask in self.event_masks:
+                self.unsubscribe_mask(mask)
+
+            self.event_masks = set()
 
         self.dispatcher.dispatch_event('server.client_disconnected', {
             'address': client_addr,
@@ -952,9 +1045,7 @@ class ServerConnection(WebSocketApplication, EventEmitter):
         with self.event_subscription_lock:
             # Increment reference count for any newly subscribed event
             for mask in set.difference(set(event_masks), self.event_masks):
-                for name, ev in list(self.dispatcher.event_types.items()):
-                    if fnmatch.fnmatch(name, mask):
-                        ev.incref()
+                self.subscribe_mask(mask)
 
             self.event_masks = set.union(self.event_masks, set(event_masks))
 
@@ -978,12 +1069,22 @@ class ServerConnection(WebSocketApplication, EventEmitter):
             # Decrement reference count for any newly unsubscribed event
             intersecting_unsubscribe_events = set.intersection(set(event_masks), self.event_masks)
             for mask in intersecting_unsubscribe_events:
-                for name, ev in list(self.dispatcher.event_types.items()):
-                    if fnmatch.fnmatch(name, mask):
-                        ev.decref()
+                self.unsubscribe_mask(mask)
 
             self.event_masks = set.difference(self.event_masks, intersecting_unsubscribe_events)
 
+    def subscribe_mask(self, mask):
+        for name in self.dispatcher.event_router.subscribe(self, mask):
+            ev = self.dispatcher.event_types.get(name)
+            if ev:
+                ev.incref()
+
+    def unsubscribe_mask(self, mask):
+        for name in self.dispatcher.event_router.unsubscribe(self, mask):
+            ev = self.dispatcher.event_types.get(name)
+            if ev:
+                ev.decref()
+
     def on_events_event(self, id, data):
         if self.user is None:
             return
@@ -1236,10 +1337,6 @@ class ServerConnection(WebSocketApplication, EventEmitter):
                 'description': "Client {0} logged out".format(self.user.name)
             })
 
-    def broadcast_event(self, event, args):
-        for i in self.server.connections:
-            i.emit_event(event, args)
-
     def call_client(self, method, callback, *args):
         id = uuid.uuid4()
         event = AsyncResult()
@@ -1281,21 +1378,6 @@ class ServerConnection(WebSocketApplication, EventEmitter):
         event = self.call_client(method, None, *args)
         return event.get(timeout=timeout)
 
-    def emit_event(self, event, args):
-        for i in self.event_masks:
-            if not fnmatch.fnmatch(event, i):
-                continue
-
-            self.send_json({
-                "namespace": "events",
-                "name": "event",
-                "id": None,
-                "args": {
-                    "name": event,
-                    "args": args
-                }
-            })
-
     def emit_rpc_call(self, id, method, args):
         payload = {
             "namespace": "rpc",
@@ -1333,7 +1415,17 @@ class ServerConnection(WebSocketApplication, EventEmitter):
             self.dispatcher.logger.error(repr(obj))
             return
 
-        trace_log('{0} <- {1}', self.real_client_address, data)
+        self.send_data(data)
+
+    def send_frame(self, frame):
+        if isinstance(self.ws, UnixSocketServer.UnixSocketHandler):
+            self.send_data(frame.data, frame.text)
+            return
+
+        self.send_data(frame.text)
+
+    def send_data(self, data, text=None):
+        trace_log('{0} <- {1}', self.real_client_address, text or data)
 
         with self.rlock:
             try:
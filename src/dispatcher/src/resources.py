@@ -35,6 +35,7 @@ class Resource(object):
     def __init__(self, name):
         self.name = name
         self.busy = False
+        self.busy_count = 0
 
 
 class ResourceError(RuntimeError):
@@ -42,12 +43,19 @@ class ResourceError(RuntimeError):
 
 
 class ResourceGraph(object):
+    """
+    Every resource keeps a busy_count: the number of busy resources among
+    itself and its descendants. It is updated incrementally on acquire and
+    release by walking the (usually short) ancestor chain, so checking
+    whether a resource can be acquired never has to visit its subtree.
+    """
     def __init__(self):
         self.logger = logging.getLogger('ResourceGraph')
         self.mutex = RLock()
         self.root = Resource('root')
         self.resources = nx.DiGraph()
         self.resources.add_node(self.root)
+        self.index = {self.root.name: self.root}
 
     def lock(self):
         self.mutex.acquire()
@@ -59,69 +67,110 @@ class ResourceGraph(object):
     def nodes(self):
         return self.resources.nodes()
 
-    def add_resource(self, resource, parents=None):
-        self.lock()
-
-        if not resource:
-            self.unlock()
-            raise ResourceError('Invalid resource')
+    def __mark_busy(self, resource, delta):
+        resource.busy_count += delta
+        for i in nx.ancestors(self.resources, resource):
+            i.busy_count += delta
 
-        if self.get_resource(resource.name):
-            self.unlock()
-            raise ResourceError('Resource {0} already exists'.format(resource.name))
+    def __rebuild_busy_counts(self):
+        for i in self.resources.nodes():
+            i.busy_count = 0
 
-        self.resources.add_node(resource)
-        if not parents:
-            parents = ['root']
+        for i in self.resources.nodes():
+            if i.busy:
+                self.__mark_busy(i, 1)
 
-        for p in parents:
-            node = self.get_resource(p)
+    def __get_parents(self, parents, pending=None):
+        result = []
+        for p in parents or ['root']:
+            node = self.index.get(p) or (pending or {}).get(p)
             if not node:
-                self.unlock()
                 raise ResourceError('Invalid parent resource {0}'.format(p))
 
-            self.resources.add_edge(node, resource)
+            result.append(node)
 
-        self.unlock()
+        return result
 
-    def remove_resource(self, name):
-        self.lock()
-        resource = self.get_resource(name)
+    def __remove(self, resource, keep_self=False):
+        removed = nx.descendants(self.resources, resource)
+        if not keep_self:
+            removed.add(resource)
 
-        if not resource:
-            self.unlock()
-            return
+        # Busy resources going away no longer count towards their ancestors
+        for i in removed:
+            if i.busy:
+                for a in nx.ancestors(self.resources, i) - removed:
+                    a.busy_count -= 1
 
-        for i in nx.descendants(self.resources, resource):
-            self.resources.remove_node(i)
+        self.resources.remove_nodes_from(removed)
+        for i in removed:
+            self.index.pop(i.name, None)
 
-        self.resources.remove_node(resource)
-        self.unlock()
+    def add_resource(self, resource, parents=None):
+        self.add_resources([(resource, parents)])
 
-    def update_resource(self, name, new_parents):
-        self.lock()
-        resource = self.get_resource(name)
+    def add_resources(self, resources):
+        with self.mutex:
+            pending = {}
+            edges = []
+            for resource, parents in resources:
+                if not resource:
+                    raise ResourceError('Invalid resource')
 
-        if not resource:
-            self.unlock()
-            return
+                if resource.name in self.index or resource.name in pending:
+                    raise ResourceError('Resource {0} already exists'.format(resource.name))
 
-        for i in nx.descendants(self.resources, resource):
-            self.resources.remove_node(i)
+                edges.extend((p, resource) for p in self.__get_parents(parents, pending))
+                pending[resource.name] = resource
 
-        for p in new_parents:
-            node = self.get_resource(p)
-            if not node:
-                self.unlock()
-                raise ResourceError('Invalid parent resource {0}'.format(p))
+            self.resources.add_nodes_from(pending.values())
+            self.resources.add_edges_from(edges)
+            self.index.update(pending)
 
-            self.resources.add_edge(node, resource)
+    def remove_resource(self, name):
+        self.remove_resources([name])
 
-        self.unlock()
+    def remove_resources(self, names):
+        with self.mutex:
+            for name in names:
+                # Might be gone already as a descendant of one removed earlier
+                resource = self.index.get(name)
+                if resource:
+                    self.__remove(resource)
+
+    def update_resource(self, name, new_parents):
+        with self.mutex:
+            resource = self.get_resource(name)
+
+            if not resource:
+                return
+
+            parents = self.__get_parents(new_parents)
+            self.__remove(resource, keep_self=True)
+            self.resources.add_edges_from((p, resource) for p in parents)
+
+            if resource.busy:
+                self.__rebuild_busy_counts()
 
     def get_resource(self, name):
-        f = [i for i in self.resources.nodes() if i.name == name]
-        return f[0] if len(f) > 0 else None
+        return self.index.get(name)
+
+    def get_affected_resources(self, *names):
+        """
+        Return given resource names along with names of all their ancestors,
+        that is every resource whose busy_count depends on them.
+        """
+        with self.mutex:
+            result = set()
+            for name in names:
+                res = self.get_resource(name)
+                if not res:
+                    continue
+
+                result.add(name)
+                result.update(i.name for i in nx.ancestors(self.resources, res))
+
+            return result
 
     def get_resource_dependencies(self, name):
         res = self.get_resource(name)
@@ -129,51 +178,42 @@ class ResourceGraph(object):
             yield i.name
 
     def acquire(self, *names):
-        self.lock()
-        self.logger.debug('Acquiring following resources: %s', ','.join(names))
+        with self.mutex:
+            self.logger.debug('Acquiring following resources: %s', ','.join(names))
+            resources = []
 
-        for name in names:
-            res = self.get_resource(name)
-            if not res:
-                raise ResourceError('Resource {0} not found'.format(name))
+            for name in names:
+                res = self.get_resource(name)
+                if not res:
+                    raise ResourceError('Resource {0} not found'.format(name))
 
-            for i in nx.descendants(self.resources, res):
-                if i.busy:
-                    self.unlock()
+                if res.busy_count - int(res.busy) > 0:
                     raise ResourceError('Cannot acquire, some of dependent resources are busy')
 
-            res.busy = True
+                resources.append(res)
 
-        self.unlock()
+            for res in resources:
+                if not res.busy:
+                    res.busy = True
+                    self.__mark_busy(res, 1)
 
     def can_acquire(self, *names):
-        self.lock()
-        self.logger.debug('Trying to acquire following resources: %s', ','.join(names))
-
-        for name in names:
-            res = self.get_resource(name)
-            if not res:
-                self.unlock()
-                return False
-
-            if res.busy:
-                self.unlock()
-                return False
-
-            for i in nx.descendants(self.resources, res):
-                if i.busy:
-                    self.unlock()
+        with self.mutex:
+            self.logger.debug('Trying to acquire following resources: %s', ','.join(names))
+
+            for name in names:
+                res = self.get_resource(name)
+                if not res or res.busy_count > 0:
                     return False
 
-        self.unlock()
-        return True
+            return True
 
     def release(self, *names):
-        self.lock()
-        self.logger.debug('Releasing following resources: %s', ','.join(names))
-
-        for name in names:
-            res = self.get_resource(name)
-            res.busy = False
-
-        self.unlock()
+        with self.mutex:
+            self.logger.debug('Releasing following resources: %s', ','.join(names))
+
+            for name in names:
+                res = self.get_resource(name)
+                if res and res.busy:
+                    res.busy = False
+                    self.__mark_busy(res, -1)
@@ -0,0 +1,225 @@
+#+
+# Copyright 2015 iXsystems, Inc.
+# All rights reserved
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted providing that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR ``AS IS'' AND ANY EXPRESS OR
+# IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT,
+# STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING
+# IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+#####################################################################
+
+import re
+import fnmatch
+
+
+WILDCARD_CHARS = ('*', '?', '[')
+
+
+def literal_prefix(mask):
+    for idx, ch in enumerate(mask):
+        if ch in WILDCARD_CHARS:
+            return mask[:idx]
+
+    return mask
+
+
+class EventRouter(object):
+    """
+    Maps event names to the set of connections subscribed to them.
+
+    Subscription masks are indexed in a character trie keyed by their
+    literal (non-wildcard) prefix, so only masks that can possibly match
+    a given event name are ever evaluated. Resolved routes are kept per
+    event name and maintained incrementally on subscribe, unsubscribe
+    and event type registration, which makes delivering an event cost
+    O(matching subscribers) instead of O(connections x masks).
+
+    Only registered event types and names with at least one matching
+    subscriber are kept in the route table, so dispatching arbitrary
+    event names does not grow it.
+    """
+    class Mask(object):
+        def __init__(self, mask):
+            self.mask = mask
+            self.regex = None
+            self.subscribers = set()
+            self.names = set()
+
+            if literal_prefix(mask) != mask:
+                self.regex = re.compile(fnmatch.translate(mask))
+
+        @property
+        def is_pattern(self):
+            return self.regex is not None
+
+        def match(self, name):
+            if self.regex is None:
+                return name == self.mask
+
+            return self.regex.match(name) is not None
+
+    class TrieNode(object):
+        def __init__(self):
+            self.children = {}
+            self.masks = set()
+
+    def __init__(self):
+        self.masks = {}
+        self.routes = {}
+        self.registered = set()
+        self.trie = self.TrieNode()
+
+    def __index_mask(self, entry):
+        node = self.trie
+        for ch in literal_prefix(entry.mask):
+            node = node.children.setdefault(ch, self.TrieNode())
+
+        node.masks.add(entry.mask)
+
+    def __unindex_mask(self, entry):
+        path = [self.trie]
+        prefix = literal_prefix(entry.mask)
+        for ch in prefix:
+            node = path[-1].children.get(ch)
+            if not node:
+                return
+
+            path.append(node)
+
+        path[-1].masks.discard(entry.mask)
+
+        # Prune now empty branches
+        for idx in range(len(prefix), 0, -1):
+            node = path[idx]
+            if node.masks or node.children:
+                break
+
+            del path[idx - 1].children[prefix[idx - 1]]
+
+    def __candidates(self, name):
+        literal = self.masks.get(name)
+        if literal and not literal.is_pattern:
+            yield literal
+
+        node = self.trie
+        for ch in name:
+            for mask in node.masks:
+                yield self.masks[mask]
+
+            node = node.children.get(ch)
+            if not node:
+                return
+
+        for mask in node.masks:
+            yield self.masks[mask]
+
+    def __add_route(self, name, force=False):
+        entries = [e for e in self.__candidates(name) if e.match(name)]
+        route = {}
+        for entry in entries:
+            for conn in entry.subscribers:
+                route[conn] = route.get(conn, 0) + 1
+
+        if route or force:
+            for entry in entries:
+                entry.names.add(name)
+
+            self.routes[name] = route
+
+        return route
+
+    def __remove_route(self, name):
+        for entry in self.__candidates(name):
+            entry.names.discard(name)
+
+        del self.routes[name]
+
+    def add_name(self, name):
+        self.registered.add(name)
+        if name not in self.routes:
+            self.__add_route(name, force=True)
+
+    def remove_name(self, name):
+        self.registered.discard(name)
+        if name in self.routes:
+            self.__remove_route(name)
+
+    def subscribe(self, conn, mask):
+        """
+        Subscribes ``conn`` to ``mask``. Returns the list of known event
+        names newly matched by that (connection, mask) pair.
+        """
+        entry = self.masks.get(mask)
+        if not entry:
+            entry = self.Mask(mask)
+            entry.names = {n for n in self.routes if entry.match(n)}
+            self.masks[mask] = entry
+            if entry.is_pattern:
+                self.__index_mask(entry)
+
+        if conn in entry.subscribers:
+            return []
+
+        entry.subscribers.add(conn)
+        for name in entry.names:
+            route = self.routes[name]
+            route[conn] = route.get(conn, 0) + 1
+
+        return list(entry.names)
+
+    def unsubscribe(self, conn, mask):
+        """
+        Removes ``conn`` subscription to ``mask``. Returns the list of known
+        event names that (connection, mask) pair was matching.
+        """
+        entry = self.masks.get(mask)
+        if not entry or conn not in entry.subscribers:
+            return []
+
+        entry.subscribers.remove(conn)
+        names = list(entry.names)
+        for name in names:
+            route = self.routes[name]
+            route[conn] -= 1
+            if route[conn] == 0:
+                del route[conn]
+
+            # Nobody listens anymore and it is not a registered event type
+            if not route and name not in self.registered:
+                self.__remove_route(name)
+
+        if not entry.subscribers:
+            if entry.is_pattern:
+                self.__unindex_mask(entry)
+
+            del self.masks[mask]
+
+        return names
+
+    def route(self, name):
+        route = self.routes.get(name)
+        if route is None:
+            route = self.__add_route(name)
+
+        return list(route)
+
+    def refcount(self, name):
+        route = self.routes.get(name)
+        return sum(route.values()) if route else 0
@@ -61,6 +61,9 @@ class ManagementService(RpcService):
     def get_event_sources(self):
         return list(self.dispatcher.event_sources.keys())
 
+    def get_call_stats(self):
+        return self.context.get_call_stats()
+
     def get_connected_clients(self):
         return [
             inner
@@ -141,6 +144,9 @@ class EventService(RpcService):
     def get_my_subscriptions(self, sender):
         return list(sender.event_masks)
 
+    def get_journal_stats(self):
+        return self.__dispatcher.event_journal.get_stats()
+
     @private
     def suspend(self):
         self.__dispatcher.event_delivery_lock.acquire()
@@ -300,12 +306,39 @@ class TaskService(RpcService):
 
         return t
 
+    def get_output(self, id, offset=0, limit=None):
+        """
+        Returns task output chunks starting at chunk number ``offset``
+        along with the offset to continue from. New chunks of running
+        tasks are also delivered as task.output events.
+        """
+        task = self.__balancer.get_task(id)
+        if task:
+            task.flush_output()
+
+        chunks = self.__datastore.query(
+            'tasks.output',
+            ('task_id', '=', id),
+            ('seq', '>=', offset),
+            sort='seq',
+            limit=limit
+        )
+
+        return {
+            'data': ''.join(c['data'] for c in chunks),
+            'next': offset + len(chunks)
+        }
+
     def wait(self, id):
         task = self.__balancer.get_task(id)
         if task:
             task.ended.wait()
             return
 
+        # Finished tasks are evicted from memory after a while
+        if self.__datastore.exists('tasks', ('id', '=', id)):
+            return
+
         raise RpcException(errno.ENOENT, 'No such task')
 
     def abort(self, id):
@@ -327,7 +360,10 @@ class TaskService(RpcService):
             result.append({
                 'index': exe.index,
                 'state': exe.state,
-                'pid': exe.pid
+                'pid': exe.pid,
+                'spawn_latency': exe.spawn_latency,
+                'tasks_count': exe.tasks_count,
+                'utilization': exe.utilization
             })
 
         return result
@@ -360,6 +396,15 @@ class TaskService(RpcService):
 
         executor.put_status(status)
 
+    @private
+    @pass_sender
+    def put_progress(self, status, sender):
+        executor = self.__balancer.get_executor_by_sender(sender)
+        if not executor:
+            raise RpcException(errno.EPERM, 'Not authorized')
+
+        executor.put_progress(status)
+
     @private
     @pass_sender
     def run_hook(self, hook, args, sender):
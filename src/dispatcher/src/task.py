@@ -28,7 +28,6 @@
 import errno
 import logging
 from freenas.dispatcher.rpc import RpcService, RpcException
-from datastore.config import ConfigStore
 import collections
 
 
@@ -47,7 +46,7 @@ class Task(object):
     def __init__(self, dispatcher, datastore):
         self.dispatcher = dispatcher
         self.datastore = datastore
-        self.configstore = ConfigStore(datastore)
+        self.configstore = dispatcher.configstore
         self.logger = logging.getLogger(self.__class__.__name__)
 
     @classmethod
@@ -61,6 +60,12 @@ class Task(object):
     def get_status(self):
         return TaskStatus(50, 'Executing...')
 
+    def push_status(self):
+        # Only available when running inside of a task executor
+        put_progress = getattr(self.dispatcher, 'put_progress', None)
+        if put_progress:
+            put_progress(self.get_status())
+
     def verify_subtask(self, classname, *args):
         return self.dispatcher.verify_subtask(self, classname, args)
 
@@ -88,6 +93,8 @@ class ProgressTask(Task):
         if message:
             self.message = message
 
+        self.push_status()
+
 
 class TaskException(RpcException):
     pass
@@ -27,20 +27,25 @@
 
 
 import os
+import re
 import sys
 import errno
 import imp
 import setproctitle
 import socket
 import traceback
+import time
 import logging
 import queue
-from threading import Event
+from threading import Event, Lock, Thread
 from freenas.dispatcher.client import Client, ClientType
 from freenas.dispatcher.rpc import RpcService, RpcException
 from datastore import get_default_datastore
 from datastore.config import ConfigStore
-from task import TaskException
+from task import Task, ProgressTask, TaskException
+
+
+PROGRESS_INTERVAL = 0.5
 
 
 def serialize_error(err):
@@ -62,8 +67,9 @@ def serialize_error(err):
 
 
 class DispatcherWrapper(object):
-    def __init__(self, dispatcher):
-        self.dispatcher = dispatcher
+    def __init__(self, context):
+        self.context = context
+        self.dispatcher = context.conn
 
     def __run_hook(self, name, args):
         return self.dispatcher.call_sync('task.run_hook', name, args, timeout=300)
@@ -93,6 +99,12 @@ class DispatcherWrapper(object):
         if item == 'join_subtasks':
             return self.__join_subtasks
 
+        if item == 'put_progress':
+            return self.context.put_progress
+
+        if item == 'configstore':
+            return self.context.configstore
+
         return getattr(self.dispatcher, item)
 
 
@@ -126,6 +138,11 @@ class Context(object):
         self.conn = None
         self.instance = None
         self.running = Event()
+        self.progress_lock = Lock()
+        self.progress_event = Event()
+        self.pending_progress = None
+        self.last_progress = None
+        self.modules = {}
 
     def put_status(self, state, result=None, exception=None):
         obj = {
@@ -139,8 +156,63 @@ class Context(object):
         if exception:
             obj['error'] = serialize_error(exception)
 
+        with self.progress_lock:
+            self.pending_progress = None
+            self.last_progress = None
+
         self.conn.call_sync('task.put_status', obj)
 
+    def put_progress(self, status):
+        status = status.__getstate__()
+        with self.progress_lock:
+            if status == self.last_progress:
+                return
+
+            self.pending_progress = status
+            self.last_progress = status
+            self.progress_event.set()
+
+    def progress_worker(self):
+        # Sends at most one update per PROGRESS_INTERVAL, newer updates replace pending ones
+        while True:
+            self.progress_event.wait()
+            with self.progress_lock:
+                self.progress_event.clear()
+                status, self.pending_progress = self.pending_progress, None
+
+            if status:
+                try:
+                    self.conn.call_sync('task.put_progress', status)
+                except RpcException as err:
+                    print("Cannot send task progress: {0}".format(str(err)), file=sys.stderr)
+
+            time.sleep(PROGRESS_INTERVAL)
+
+    def load_module(self, filename):
+        # Plugin modules are cached until their source file changes
+        mtime = os.stat(filename).st_mtime
+        cached = self.modules.get(filename)
+        if cached and cached[0] == mtime:
+            return cached[1]
+
+        name = 'plugin_{0}'.format(re.sub(r'\W', '_', filename))
+        module = imp.load_source(name, filename)
+        self.modules[filename] = (mtime, module)
+        return module
+
+    def on_config_set(self, keys):
+        self.conn.emit_event('config.changed', {
+            'keys': keys,
+            'pid': os.getpid(),
+            'nolog': True
+        })
+
+    def on_config_changed(self, args):
+        if args.get('pid') == os.getpid():
+            return
+
+        self.configstore.invalidate(args['keys'])
+
     def main(self):
         if len(sys.argv) != 2:
             print("Invalid number of arguments", file=sys.stderr)
@@ -150,15 +222,26 @@ class Context(object):
         logging.basicConfig(level=logging.DEBUG)
 
         self.datastore = get_default_datastore()
-        self.configstore = ConfigStore(self.datastore)
+        self.configstore = ConfigStore(self.datastore, cached=True, notify=self.on_config_set)
         self.conn = Client()
         self.conn.connect('unix:')
         self.conn.login_service('task.{0}'.format(os.getpid()))
+        self.conn.register_event_handler('config.changed', self.on_config_changed)
         self.conn.enable_server()
         self.conn.rpc.register_service_instance('taskproxy', self.service)
-        self.conn.call_sync('task.checkin', key)
+        preload = self.conn.call_sync('task.checkin', key)
+        Thread(target=self.progress_worker, daemon=True).start()
         setproctitle.setproctitle('task executor (idle)')
 
+        for filename in preload or []:
+            if not self.task.empty():
+                break
+
+            try:
+                self.load_module(filename)
+            except BaseException as err:
+                print("Cannot preload {0}: {1}".format(filename, str(err)), file=sys.stderr)
+
         while True:
             try:
                 task = self.task.get()
@@ -171,13 +254,18 @@ class Context(object):
                     host, port = task['debugger']
                     pydevd.settrace(host, port=port, stdoutToServer=True, stderrToServer=True)
 
-                module = imp.load_source('plugin', task['filename'])
+                module = self.load_module(task['filename'])
+                self.configstore.sync()
                 setproctitle.setproctitle('task executor (tid {0})'.format(task['id']))
 
                 try:
-                    self.instance = getattr(module, task['class'])(DispatcherWrapper(self.conn), self.datastore)
-                    self.instance.configstore = self.configstore
+                    self.instance = getattr(module, task['class'])(DispatcherWrapper(self), self.datastore)
                     self.running.set()
+
+                    # Status of such tasks changes only through set_progress(), so it can be pushed
+                    if type(self.instance).get_status in (Task.get_status, ProgressTask.get_status):
+                        self.instance.push_status()
+
                     result = self.instance.run(*task['args'])
                 except BaseException as err:
                     print("Task exception: {0}".format(str(err)), file=sys.stderr)
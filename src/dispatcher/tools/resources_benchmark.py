@@ -0,0 +1,86 @@
+#!/usr/local/bin/python3
+#+
+# Copyright 2015 iXsystems, Inc.
+# All rights reserved
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted providing that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR ``AS IS'' AND ANY EXPRESS OR
+# IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT,
+# STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING
+# IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+#####################################################################
+
+
+import os
+import sys
+import time
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+from resources import Resource, ResourceGraph
+
+
+def build_graph(disks, datasets):
+    graph = ResourceGraph()
+    graph.add_resources([(Resource('disk:{0}'.format(i)), None) for i in range(disks)])
+    graph.add_resource(Resource('zpool:tank'), ['disk:{0}'.format(i) for i in range(disks)])
+    graph.add_resources([(Resource('zfs:tank/ds{0}'.format(i)), ['zpool:tank']) for i in range(datasets)])
+    return graph
+
+
+def run(graph, datasets, iterations):
+    names = ['zfs:tank/ds{0}'.format(1 + i % (datasets - 1)) for i in range(iterations)]
+    start = time.time()
+    for name in names:
+        if graph.can_acquire(name, 'zpool:tank'):
+            raise AssertionError('zpool:tank should not be acquirable')
+
+        graph.acquire(name)
+        if graph.can_acquire('zpool:tank'):
+            raise AssertionError('zpool:tank should be busy')
+
+        graph.release(name)
+
+    return time.time() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure ResourceGraph acquire/release throughput')
+    parser.add_argument('--disks', type=int, default=8, help='Number of disk resources')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[100, 1000, 10000, 50000], help='Dataset counts')
+    parser.add_argument('--iterations', type=int, default=10000, help='Acquire/release cycles per size')
+    args = parser.parse_args()
+
+    for size in args.sizes:
+        start = time.time()
+        graph = build_graph(args.disks, size)
+        registered = time.time() - start
+
+        # Keep one dataset busy so that pool-level checks have to say no
+        graph.acquire('zfs:tank/ds0')
+        elapsed = run(graph, size, args.iterations)
+        print('{0:>8} datasets: registered in {1:.2f}s, {2:.0f} acquire/release cycles/sec'.format(
+            size,
+            registered,
+            args.iterations / elapsed
+        ))
+
+
+if __name__ == '__main__':
+    main()
@@ -32,6 +32,38 @@ import sys
 
 logger = logging.getLogger('activedirectory')
 
+DEFAULT_PAGE_SIZE = 500
+
+USER_ATTRIBUTES = [
+    'sAMAccountName',
+    'sAMAccountType',
+    'distinguishedName',
+    'userPrincipalName',
+    'displayName',
+    'objectGUID',
+    'objectSid',
+    'primaryGroupID',
+    'userAccountControl',
+    'uidNumber',
+    'gidNumber',
+    'homeDirectory',
+    'loginShell',
+    'memberOf',
+    'uSNChanged'
+]
+
+GROUP_ATTRIBUTES = [
+    'sAMAccountName',
+    'groupType',
+    'distinguishedName',
+    'cn',
+    'objectGUID',
+    'objectSid',
+    'gidNumber',
+    'member',
+    'uSNChanged'
+]
+
 #
 # domainFunctionality, forestFunctionality, domainControllerFunctionality
 #
@@ -72,12 +104,14 @@ GROUP_TYPE_SECURITY_ENABLED    = 0x80000000
 
 class ActiveDirectory(object):
     class ActiveDirectoryHandle(object):
-        def __init__(self, host, binddn, bindpw):
+        def __init__(self, host, binddn, bindpw, dchandle=None, gchandle=None):
             self.__host = host
             self.__binddn = binddn
             self.__bindpw = bindpw
-            self.__dchandle = self.get_dc_handle()
-            self.__gchandle = self.get_gc_handle()
+            self.__dchandle = dchandle or self.get_dc_handle()
+            self.__gchandle = gchandle or self.get_gc_handle()
+            self.rootDSE = None
+            self.sync_state = {}
 
         def get_connection_handle(self, host, port, binddn, bindpw):
             server = ldap3.Server(host, port=port, get_info=ldap3.ALL)
@@ -124,8 +158,8 @@ class ActiveDirectory(object):
     def get_directory_type(self):
         return "activedirectory"
 
-    def get_connection_handle(self, host, binddn, bindpw):
-        return self.ActiveDirectoryHandle(host, binddn, bindpw)
+    def get_connection_handle(self, host, binddn, bindpw, dchandle=None, gchandle=None):
+        return self.ActiveDirectoryHandle(host, binddn, bindpw, dchandle=dchandle, gchandle=gchandle)
 
     def get_ldap_servers(self, domain, site=None):
         dcs = []
@@ -259,7 +293,10 @@ class ActiveDirectory(object):
 
         return kpws
 
-    def get_rootDSE(self, handle):
+    def get_rootDSE(self, handle, refresh=False):
+        if handle.rootDSE and not refresh:
+            return handle.rootDSE
+
         dchandle = handle.dchandle
 
         dchandle.search('',
@@ -282,6 +319,7 @@ class ActiveDirectory(object):
         if not attributes:
             return None
 
+        handle.rootDSE = attributes
         return attributes
 
     def get_rootDN(self, handle):
@@ -326,6 +364,20 @@ class ActiveDirectory(object):
 
         return configurationDN
 
+    def get_highest_committed_usn(self, handle):
+        rootDSE = self.get_rootDSE(handle, refresh=True)
+        if not rootDSE:
+            return None
+
+        usn = rootDSE.get('highestCommittedUSN', None)
+        if not usn:
+            return None
+
+        usn = int(str(usn[0]).strip())
+        logger.debug("get_highest_committed_usn: usn = %d", usn)
+
+        return usn
+
     def get_forest_functionality(self, handle):
         rootDSE = self.get_rootDSE(handle)
         if not rootDSE:
@@ -636,60 +688,87 @@ class ActiveDirectory(object):
 
         return attributes
 
-    def get_users(self, handle, **kwargs):
+    def search(self, handle, baseDN, filter, attributes=None, page_size=DEFAULT_PAGE_SIZE):
+        """
+        Enumerate a subtree using the paged results control, yielding
+        entries one by one instead of buffering the whole response
+        """
         dchandle = handle.dchandle
+        logger.debug("search: filter = %s, page_size = %d", filter, page_size)
 
-        baseDN = self.get_baseDN(handle) 
-        filter = '(&(|(objectclass=user)(objectclass=person))(sAMAccountName=*))'
-        logger.debug("get_users: filter = %s", filter)
-
-        dchandle.search(
+        entries = dchandle.extend.standard.paged_search(
             baseDN,
             filter,
             search_scope=ldap3.SUBTREE,
-            attributes=ldap3.ALL_ATTRIBUTES
+            attributes=attributes or ldap3.ALL_ATTRIBUTES,
+            paged_size=page_size,
+            generator=True
         )
-         
-        users = []
-        if not dchandle.result:
-            return users
-
-        filter_func = lambda x: 'sAMAccountType' in x and \
-            (long(x['sAMAccountType']) != SAM_USER_OBJECT)
 
-        if 'filter' in kwargs and kwargs['filter']:
-            filter_func = kwargs['filter']
+        for result in entries:
+            if result.get('type') != 'searchResEntry':
+                continue
 
-        for result in dchandle.response:
             attributes = result.get('attributes', None)
-            if not attributes: 
+            if not attributes:
                 continue
 
+            attributes['dn'] = result.get('dn')
+            yield attributes
+
+    def iter_entries(self, handle, kind, search_filter, filter_func, **kwargs):
+        """
+        With incremental=True only entries whose uSNChanged is above the
+        highestCommittedUSN seen at the start of the previous complete
+        incremental pass of the same kind are returned. USNs are local to
+        a domain controller and deleted entries are not reported, so a
+        full pass is still needed from time to time.
+        """
+        incremental = kwargs.get('incremental', False)
+        since = handle.sync_state.get(kind) if incremental else None
+
+        # Taken before the search starts so nothing modified during the pass is missed
+        marker = self.get_highest_committed_usn(handle) if incremental else None
+        if since is not None:
+            search_filter = '(&{0}(uSNChanged>={1}))'.format(search_filter, since + 1)
+
+        entries = self.search(
+            handle,
+            kwargs.get('baseDN') or self.get_baseDN(handle),
+            search_filter,
+            attributes=kwargs.get('attributes'),
+            page_size=kwargs.get('page_size', DEFAULT_PAGE_SIZE)
+        )
+
+        for attributes in entries:
             if filter_func:
                 if filter_func(attributes):
                     continue
 
-            users.append(attributes)
- 
-        return users
-         
-    def get_groups(self, handle, **kwargs):
-        dchandle = handle.dchandle
+            yield attributes
 
-        baseDN = self.get_baseDN(handle) 
-        filter = '(&(objectclass=group)(sAMAccountName=*))'
-        logger.debug("get_groups: filter = %s", filter)
+        if incremental:
+            if marker is not None:
+                handle.sync_state[kind] = marker
+            else:
+                handle.sync_state.pop(kind, None)
 
-        dchandle.search(
-            baseDN,
-            filter,
-            search_scope=ldap3.SUBTREE,
-            attributes=ldap3.ALL_ATTRIBUTES
-        )
-         
-        groups = []
-        if not dchandle.result:
-            return groups
+    def iter_users(self, handle, **kwargs):
+        filter = '(&(|(objectclass=user)(objectclass=person))(sAMAccountName=*))'
+        logger.debug("iter_users: filter = %s", filter)
+
+        filter_func = lambda x: 'sAMAccountType' in x and \
+            (long(x['sAMAccountType']) != SAM_USER_OBJECT)
+
+        if 'filter' in kwargs and kwargs['filter']:
+            filter_func = kwargs['filter']
+
+        kwargs.setdefault('attributes', USER_ATTRIBUTES)
+        return self.iter_entries(handle, 'users', filter, filter_func, **kwargs)
+
+    def iter_groups(self, handle, **kwargs):
+        filter = '(&(objectclass=group)(sAMAccountName=*))'
+        logger.debug("iter_groups: filter = %s", filter)
 
         filter_func = lambda x: 'groupType' in x and \
             (long(x['groupType']) & GROUP_TYPE_BUILTIN_LOCAL_GROUP)
@@ -697,18 +776,14 @@ class ActiveDirectory(object):
         if 'filter' in kwargs and kwargs['filter']:
             filter_func = kwargs['filter']
 
-        for result in dchandle.response:
-            attributes = result.get('attributes', None)
-            if not attributes: 
-                continue
-
-            if filter_func:
-                if filter_func(attributes):
-                    continue
+        kwargs.setdefault('attributes', GROUP_ATTRIBUTES)
+        return self.iter_entries(handle, 'groups', filter, filter_func, **kwargs)
 
-            groups.append(attributes)
+    def get_users(self, handle, **kwargs):
+        return list(self.iter_users(handle, **kwargs))
 
-        return groups
+    def get_groups(self, handle, **kwargs):
+        return list(self.iter_groups(handle, **kwargs))
 
     def get_user(self, handle, user):
         dchandle = handle.dchandle
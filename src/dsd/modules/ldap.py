@@ -29,16 +29,68 @@
 import ldap3
 import logging
 import sys
+import datetime
 
 logger = logging.getLogger('ldap')
 
+DEFAULT_PAGE_SIZE = 500
+SYNC_OVERLAP = 300
+GENERALIZED_TIME_FORMAT = '%Y%m%d%H%M%SZ'
+
+USER_ATTRIBUTES = [
+    'uid',
+    'uidNumber',
+    'gidNumber',
+    'cn',
+    'gecos',
+    'displayName',
+    'homeDirectory',
+    'loginShell',
+    'mail',
+    'memberOf',
+    'entryUUID',
+    'modifyTimestamp'
+]
+
+GROUP_ATTRIBUTES = [
+    'cn',
+    'gidNumber',
+    'memberUid',
+    'member',
+    'uniqueMember',
+    'entryUUID',
+    'modifyTimestamp'
+]
+
+
+def parse_generalized_time(value):
+    if isinstance(value, (list, tuple)):
+        value = value[0] if value else None
+
+    if isinstance(value, datetime.datetime):
+        if value.tzinfo:
+            value = value.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+
+        return value
+
+    if not value:
+        return None
+
+    try:
+        return datetime.datetime.strptime(str(value)[:14], GENERALIZED_TIME_FORMAT[:-1])
+    except ValueError:
+        return None
+
+
 class LDAP(object):
     class LDAPHandle(object):
-        def __init__(self, host, binddn, bindpw):
+        def __init__(self, host, binddn, bindpw, connection=None):
             self.__host = host
             self.__binddn = binddn
             self.__bindpw = bindpw
-            self.__ldap_handle = self.get_ldap_handle()
+            self.__ldap_handle = connection or self.get_ldap_handle()
+            self.rootDSE = None
+            self.sync_state = {}
 
         def get_connection_handle(self, host, port, binddn, bindpw):
             server = ldap3.Server(host, port=port, get_info=ldap3.ALL)
@@ -73,8 +125,8 @@ class LDAP(object):
     def get_directory_type(self):
         return "ldap"
 
-    def get_connection_handle(self, host, binddn, bindpw):
-        return self.LDAPHandle(host, binddn, bindpw)
+    def get_connection_handle(self, host, binddn, bindpw, connection=None):
+        return self.LDAPHandle(host, binddn, bindpw, connection=connection)
 
     def get_ldap_servers(self, domain):
         ldap_servers = []
@@ -91,7 +143,10 @@ class LDAP(object):
 
         return ldap_servers
 
-    def get_rootDSE(self, handle):
+    def get_rootDSE(self, handle, refresh=False):
+        if handle.rootDSE and not refresh:
+            return handle.rootDSE
+
         ldap_handle = handle.ldap_handle
 
         ldap_handle.search('',
@@ -114,6 +169,7 @@ class LDAP(object):
         if not attributes:
             return None
 
+        handle.rootDSE = attributes
         return attributes
 
     def get_baseDN(self, handle):
@@ -130,81 +186,107 @@ class LDAP(object):
 
         return baseDN
 
-    def get_users(self, handle, **kwargs):
+    def search(self, handle, baseDN, filter, attributes=None, page_size=DEFAULT_PAGE_SIZE):
+        """
+        Enumerate a subtree using the paged results control, yielding
+        entries one by one instead of buffering the whole response
+        """
         ldap_handle = handle.ldap_handle
+        logger.debug("search: filter = %s, page_size = %d", filter, page_size)
 
-        baseDN = self.get_baseDN(handle)
-        filter = '(&(|(objectclass=person)' \
-            '(objectclass=posixaccount)' \
-            '(objectclass=account))(uid=*))'
-        logger.debug("get_users: filter = %s", filter)
-
-        ldap_handle.search(
+        entries = ldap_handle.extend.standard.paged_search(
             baseDN,
             filter,
             search_scope=ldap3.SUBTREE,
-            attributes=ldap3.ALL_ATTRIBUTES
+            attributes=attributes or ldap3.ALL_ATTRIBUTES,
+            paged_size=page_size,
+            generator=True
         )
 
-        users = []
-        if not ldap_handle.result:
-            return users
-
-        filter_func = None
-        if 'filter' in kwargs and kwargs['filter']:
-            filter_func = kwargs['filter']
+        for result in entries:
+            if result.get('type') != 'searchResEntry':
+                continue
 
-        for result in ldap_handle.response:
             attributes = result.get('attributes', None)
             if not attributes:
                 continue
 
             attributes['dn'] = result.get('dn')
+            yield attributes
+
+    def iter_entries(self, handle, kind, search_filter, **kwargs):
+        """
+        With incremental=True only entries whose modifyTimestamp is not
+        older than the highest one seen in the previous complete
+        incremental pass of the same kind, minus SYNC_OVERLAP seconds,
+        are returned. Deleted entries are not reported, so a full pass is
+        still needed from time to time.
+        """
+        filter_func = kwargs.get('filter')
+        incremental = kwargs.get('incremental', False)
+        since = handle.sync_state.get(kind) if incremental else None
+        attributes = kwargs.get('attributes')
+
+        if since:
+            search_filter = '(&{0}(modifyTimestamp>={1}))'.format(search_filter, since)
+
+        # Marker is derived from the server's own timestamps, so the
+        # clock of this host doesn't matter
+        if incremental:
+            attributes = list(attributes or [ldap3.ALL_ATTRIBUTES])
+            if 'modifyTimestamp' not in attributes:
+                attributes.append('modifyTimestamp')
+
+        entries = self.search(
+            handle,
+            kwargs.get('baseDN') or self.get_baseDN(handle),
+            search_filter,
+            attributes=attributes,
+            page_size=kwargs.get('page_size', DEFAULT_PAGE_SIZE)
+        )
+
+        highest = None
+        for attributes in entries:
+            if incremental:
+                modified = parse_generalized_time(attributes.get('modifyTimestamp'))
+                if modified and (not highest or modified > highest):
+                    highest = modified
+
             if filter_func:
                 if filter_func(attributes):
                     continue
 
-            users.append(attributes)
+            yield attributes
 
-        return users
+        if incremental and highest:
+            # Entries modified within the same pass may carry an older
+            # timestamp than the highest one seen, hence the overlap
+            marker = highest - datetime.timedelta(seconds=SYNC_OVERLAP)
+            handle.sync_state[kind] = marker.strftime(GENERALIZED_TIME_FORMAT)
 
-    def get_groups(self, handle, **kwargs):
-        ldap_handle = handle.ldap_handle
+    def iter_users(self, handle, **kwargs):
+        filter = '(&(|(objectclass=person)' \
+            '(objectclass=posixaccount)' \
+            '(objectclass=account))(uid=*))'
+        logger.debug("iter_users: filter = %s", filter)
 
-        baseDN = self.get_baseDN(handle)
+        kwargs.setdefault('attributes', USER_ATTRIBUTES)
+        return self.iter_entries(handle, 'users', filter, **kwargs)
+
+    def iter_groups(self, handle, **kwargs):
         filter = '(&(|(objectclass=posixgroup)' \
             '(objectclass=group))' \
             '(gidnumber=*))'
-        logger.debug("get_groups: filter = %s", filter)
-
-        ldap_handle.search(
-            baseDN,
-            filter,
-            search_scope=ldap3.SUBTREE,
-            attributes=ldap3.ALL_ATTRIBUTES
-        )
-
-        groups = []
-        if not ldap_handle.result:
-            return groups
+        logger.debug("iter_groups: filter = %s", filter)
 
-        filter_func = None
-        if 'filter' in kwargs and kwargs['filter']:
-            filter_func = kwargs['filter']
+        kwargs.setdefault('attributes', GROUP_ATTRIBUTES)
+        return self.iter_entries(handle, 'groups', filter, **kwargs)
 
-        for result in ldap_handle.response:
-            attributes = result.get('attributes', None)
-            if not attributes:
-                continue
-
-            attributes['dn'] = result.get('dn')
-            if filter_func:
-                if filter_func(attributes):
-                    continue
-
-            groups.append(attributes)
+    def get_users(self, handle, **kwargs):
+        return list(self.iter_users(handle, **kwargs))
 
-        return groups
+    def get_groups(self, handle, **kwargs):
+        return list(self.iter_groups(handle, **kwargs))
 
     def get_user(self, handle, user):
         ldap_handle = handle.ldap_handle
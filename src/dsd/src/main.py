@@ -602,7 +602,16 @@ class Main(object):
             self.logger.error('Cannot initialize datastore: %s', str(err))
             sys.exit(1)
 
-        self.configstore = ConfigStore(self.datastore)
+        self.configstore = ConfigStore(self.datastore, notify=self.on_config_set)
+
+    def on_config_set(self, keys):
+        # Let cached config stores in other processes know
+        if self.client:
+            self.client.emit_event('config.changed', {
+                'keys': keys,
+                'pid': os.getpid(),
+                'nolog': True
+            })
 
     def connect(self, resume=False):
         while True:  
@@ -0,0 +1,163 @@
+#!/usr/local/bin/python
+#
+# Copyright 2015 iXsystems, Inc.
+# All rights reserved
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted providing that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR ``AS IS'' AND ANY EXPRESS OR
+# IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT,
+# STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING
+# IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+
+import os
+import sys
+import unittest
+import ldap3
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'modules'))
+
+from ldap import LDAP
+from activedirectory import ActiveDirectory
+
+__doc__ = """ Directory enumeration tests, run against ldap3's mock strategy
+so no directory server is needed:
+
+    python test_enumeration.py -v
+
+"""
+
+BASE_DN = 'dc=example,dc=org'
+ENTRY_COUNT = 1200
+
+
+def create_connection():
+    server = ldap3.Server('mock')
+    conn = ldap3.Connection(server, user='cn=admin,' + BASE_DN, password='secret', client_strategy=ldap3.MOCK_SYNC)
+    conn.strategy.add_entry('cn=admin,' + BASE_DN, {'userPassword': 'secret', 'sn': 'admin'})
+    conn.bind()
+    return conn
+
+
+class LDAPEnumerationTest(unittest.TestCase):
+    def setUp(self):
+        self.conn = create_connection()
+        for i in range(ENTRY_COUNT):
+            self.conn.strategy.add_entry('uid=user{0},ou=people,{1}'.format(i, BASE_DN), {
+                'objectClass': ['person', 'posixAccount'],
+                'uid': 'user{0}'.format(i),
+                'uidNumber': 1000 + i,
+                'cn': 'User {0}'.format(i),
+                'description': 'not projected',
+                'modifyTimestamp': '20200101000000Z'
+            })
+
+        # Constructor resolves DNS helpers which aren't needed here
+        self.ldap = LDAP.__new__(LDAP)
+        self.handle = self.ldap.get_connection_handle('mock', None, None, connection=self.conn)
+        self.handle.rootDSE = {'defaultNamingContext': [BASE_DN]}
+
+    def touch(self, i, timestamp):
+        self.conn.modify('uid=user{0},ou=people,{1}'.format(i, BASE_DN), {
+            'modifyTimestamp': [(ldap3.MODIFY_REPLACE, [timestamp])]
+        })
+
+    def test_paged_enumeration(self):
+        users = self.ldap.get_users(self.handle, page_size=100)
+        self.assertEqual(len(users), ENTRY_COUNT)
+        self.assertEqual(
+            sorted(u['uid'][0] for u in users),
+            sorted('user{0}'.format(i) for i in range(ENTRY_COUNT))
+        )
+
+    def test_attribute_projection(self):
+        users = self.ldap.get_users(self.handle, attributes=['uid', 'uidNumber'])
+        for u in users:
+            self.assertNotIn('description', u)
+            self.assertNotIn('cn', u)
+            self.assertIn('uid', u)
+            self.assertIn('dn', u)
+
+    def test_filter(self):
+        users = self.ldap.get_users(self.handle, filter=lambda x: x['uid'][0] != 'user7')
+        self.assertEqual([u['uid'][0] for u in users], ['user7'])
+
+    def test_incremental(self):
+        users = self.ldap.get_users(self.handle, incremental=True, attributes=['uid'])
+        self.assertEqual(len(users), ENTRY_COUNT)
+        self.assertIn('modifyTimestamp', users[0])
+        self.assertEqual(self.handle.sync_state['users'], '20191231235500Z')
+
+        self.touch(5, '20200102000000Z')
+        users = self.ldap.get_users(self.handle, incremental=True)
+        self.assertEqual(len(users), ENTRY_COUNT)
+        self.assertEqual(self.handle.sync_state['users'], '20200101235500Z')
+
+        # Marker comes from the server's timestamps with a safety overlap,
+        # so entries stamped slightly behind the highest one are returned too
+        self.touch(3, '20200101235800Z')
+        users = self.ldap.get_users(self.handle, incremental=True)
+        self.assertEqual(sorted(u['uid'][0] for u in users), ['user3', 'user5'])
+        self.assertEqual(self.handle.sync_state['users'], '20200101235500Z')
+
+        # Non-incremental pass neither uses nor updates the marker
+        self.assertEqual(len(self.ldap.get_users(self.handle)), ENTRY_COUNT)
+        self.assertEqual(self.handle.sync_state['users'], '20200101235500Z')
+
+
+class ActiveDirectoryEnumerationTest(unittest.TestCase):
+    def setUp(self):
+        self.conn = create_connection()
+        for i in range(ENTRY_COUNT):
+            self.conn.strategy.add_entry('cn=user{0},cn=Users,{1}'.format(i, BASE_DN), {
+                'objectClass': ['person', 'user'],
+                'sAMAccountName': 'user{0}'.format(i),
+                'uSNChanged': 100 + i,
+                'description': 'not projected'
+            })
+
+        self.ad = ActiveDirectory.__new__(ActiveDirectory)
+        self.ad.get_highest_committed_usn = lambda handle: self.usn
+        self.handle = self.ad.get_connection_handle('mock', None, None, dchandle=self.conn, gchandle=self.conn)
+        self.handle.rootDSE = {'defaultNamingContext': [BASE_DN]}
+        self.usn = 100 + ENTRY_COUNT - 1
+
+    def get_users(self, **kwargs):
+        return self.ad.get_users(self.handle, filter=lambda x: False, **kwargs)
+
+    def test_paged_enumeration(self):
+        users = self.get_users(page_size=100, attributes=['sAMAccountName'])
+        self.assertEqual(len(users), ENTRY_COUNT)
+        self.assertNotIn('description', users[0])
+
+    def test_incremental(self):
+        self.assertEqual(len(self.get_users(incremental=True)), ENTRY_COUNT)
+        self.assertEqual(self.handle.sync_state['users'], self.usn)
+
+        self.usn += 1
+        self.conn.modify('cn=user42,cn=Users,{0}'.format(BASE_DN), {
+            'uSNChanged': [(ldap3.MODIFY_REPLACE, [self.usn])]
+        })
+
+        users = self.get_users(incremental=True)
+        self.assertEqual([u['sAMAccountName'][0] for u in users], ['user42'])
+        self.assertEqual(self.get_users(incremental=True), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -36,8 +36,12 @@ import errno
 import datastore
 import time
 import imp
+import hashlib
+import threading
+import collections
 import setproctitle
 import renderers
+from concurrent.futures import ThreadPoolExecutor
 from datastore.config import ConfigStore
 from freenas.dispatcher.client import Client, ClientError
 from freenas.dispatcher.rpc import RpcService, RpcException
@@ -46,6 +50,7 @@ from freenas.utils.debug import DebugService
 
 
 DEFAULT_CONFIGFILE = '/usr/local/etc/middleware.conf'
+DEFAULT_WORKERS = 8
 TEMPLATE_RENDERERS = {
     '.mako': renderers.MakoTemplateRenderer,
     '.py': renderers.PythonRenderer,
@@ -69,65 +74,131 @@ class FileGenerationService(RpcService):
         self.context = ctx
         self.datastore = ctx.datastore
 
+    def __resolve(self, names):
+        # Flattens requested groups into an ordered list of unique targets.
+        # Every target is generated only once per request, even if it's
+        # referenced from several (nested) groups.
+        groups = {g['name']: g for g in self.datastore.query('etcd.groups')}
+        visited = set()
+        targets = collections.OrderedDict()
+
+        def walk(name):
+            if name in visited:
+                return
+
+            group = groups.get(name)
+            if not group:
+                raise RpcException(errno.ENOENT, 'Group {0} not found'.format(name))
+
+            visited.add(name)
+            for i in group['dependencies']:
+                typ, fname = i.split(':')
+                if typ == 'group':
+                    walk(fname)
+                    continue
+
+                targets.setdefault((typ, fname), None)
+
+        for i in names:
+            walk(i)
+
+        return list(targets.keys())
+
+    def __timed(self, fn, name):
+        started_at = time.time()
+        try:
+            return fn(name)
+        finally:
+            self.context.record_timing(name, time.time() - started_at)
+
+    def __execute(self, targets):
+        # Files have no dependencies between each other and are rendered
+        # concurrently. Plugins (which may post-process previously generated
+        # files, eg. by running pwd_mkdb) act as barriers: they run after
+        # all preceding targets have finished and before any following one.
+        changed = []
+        stage = []
+
+        def flush_stage():
+            futures = [(i, self.context.executor.submit(self.__timed, self.__generate_file, i)) for i in stage]
+            changed.extend(i for i, f in futures if f.result())
+            del stage[:]
+
+        for typ, name in targets:
+            if typ == 'file':
+                stage.append(name)
+                continue
+
+            flush_stage()
+            if typ == 'plugin' and self.__timed(self.generate_plugin, name):
+                changed.append(name)
+
+        flush_stage()
+        return changed
+
     def generate_all(self):
-        for group in self.datastore.query('etcd.groups'):
-            self.generate_group(group['name'])
+        self.context.configstore.sync()
+        return self.__execute(self.__resolve(self.get_groups()))
 
     def generate_file(self, filename):
+        self.context.configstore.sync()
+        return self.__generate_file(filename)
+
+    def __generate_file(self, filename):
         if filename not in self.context.managed_files.keys():
-            return
+            return False
 
-        text = self.context.generate_file(filename)
         filepath = os.path.join(self.context.root, filename)
-        try:
-            with open(filepath, 'w') as fd:
-                fd.write(text)
-        except FileNotFoundError as e:
-            self.context.logger.error('Failed to open {0}: {1}'.format(filepath, e), exc_info=True)
-            return
+        with self.context.get_file_lock(filename):
+            text = self.context.generate_file(filename)
+            try:
+                if not self.context.write_file(filepath, text):
+                    return False
+            except OSError as e:
+                self.context.logger.error('Failed to write {0}: {1}'.format(filepath, e), exc_info=True)
+                return False
 
         self.context.emit_event('etcd.file_generated', {
             'filename': filepath,
         })
 
+        return True
+
     def generate_plugin(self, name):
         if name not in self.context.managed_files.keys():
-            return
+            return False
 
         try:
             pname = os.path.basename(name)
             plugin = imp.load_source(pname, self.context.managed_files[name])
         except:
             self.context.logger.error('Invalid plugin source file: {0}'.format(name), exc_info=True)
-            return
+            return False
 
         if not hasattr(plugin, 'run'):
             self.context.logger.error('Invalid plugin source {0}, no run method'.format(pname))
-            return
+            return False
 
         try:
             plugin.run(self.context)
         except Exception as err:
             self.context.logger.error('Cannot run plugin {0}: {1}'.format(name, str(err)), exc_info=True)
+            return False
 
-    def generate_group(self, name):
-        group = self.datastore.get_one('etcd.groups', ('name', '=', name))
-        if not group:
-            raise RpcException(errno.ENOENT, 'Group {0} not found'.format(name))
-
-        for i in group['dependencies']:
-            typ, fname = i.split(':')
+        # Plugins write files on their own, so assume something has changed
+        return True
 
-            if typ == 'file':
-                self.generate_file(fname)
-            elif typ == 'plugin':
-                self.generate_plugin(fname)
-            elif typ == 'group':
-                self.generate_group(fname)
+    def generate_group(self, name):
+        # config.changed may still be on its way, pick up any recent writes
+        self.context.configstore.sync()
+        return self.__execute(self.__resolve([name]))
 
     def get_managed_files(self):
         return self.context.managed_files
 
+    def get_timings(self):
+        return self.context.timings
+
     def get_groups(self):
         return [g['name'] for g in self.datastore.query('etcd.groups')]
 
@@ -143,6 +214,10 @@ class Main(object):
         self.plugin_dirs = []
         self.renderers = {}
         self.managed_files = {}
+        self.executor = None
+        self.timings = {}
+        self.timings_lock = threading.Lock()
+        self.file_locks = collections.defaultdict(threading.Lock)
 
     def init_datastore(self):
         try:
@@ -151,23 +226,27 @@ class Main(object):
             self.logger.error('Cannot initialize datastore: %s', str(err))
             sys.exit(1)
 
-        self.configstore = ConfigStore(self.datastore)
+        self.configstore = ConfigStore(self.datastore, cached=True)
 
     def init_dispatcher(self):
         def on_error(reason, **kwargs):
             if reason in (ClientError.CONNECTION_CLOSED, ClientError.LOGOUT):
                 self.logger.warning('Connection to dispatcher lost')
                 self.connect()
+                # Config changes might have been missed while disconnected
+                self.configstore.reload()
 
         self.client = Client()
         self.client.on_error(on_error)
         self.connect()
+        self.client.register_event_handler('config.changed', self.on_config_changed)
 
     def connect(self):
         while True:
             try:
                 self.client.connect('127.0.0.1')
                 self.client.login_service('etcd')
+                self.client.subscribe_events('config.changed')
                 self.client.enable_server()
                 self.client.register_service('etcd.generation', FileGenerationService(self))
                 self.client.register_service('etcd.management', ManagementService(self))
@@ -180,6 +259,9 @@ class Main(object):
                 self.logger.warning('Cannot connect to dispatcher: {0}, retrying in 1 second'.format(str(err)))
                 time.sleep(1)
 
+    def on_config_changed(self, args):
+        self.configstore.invalidate(args['keys'])
+
     def init_renderers(self):
         for name, impl in TEMPLATE_RENDERERS.items():
             self.renderers[name] = impl(self)
@@ -197,6 +279,7 @@ class Main(object):
             sys.exit(1)
 
         self.plugin_dirs = self.config['etcd']['plugin-dirs']
+        self.executor = ThreadPoolExecutor(max_workers=self.config['etcd'].get('workers', DEFAULT_WORKERS))
 
     def scan_plugins(self):
         for i in self.plugin_dirs:
@@ -233,6 +316,60 @@ class Main(object):
             self.logger.warn('Cannot generate file {0}: {1}'.format(file_path, str(e)))
             return "# FILE GENERATION FAILED: {0}\n".format(str(e))
 
+    def get_file_lock(self, name):
+        with self.timings_lock:
+            return self.file_locks[name]
+
+    def record_timing(self, name, duration):
+        with self.timings_lock:
+            item = self.timings.setdefault(name, {'count': 0, 'total': 0, 'last': None, 'max': 0})
+            item['count'] += 1
+            item['total'] += duration
+            item['last'] = duration
+            item['max'] = max(item['max'], duration)
+
+        self.logger.debug('Generated {0} in {1:.3f}s'.format(name, duration))
+
+    def write_file(self, filepath, text):
+        # Returns True if file contents were actually changed. New contents
+        # are written to a temporary file first and then renamed over the
+        # original one, so readers never see partially written file.
+        data = text.encode('utf-8')
+        try:
+            with open(filepath, 'rb') as fd:
+                if hashlib.sha256(fd.read()).digest() == hashlib.sha256(data).digest():
+                    return False
+        except FileNotFoundError:
+            pass
+
+        try:
+            st = os.stat(filepath)
+        except FileNotFoundError:
+            st = None
+
+        tmppath = '{0}.{1}.{2}.tmp'.format(filepath, os.getpid(), threading.get_ident())
+        fd = os.open(tmppath, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o666)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+
+            if st:
+                os.chmod(tmppath, st.st_mode & 0o7777)
+                os.chown(tmppath, st.st_uid, st.st_gid)
+
+            os.rename(tmppath, filepath)
+        except OSError:
+            try:
+                os.unlink(tmppath)
+            except OSError:
+                pass
+
+            raise
+
+        return True
+
     def emit_event(self, name, params):
         self.client.emit_event(name, params)
 
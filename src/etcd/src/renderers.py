@@ -25,7 +25,7 @@
 #
 #####################################################################
 
-
+import os
 from mako import exceptions
 from mako.template import Template
 from datastore.config import ConfigStore
@@ -38,8 +38,32 @@ class TemplateFunctions:
 
 
 class MakoTemplateRenderer(object):
+    MODULE_DIRECTORY = '/var/tmp/etcd/mako'
+
     def __init__(self, context):
         self.context = context
+        self.templates = {}
+        self.module_directory = self.MODULE_DIRECTORY
+
+        try:
+            os.makedirs(self.module_directory, exist_ok=True)
+        except OSError as err:
+            self.context.logger.warning('Cannot create Mako module directory {0}: {1}'.format(
+                self.module_directory,
+                str(err)
+            ))
+            self.module_directory = None
+
+    def get_template(self, path):
+        # Compiled templates are reused as long as source file is not modified
+        mtime = os.stat(path).st_mtime
+        cached = self.templates.get(path)
+        if cached and cached[0] == mtime:
+            return cached[1]
+
+        tmpl = Template(filename=path, module_directory=self.module_directory)
+        self.templates[path] = (mtime, tmpl)
+        return tmpl
 
     def get_template_context(self):
         return {
@@ -51,7 +75,7 @@ class MakoTemplateRenderer(object):
 
     def render_template(self, path):
         try:
-            tmpl = Template(filename=path)
+            tmpl = self.get_template(path)
             return tmpl.render(**self.get_template_context())
         except:
             self.context.logger.debug('Failed to render mako template: {0}'.format(
@@ -59,6 +59,7 @@ from freenas.utils import configure_logging, to_timedelta
 
 DEFAULT_CONFIGFILE = '/usr/local/etc/middleware.conf'
 DEFAULT_DBFILE = 'stats.hdf'
+DEFAULT_FLUSH_INTERVAL = 30
 gevent.monkey.patch_all(thread=False)
 
 
@@ -171,6 +172,10 @@ class DataSource(object):
         mean = np.mean(list(zip(*data[-count:]))[1])
         buffer.push(timestamp, mean)
 
+    def flush(self):
+        for b in self.bucket_buffers[1:]:
+            b.flush()
+
     def query(self, start, end, frequency):
         self.logger.debug('Query: start={0}, end={1}, frequency={2}'.format(start, end, frequency))
         buckets = list(self.config.get_covered_buckets(start, end))
@@ -296,6 +301,8 @@ class Main(object):
         self.hdf = None
         self.hdf_group = None
         self.config = None
+        self.flush_interval = DEFAULT_FLUSH_INTERVAL
+        self.flush_thread = None
         self.logger = logging.getLogger('statd')
         self.data_sources = {}
 
@@ -311,6 +318,8 @@ class Main(object):
             self.logger.error('Config file has unreadable format (not valid JSON)')
             sys.exit(1)
 
+        self.flush_interval = self.config.get('fnstatd', {}).get('flush-interval', DEFAULT_FLUSH_INTERVAL)
+
     def init_datastore(self):
         try:
             self.datastore = get_datastore(self.config['datastore']['driver'], self.config['datastore']['dsn'])
@@ -343,6 +352,18 @@ class Main(object):
         except Exception as e:
             self.logger.error(str(e))
 
+    def flush(self):
+        for ds in list(self.data_sources.values()):
+            try:
+                ds.flush()
+            except Exception as e:
+                self.logger.error('Cannot flush data source {0}: {1}'.format(ds.name, str(e)))
+
+    def flush_worker(self):
+        while True:
+            gevent.sleep(self.flush_interval)
+            self.flush()
+
     def get_data_source(self, name):
         if name not in list(self.data_sources.keys()):
             config = DataSourceConfig(self.datastore, name)
@@ -384,6 +405,13 @@ class Main(object):
     def die(self):
         self.logger.warning('Exiting')
         self.server.stop()
+        if self.flush_thread:
+            gevent.kill(self.flush_thread)
+
+        if self.hdf:
+            self.flush()
+            self.hdf.close()
+
         self.client.disconnect()
         sys.exit(0)
 
@@ -408,6 +436,7 @@ class Main(object):
         self.init_dispatcher()
         self.init_database()
         self.server.start()
+        self.flush_thread = gevent.spawn(self.flush_worker)
         self.logger.info('Started')
         self.client.wait_forever()
 
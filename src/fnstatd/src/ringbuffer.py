@@ -83,40 +83,63 @@ class MemoryRingBuffer(object):
 
 
 class PersistentRingBuffer(object):
-    def __init__(self, table, size):
+    """
+    Ring buffer backed by a PyTables table.
+
+    Pushed points are kept in memory and written out by flush() in
+    contiguous chunks, followed by the head/tail attributes and a single
+    table flush. Data rows are always written before the metadata which
+    references them, so after a crash the table reflects the state of
+    the last completed flush: at most one flush interval worth of points
+    is lost. A crash in the middle of a flush may additionally leave up
+    to one batch of newer points in place of the oldest ones.
+    """
+    def __init__(self, table, size, max_pending=None):
         self.table = table
         self.size = size
+        self.max_pending = max_pending or size
+        self.pending = []
 
         if not hasattr(self.table.attrs, 'tail'):
             self.table.attrs.tail = 0
             self.table.attrs.head = 0
             self.fill_initial()
 
+        self.head = self.table.attrs.head
+        self.tail = self.table.attrs.tail
+        self.flushed_tail = self.tail
+
     @property
     def empty(self):
-        return self.table.attrs.head == self.table.attrs.tail
+        return self.head == self.tail
+
+    @property
+    def dirty(self):
+        return len(self.pending) > 0
 
     @property
     def used_count(self):
         if self.empty:
             return 0
 
-        if self.table.attrs.tail > self.table.attrs.head:
-            return self.table.attrs.tail - self.table.attrs.head - 1
+        if self.tail > self.head:
+            return self.tail - self.head - 1
 
-        if self.table.attrs.head > self.table.attrs.tail:
-            return (self.size - self.table.attrs.head) + self.table.attrs.tail - 1
+        if self.head > self.tail:
+            return (self.size - self.head) + self.tail - 1
 
     @property
     def data(self):
         if self.empty:
             return None
 
-        if self.table.attrs.tail > self.table.attrs.head:
-            return self.table[self.table.attrs.head:self.table.attrs.tail]
+        self.write_pending()
 
-        if self.table.attrs.head > self.table.attrs.tail:
-            return np.concatenate((self.table[self.table.attrs.head:], self.table[:self.table.attrs.tail]))
+        if self.tail > self.head:
+            return self.table[self.head:self.tail]
+
+        if self.head > self.tail:
+            return np.concatenate((self.table[self.head:], self.table[:self.tail]))
 
     @property
     def df(self):
@@ -130,12 +153,39 @@ class PersistentRingBuffer(object):
         self.table.flush()
 
     def push(self, timestamp, value):
-        self.table[self.table.attrs.tail] = (timestamp, value)
-        self.table.attrs.tail = (self.table.attrs.tail + 1) % self.size
-        if self.table.attrs.head == self.table.attrs.tail:
-            self.table.attrs.head = (self.table.attrs.head + 1) % self.size
+        self.pending.append((timestamp, value))
+        self.tail = (self.tail + 1) % self.size
+        if self.head == self.tail:
+            self.head = (self.head + 1) % self.size
+
+        if len(self.pending) >= self.max_pending:
+            self.write_pending()
+
+    def write_pending(self):
+        if not self.pending:
+            return
+
+        # Only the last "size" points can survive in the ring anyway
+        rows = self.pending[-self.size:]
+        start = (self.tail - len(rows)) % self.size
+        self.pending = []
+
+        # Split at the end of the table so that each chunk is contiguous
+        first = rows[:self.size - start]
+        self.table.modify_rows(start, start + len(first), rows=first)
+        if len(rows) > len(first):
+            rest = rows[len(first):]
+            self.table.modify_rows(0, len(rest), rows=rest)
+
+    def flush(self):
+        if not self.dirty and self.flushed_tail == self.tail:
+            return
 
+        self.write_pending()
+        self.table.attrs.head = self.head
+        self.table.attrs.tail = self.tail
         self.table.flush()
+        self.flushed_tail = self.tail
 
     def pop(self):
         pass
@@ -0,0 +1,89 @@
+#!/usr/local/bin/python3
+#+
+# Copyright 2015 iXsystems, Inc.
+# All rights reserved
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted providing that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR ``AS IS'' AND ANY EXPRESS OR
+# IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT,
+# STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING
+# IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+#####################################################################
+
+
+import os
+import sys
+import time
+import argparse
+import tempfile
+import tables
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+from ringbuffer import PersistentRingBuffer
+
+
+class DataPoint(tables.IsDescription):
+    timestamp = tables.Time32Col()
+    value = tables.FloatCol()
+
+
+def run(hdf, sources, samples, size, flush_every):
+    buffers = []
+    for i in range(sources):
+        table = hdf.create_table('/', 'ds{0}'.format(i), DataPoint)
+        buffers.append(PersistentRingBuffer(table, size))
+
+    start = time.time()
+    for n in range(samples):
+        for b in buffers:
+            b.push(n, float(n))
+
+        if (n + 1) % flush_every == 0:
+            for b in buffers:
+                b.flush()
+
+    for b in buffers:
+        b.flush()
+
+    return time.time() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure PersistentRingBuffer ingest rate')
+    parser.add_argument('--sources', type=int, default=100, help='Number of data sources')
+    parser.add_argument('--samples', type=int, default=1000, help='Samples pushed to each data source')
+    parser.add_argument('--size', type=int, default=720, help='Ring buffer size')
+    parser.add_argument('--flush-every', type=int, default=30, help='Flush after that many samples (1 = flush on every push)')
+    args = parser.parse_args()
+
+    fd, path = tempfile.mkstemp(suffix='.hdf')
+    os.close(fd)
+
+    try:
+        with tables.open_file(path, mode='w') as hdf:
+            elapsed = run(hdf, args.sources, args.samples, args.size, args.flush_every)
+    finally:
+        os.unlink(path)
+
+    total = args.sources * args.samples
+    print('{0} samples in {1:.2f}s: {2:.0f} samples/sec'.format(total, elapsed, total / elapsed))
+
+
+if __name__ == '__main__':
+    main()
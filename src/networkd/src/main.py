@@ -41,6 +41,7 @@ import netif
 import time
 import ipaddress
 import io
+from concurrent.futures import ThreadPoolExecutor
 from datastore import get_datastore, DatastoreException
 from datastore.config import ConfigStore
 from freenas.dispatcher.client import Client, ClientError
@@ -52,6 +53,8 @@ from functools import reduce
 
 
 DEFAULT_CONFIGFILE = '/usr/local/etc/middleware.conf'
+COALESCE_WINDOW = 0.2
+DEFAULT_WORKERS = 8
 
 
 def cidr_to_netmask(cidr):
@@ -128,14 +131,18 @@ def describe_route(route):
     return '{0}/{1} via {2}'.format(route.network, bits, route.gateway)
 
 
-def filter_routes(routes):
+def filter_routes(routes, interfaces=None):
     """
     Filter out routes for loopback addresses and local subnets
     :param routes: routes list
+    :param interfaces: interfaces snapshot, read from the kernel if not given
     :return: filtered routes list
     """
 
-    aliases = [i.addresses for i in list(netif.list_interfaces().values())]
+    if interfaces is None:
+        interfaces = netif.list_interfaces()
+
+    aliases = [i.addresses for i in list(interfaces.values())]
     aliases = reduce(lambda x, y: x+y, aliases)
     aliases = [a for a in aliases if a.af == netif.AddressFamily.INET]
     aliases = [ipaddress.ip_interface('{0}/{1}'.format(a.address, a.netmask)) for a in aliases]
@@ -161,21 +168,110 @@ def get_addresses(entity):
     return [ipaddress.ip_address(i['address']) for i in entity.get('aliases', [])]
 
 
+def interface_dependencies(entity):
+    deps = set()
+    if entity.get('type') == 'VLAN':
+        parent = (entity.get('vlan') or {}).get('parent')
+        if parent:
+            deps.add(parent)
+
+    if entity.get('type') == 'LAGG':
+        deps.update((entity.get('lagg') or {}).get('ports', []))
+
+    return deps
+
+
+def plan_interfaces(entities):
+    """
+    Split interface entities into waves. Interfaces within a wave do not depend
+    on each other and may be configured concurrently; each wave only depends
+    on the waves before it.
+    :param entities: interface entities
+    :return: list of waves
+    """
+
+    pending = {e['id']: e for e in entities}
+    waves = []
+
+    while pending:
+        wave = [e for e in pending.values() if not interface_dependencies(e) & set(pending)]
+        if not wave:
+            # Dependency cycle, just configure the rest one after another
+            waves.extend([e] for e in sorted(pending.values(), key=lambda e: e['id']))
+            break
+
+        for e in wave:
+            del pending[e['id']]
+
+        waves.append(sorted(wave, key=lambda e: e['id']))
+
+    return waves
+
+
+def ipv6_state(entities, gateway):
+    return gateway, tuple(sorted(
+        (
+            e['id'],
+            bool(e.get('enabled')),
+            bool(e.get('rtadv')),
+            bool(e.get('noipv6')),
+            tuple(sorted(a['address'] for a in e.get('aliases', []) if a.get('type') == 'INET6'))
+        )
+        for e in entities
+    ))
+
+
 class RoutingSocketEventSource(threading.Thread):
     def __init__(self, context):
         super(RoutingSocketEventSource, self).__init__()
         self.context = context
         self.client = context.client
-        self.mtu_cache = {}
-        self.flags_cache = {}
-        self.link_state_cache = {}
+        self.cache = {}
+        self.entities = None
+        self.lock = threading.Lock()
+        self.pending_changes = set()
+        self.flush_timer = None
 
     def build_cache(self):
         # Build a cache of certain interface states so we'll later know what has changed
         for i in list(netif.list_interfaces().values()):
-            self.mtu_cache[i.name] = i.mtu
-            self.flags_cache[i.name] = i.flags
-            self.link_state_cache[i.name] = i.link_state
+            self.update_cache(i)
+
+    def update_cache(self, iface):
+        self.cache[iface.name] = {
+            'mtu': iface.mtu,
+            'flags': iface.flags,
+            'link_state': iface.link_state
+        }
+
+    def invalidate_entities(self):
+        self.entities = None
+
+    def get_entities(self):
+        entities = self.entities
+        if entities is None:
+            entities = self.entities = set(self.context.datastore.query('network.interfaces', select='id'))
+
+        return entities
+
+    def interface_changed(self, name):
+        # Changes are collected for a short while and emitted as one event
+        with self.lock:
+            self.pending_changes.add(name)
+            if not self.flush_timer:
+                self.flush_timer = threading.Timer(COALESCE_WINDOW, self.flush_changes)
+                self.flush_timer.start()
+
+    def flush_changes(self):
+        with self.lock:
+            ids, self.pending_changes = self.pending_changes, set()
+            self.flush_timer = None
+
+        if ids:
+            self.client.emit_event('network.interface.changed', {
+                'operation': 'update',
+                'ids': sorted(ids)
+            })
 
     def alias_added(self, message):
         pass
@@ -197,24 +293,41 @@ class RoutingSocketEventSource(threading.Thread):
 
                 if message.type == netif.InterfaceAnnounceType.ARRIVAL:
                     self.context.interface_attached(message.interface)
+                    try:
+                        self.update_cache(netif.get_interface(message.interface))
+                    except (KeyError, NameError, OSError):
+                        # Interface went away before we could query it
+                        self.cache.pop(message.interface, None)
+
                     self.client.emit_event('network.interface.attached', args)
 
                 if message.type == netif.InterfaceAnnounceType.DEPARTURE:
                     self.context.interface_detached(message.interface)
+                    self.cache.pop(message.interface, None)
                     self.client.emit_event('network.interface.detached', args)
 
-                self.build_cache()
-
             if type(message) is netif.InterfaceInfoMessage:
                 ifname = message.interface
-                if self.mtu_cache[ifname] != message.mtu:
+                state = self.cache.get(ifname)
+                if state is None:
+                    # Interface we haven't seen announced, nothing to compare against
+                    self.cache[ifname] = {
+                        'mtu': message.mtu,
+                        'flags': message.flags,
+                        'link_state': message.link_state
+                    }
+
+                    self.interface_changed(ifname)
+                    continue
+
+                if state['mtu'] != message.mtu:
                     self.client.emit_event('network.interface.mtu_changed', {
                         'interface': ifname,
-                        'old-mtu': self.mtu_cache[ifname],
+                        'old-mtu': state['mtu'],
                         'new-mtu': message.mtu
                     })
 
-                if self.link_state_cache[ifname] != message.link_state:
+                if state['link_state'] != message.link_state:
                     if message.link_state == netif.InterfaceLinkState.LINK_STATE_DOWN:
                         self.context.logger.warn('Link down on interface {0}'.format(ifname))
                         self.client.emit_event('network.interface.link_down', {
@@ -227,33 +340,33 @@ class RoutingSocketEventSource(threading.Thread):
                             'interface': ifname,
                         })
 
-                if self.flags_cache[ifname] != message.flags:
-                    if (netif.InterfaceFlags.UP in self.flags_cache) and (netif.InterfaceFlags.UP not in message.flags):
+                if state['flags'] != message.flags:
+                    if (netif.InterfaceFlags.UP in state['flags']) and (netif.InterfaceFlags.UP not in message.flags):
                         self.client.emit_event('network.interface.down', {
                             'interface': ifname,
                         })
 
-                    if (netif.InterfaceFlags.UP not in self.flags_cache) and (netif.InterfaceFlags.UP in message.flags):
+                    if (netif.InterfaceFlags.UP not in state['flags']) and (netif.InterfaceFlags.UP in message.flags):
                         self.client.emit_event('network.interface.up', {
                             'interface': ifname,
                         })
 
                     self.client.emit_event('network.interface.flags_changed', {
                         'interface': ifname,
-                        'old-flags': [f.name for f in self.flags_cache[ifname]],
+                        'old-flags': [f.name for f in state['flags']],
                         'new-flags': [f.name for f in message.flags]
                     })
 
-                self.client.emit_event('network.interface.changed', {
-                    'operation': 'update',
-                    'ids': [ifname]
+                state.update({
+                    'mtu': message.mtu,
+                    'flags': message.flags,
+                    'link_state': message.link_state
                 })
 
-                self.build_cache()
+                self.interface_changed(ifname)
 
             if type(message) is netif.InterfaceAddrMessage:
-                entity = self.context.datastore.get_by_id('network.interfaces', message.interface)
-                if entity is None:
+                if message.interface not in self.get_entities():
                     continue
 
                 # Skip messagess with empty address
@@ -284,10 +397,7 @@ class RoutingSocketEventSource(threading.Thread):
                         message.netmask
                     ))
 
-                self.client.emit_event('network.interface.changed', {
-                    'operation': 'update',
-                    'ids': [entity['id']]
-                })
+                self.interface_changed(message.interface)
 
             if type(message) is netif.RoutingMessage:
                 if message.errno != 0:
@@ -339,6 +449,7 @@ class ConfigurationService(RpcService):
         return wrap(rtable.static_routes)
 
     def configure_network(self):
+        self.context.interfaces_changed()
         if self.config.get('network.autoconfigure'):
             # Try DHCP on each interface until we find lease. Mark failed ones as disabled.
             self.logger.warn('Network in autoconfiguration mode')
@@ -362,58 +473,129 @@ class ConfigurationService(RpcService):
             self.logger.warn('Failed to configure any network interface')
             return
 
-        for i in self.datastore.query('network.interfaces'):
-            self.logger.info('Configuring interface {0}...'.format(i['id']))
-            try:
-                self.configure_interface(i['id'])
-            except BaseException as e:
-                self.logger.warning('Cannot configure {0}: {1}'.format(i['id'], str(e)), exc_info=True)
+        started_at = time.time()
+        timings = {}
+        summary = {
+            'interfaces': {},
+            'failed': {},
+            'destroyed': [],
+            'routes': [],
+            'rtsold_restarted': False,
+            'timings': timings
+        }
+
+        # Take a single snapshot of kernel and datastore state and work from it
+        interfaces = netif.list_interfaces()
+        entities = list(self.datastore.query('network.interfaces'))
+        timings['snapshot'] = time.time() - started_at
+
+        t = time.time()
+        waves = plan_interfaces([e for e in entities if e.get('enabled')])
+        workers = self.config.get('middleware.networkd.workers', DEFAULT_WORKERS)
+        with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+            for wave in waves:
+                futures = {
+                    executor.submit(self.configure_planned, e, interfaces.get(e['id'])): e['id']
+                    for e in wave
+                }
+
+                for future, name in futures.items():
+                    try:
+                        changes = future.result()
+                        if changes:
+                            summary['interfaces'][name] = changes
+                    except BaseException as e:
+                        self.logger.warning('Cannot configure {0}: {1}'.format(name, str(e)), exc_info=True)
+                        summary['failed'][name] = str(e)
 
         # Are there any orphaned interfaces?
-        for name, iface in list(netif.list_interfaces().items()):
+        names = set(e['id'] for e in entities)
+        for name in interfaces:
             if not name.startswith(('vlan', 'lagg', 'bridge')):
                 continue
 
-            if not self.datastore.exists('network.interfaces', ('id', '=', name)):
+            if name not in names:
+                self.logger.info('Destroying orphaned interface {0}'.format(name))
                 netif.destroy_interface(name)
+                summary['destroyed'].append(name)
+
+        timings['interfaces'] = time.time() - t
+
+        t = time.time()
+        if summary['interfaces'] or summary['destroyed']:
+            # Addresses have changed, so local subnets need to be re-read
+            interfaces = netif.list_interfaces()
 
-        self.configure_routes()
+        summary['routes'] = self.configure_routes(interfaces)
+        timings['routes'] = time.time() - t
+
+        t = time.time()
         self.configure_dns()
-        self.client.call_sync('services.restart', 'rtsold')
-        self.client.emit_event('network.changed', {
-            'operation': 'update'
-        })
+        timings['dns'] = time.time() - t
+
+        # rtsold only needs a kick when IPv6 related configuration has changed
+        state = ipv6_state(entities, self.config.get('network.gateway.ipv6'))
+        rtadv_changed = any(
+            e.get('rtadv') for e in entities
+            if e['id'] in summary['interfaces'] or e['id'] in summary['failed']
+        )
 
-    def configure_routes(self):
+        if state != self.context.ipv6_state or rtadv_changed:
+            self.client.call_sync('services.restart', 'rtsold')
+            self.context.ipv6_state = state
+            summary['rtsold_restarted'] = True
+
+        if summary['interfaces'] or summary['destroyed'] or summary['routes'] or summary['rtsold_restarted']:
+            self.client.emit_event('network.changed', {
+                'operation': 'update'
+            })
+
+        timings['total'] = time.time() - started_at
+        self.logger.info('Network configured in {0:.3f}s: {1} interfaces changed, {2} destroyed, {3} route changes'.format(
+            timings['total'],
+            len(summary['interfaces']),
+            len(summary['destroyed']),
+            len(summary['routes'])
+        ))
+
+        return summary
+
+    def configure_routes(self, interfaces=None):
+        changes = []
         rtable = netif.RoutingTable()
-        static_routes = filter_routes(rtable.static_routes)
+        static_routes = list(filter_routes(rtable.static_routes, interfaces))
+        current_ipv4 = rtable.default_route_ipv4
+        current_ipv6 = rtable.default_route_ipv6
         default_route_ipv4 = default_route(self.config.get('network.gateway.ipv4'))
 
         if not self.context.using_dhcp_for_gateway():
             # Default route was deleted
-            if not default_route_ipv4 and rtable.default_route_ipv4:
+            if not default_route_ipv4 and current_ipv4:
                 self.logger.info('Removing default route')
                 try:
-                    rtable.delete(rtable.default_route_ipv4)
+                    rtable.delete(current_ipv4)
+                    changes.append('remove default route')
                 except OSError as e:
                     self.logger.error('Cannot remove default route: {0}'.format(str(e)))
 
             # Default route was added
-            elif not rtable.default_route_ipv4 and default_route_ipv4:
+            elif not current_ipv4 and default_route_ipv4:
                 self.logger.info('Adding default route via {0}'.format(default_route_ipv4.gateway))
                 try:
                     rtable.add(default_route_ipv4)
+                    changes.append('add default route')
                 except OSError as e:
                     self.logger.error('Cannot add default route: {0}'.format(str(e)))
 
             # Default route was changed
-            elif rtable.default_route_ipv4 != default_route_ipv4:
+            elif current_ipv4 != default_route_ipv4:
                 self.logger.info('Changing default route from {0} to {1}'.format(
-                    rtable.default_route.gateway,
+                    current_ipv4.gateway,
                     default_route_ipv4.gateway))
 
                 try:
                     rtable.change(default_route_ipv4)
+                    changes.append('change default route')
                 except OSError as e:
                     self.logger.error('Cannot add default route: {0}'.format(str(e)))
 
@@ -423,30 +605,33 @@ class ConfigurationService(RpcService):
         # Same thing for IPv6
         default_route_ipv6 = default_route(self.config.get('network.gateway.ipv6'))
 
-        if not default_route_ipv6 and rtable.default_route_ipv6:
+        if not default_route_ipv6 and current_ipv6:
             # Default route was deleted
             self.logger.info('Removing default route')
             try:
-                rtable.delete(rtable.default_route_ipv6)
+                rtable.delete(current_ipv6)
+                changes.append('remove default IPv6 route')
             except OSError as e:
                 self.logger.error('Cannot remove default route: {0}'.format(str(e)))
 
-        elif not rtable.default_route_ipv6 and default_route_ipv6:
+        elif not current_ipv6 and default_route_ipv6:
             # Default route was added
             self.logger.info('Adding default route via {0}'.format(default_route_ipv6.gateway))
             try:
                 rtable.add(default_route_ipv6)
+                changes.append('add default IPv6 route')
             except OSError as e:
                 self.logger.error('Cannot add default route: {0}'.format(str(e)))
 
-        elif rtable.default_route_ipv6 != default_route_ipv6:
+        elif current_ipv6 != default_route_ipv6:
             # Default route was changed
             self.logger.info('Changing default route from {0} to {1}'.format(
-                rtable.default_route.gateway,
+                current_ipv6.gateway,
                 default_route_ipv6.gateway))
 
             try:
                 rtable.change(default_route_ipv6)
+                changes.append('change default IPv6 route')
             except OSError as e:
                 self.logger.error('Cannot add default route: {0}'.format(str(e)))
 
@@ -458,6 +643,7 @@ class ConfigurationService(RpcService):
             self.logger.info('Removing static route to {0}'.format(describe_route(i)))
             try:
                 rtable.delete(i)
+                changes.append('remove route to {0}'.format(describe_route(i)))
             except OSError as e:
                 self.logger.error('Cannot remove static route to {0}: {1}'.format(describe_route(i), str(e)))
 
@@ -465,9 +651,12 @@ class ConfigurationService(RpcService):
             self.logger.info('Adding static route to {0}'.format(describe_route(i)))
             try:
                 rtable.add(i)
+                changes.append('add route to {0}'.format(describe_route(i)))
             except OSError as e:
                 self.logger.error('Cannot add static route to {0}: {1}'.format(describe_route(i), str(e)))
 
+        return changes
+
     def configure_dns(self):
         resolv = io.StringIO()
         proc = subprocess.Popen(
@@ -491,6 +680,7 @@ class ConfigurationService(RpcService):
         })
 
     def configure_interface(self, name):
+        self.context.interfaces_changed()
         entity = self.datastore.get_one('network.interfaces', ('id', '=', name))
         if not entity:
             raise RpcException(errno.ENXIO, "Configuration for interface {0} not found".format(name))
@@ -499,14 +689,35 @@ class ConfigurationService(RpcService):
             self.logger.info('Interface {0} is disabled'.format(name))
             return
 
-        try:
-            iface = netif.get_interface(name)
-        except KeyError:
-            if entity.get('cloned'):
-                netif.create_interface(entity['id'])
+        self.apply_interface(entity)
+        self.client.emit_event('network.interface.configured', {
+            'interface': name,
+        })
+
+    def configure_planned(self, entity, iface):
+        changes = self.apply_interface(entity, iface)
+        if changes:
+            self.logger.info('Configured interface {0}: {1}'.format(entity['id'], ', '.join(changes)))
+            self.client.emit_event('network.interface.configured', {
+                'interface': entity['id'],
+            })
+
+        return changes
+
+    def apply_interface(self, entity, iface=None):
+        name = entity['id']
+        changes = []
+
+        if not iface:
+            try:
                 iface = netif.get_interface(name)
-            else:
-                raise RpcException(errno.ENOENT, "Interface {0} not found".format(name))
+            except KeyError:
+                if entity.get('cloned'):
+                    netif.create_interface(entity['id'])
+                    iface = netif.get_interface(name)
+                    changes.append('created')
+                else:
+                    raise RpcException(errno.ENOENT, "Interface {0} not found".format(name))
 
         # If it's VLAN, configure parent and tag
         if entity.get('type') == 'VLAN':
@@ -518,8 +729,10 @@ class ConfigurationService(RpcService):
                 if parent and tag:
                     try:
                         tag = int(tag)
-                        iface.unconfigure()
-                        iface.configure(parent, tag)
+                        if iface.parent != parent or iface.tag != tag:
+                            iface.unconfigure()
+                            iface.configure(parent, tag)
+                            changes.append('vlan')
                     except Exception as e:
                         self.logger.warn('Failed to configure VLAN interface {0}: {1}'.format(name, str(e)))
 
@@ -527,15 +740,29 @@ class ConfigurationService(RpcService):
         if entity.get('type') == 'LAGG':
             lagg = entity.get('lagg')
             if lagg:
-                iface.protocol = getattr(netif.AggregationProtocol, lagg.get('protocol', 'FAILOVER'))
+                protocol = getattr(netif.AggregationProtocol, lagg.get('protocol', 'FAILOVER'))
+                if iface.protocol != protocol:
+                    iface.protocol = protocol
+                    changes.append('protocol')
+
+                ports = set(lagg.get('ports', []))
+                existing_ports = set(p for p, _ in iface.ports)
+
+                for i in existing_ports - ports:
+                    iface.delete_port(i)
+                    changes.append('delete port {0}'.format(i))
 
-                for i in lagg['ports']:
+                for i in ports - existing_ports:
                     iface.add_port(i)
+                    changes.append('add port {0}'.format(i))
 
         if entity.get('dhcp'):
-            self.logger.info('Trying to acquire DHCP lease on interface {0}...'.format(name))
-            if not self.context.configure_dhcp(name):
-                self.logger.warn('Failed to configure interface {0} using DHCP'.format(name))
+            if not self.context.dhcp_running(name):
+                self.logger.info('Trying to acquire DHCP lease on interface {0}...'.format(name))
+                if self.context.configure_dhcp(name):
+                    changes.append('dhcp')
+                else:
+                    self.logger.warn('Failed to configure interface {0} using DHCP'.format(name))
         else:
             addresses = set(convert_aliases(entity))
             existing_addresses = set([a for a in iface.addresses if a.af != netif.AddressFamily.LINK])
@@ -544,48 +771,60 @@ class ConfigurationService(RpcService):
             for i in existing_addresses - addresses:
                 self.logger.info('Removing address from interface {0}: {1}'.format(name, i))
                 iface.remove_address(i)
+                changes.append('remove address {0}'.format(i.address))
 
             # Add new or changed addresses
             for i in addresses - existing_addresses:
                 self.logger.info('Adding new address to interface {0}: {1}'.format(name, i))
                 iface.add_address(i)
+                changes.append('add address {0}'.format(i.address))
 
         # nd6 stuff
+        existing_nd6_flags = iface.nd6_flags
+        nd6_flags = set(existing_nd6_flags)
         if entity.get('rtadv', False):
-            iface.nd6_flags = iface.nd6_flags | {netif.NeighborDiscoveryFlags.ACCEPT_RTADV}
+            nd6_flags.add(netif.NeighborDiscoveryFlags.ACCEPT_RTADV)
         else:
-            iface.nd6_flags = iface.nd6_flags - {netif.NeighborDiscoveryFlags.ACCEPT_RTADV}
+            nd6_flags.discard(netif.NeighborDiscoveryFlags.ACCEPT_RTADV)
 
         if entity.get('noipv6', False):
-            iface.nd6_flags = iface.nd6_flags | {netif.NeighborDiscoveryFlags.IFDISABLED}
-            iface.nd6_flags = iface.nd6_flags - {netif.NeighborDiscoveryFlags.AUTO_LINKLOCAL}
+            nd6_flags.add(netif.NeighborDiscoveryFlags.IFDISABLED)
+            nd6_flags.discard(netif.NeighborDiscoveryFlags.AUTO_LINKLOCAL)
         else:
-            iface.nd6_flags = iface.nd6_flags - {netif.NeighborDiscoveryFlags.IFDISABLED}
-            iface.nd6_flags = iface.nd6_flags | {netif.NeighborDiscoveryFlags.AUTO_LINKLOCAL}
+            nd6_flags.discard(netif.NeighborDiscoveryFlags.IFDISABLED)
+            nd6_flags.add(netif.NeighborDiscoveryFlags.AUTO_LINKLOCAL)
 
-        if entity.get('mtu'):
+        if nd6_flags != set(existing_nd6_flags):
+            iface.nd6_flags = nd6_flags
+            changes.append('nd6')
+
+        if entity.get('mtu') and iface.mtu != entity['mtu']:
             iface.mtu = entity['mtu']
+            changes.append('mtu')
 
-        if entity.get('media'):
+        if entity.get('media') and iface.media_subtype != entity['media']:
             iface.media_subtype = entity['media']
+            changes.append('media')
 
         if entity.get('capabilities'):
-            caps = iface.capabilities
-            for c in entity['capabilities'].get('add'):
+            existing_caps = iface.capabilities
+            caps = set(existing_caps)
+            for c in entity['capabilities'].get('add', []):
                 caps.add(getattr(netif.InterfaceCapability, c))
 
-            for c in entity['capabilities'].get('del'):
-                caps.remove(getattr(netif.InterfaceCapability, c))
+            for c in entity['capabilities'].get('del', []):
+                caps.discard(getattr(netif.InterfaceCapability, c))
 
-            iface.capabilities = caps
+            if caps != set(existing_caps):
+                iface.capabilities = caps
+                changes.append('capabilities')
 
         if netif.InterfaceFlags.UP not in iface.flags:
             self.logger.info('Bringing interface {0} up'.format(name))
             iface.up()
+            changes.append('up')
 
-        self.client.emit_event('network.interface.configured', {
-            'interface': name,
-        })
+        return changes
 
     def up_interface(self, name):
         try:
@@ -622,11 +861,15 @@ class Main:
         self.datastore = None
         self.configstore = None
         self.rtsock_thread = None
+        self.ipv6_state = None
         self.logger = logging.getLogger('networkd')
 
+    def dhcp_running(self, interface):
+        return os.path.exists(os.path.join('/var/run', 'dhclient.{0}.pid'.format(interface)))
+
     def configure_dhcp(self, interface):
         # Check if dhclient is running
-        if os.path.exists(os.path.join('/var/run', 'dhclient.{0}.pid'.format(interface))):
+        if self.dhcp_running(interface):
             self.logger.info('Interface {0} already configured by DHCP'.format(interface))
             return True
 
@@ -640,6 +883,11 @@ class Main:
     def interface_attached(self, name):
         self.logger.warn('Interface {0} attached to the system'.format(name))
 
+    def interfaces_changed(self):
+        # Interface entities might have been created or deleted
+        if self.rtsock_thread:
+            self.rtsock_thread.invalidate_entities()
+
     def using_dhcp_for_gateway(self):
         for i in self.datastore.query('network.interfaces'):
             if i.get('dhcp') and self.configstore.get('network.dhcp.assign_gateway'):
@@ -670,6 +918,8 @@ class Main:
         for i in self.datastore.query('network.interfaces', ('id', 'nin', existing)):
             self.datastore.delete('network.interfaces', i['id'])
 
+        self.interfaces_changed()
+
     def parse_config(self, filename):
         try:
             f = open(filename, 'r')
@@ -689,7 +939,16 @@ class Main:
             self.logger.error('Cannot initialize datastore: %s', str(err))
             sys.exit(1)
 
-        self.configstore = ConfigStore(self.datastore)
+        self.configstore = ConfigStore(self.datastore, notify=self.on_config_set)
+
+    def on_config_set(self, keys):
+        # Let cached config stores in other processes know
+        if self.client:
+            self.client.emit_event('config.changed', {
+                'keys': keys,
+                'pid': os.getpid(),
+                'nolog': True
+            })
 
     def connect(self, resume=False):
         while True:
@@ -716,6 +975,7 @@ class Main:
                 self.connect(resume=True)
 
         self.client = Client()
+        self.client.use_bursts = True
         self.client.on_error(on_error)
         self.connect()
 
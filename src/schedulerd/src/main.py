@@ -25,6 +25,7 @@
 #
 #####################################################################
 
+import os
 import sys
 import json
 import time
@@ -34,6 +35,9 @@ import argparse
 import socket
 import uuid
 import pytz
+import threading
+from apscheduler.events import EVENT_JOB_MISSED
+from apscheduler.executors.pool import ThreadPoolExecutor
 from apscheduler.schedulers.background import BackgroundScheduler
 from apscheduler.jobstores.mongodb import MongoDBJobStore
 from datastore import get_datastore, DatastoreException
@@ -41,11 +45,15 @@ from datastore.config import ConfigStore
 from freenas.dispatcher.rpc import RpcService, RpcException, private
 from freenas.dispatcher.client import Client, ClientError
 from freenas.utils import exclude, configure_logging
-from freenas.utils.query import wrap
+from freenas.utils.query import run_query
 from freenas.utils.debug import DebugService
 
 
 DEFAULT_CONFIGFILE = '/usr/local/etc/middleware.conf'
+DEFAULT_MAX_CONCURRENCY = 1
+DEFAULT_MISFIRE_GRACE_TIME = 60
+DEFAULT_WORKERS = 20
+TERMINAL_STATES = ('FINISHED', 'FAILED', 'ABORTED')
 context = None
 
 
@@ -53,6 +61,13 @@ def job(*args, **kwargs):
     return context.run_job(*args, **kwargs)
 
 
+def uses_status(rule):
+    if len(rule) == 2:
+        return any(uses_status(r) for r in rule[1])
+
+    return rule[0].split('.')[0] == 'status'
+
+
 class ManagementService(RpcService):
     def __init__(self, context):
         self.context = context
@@ -60,27 +75,9 @@ class ManagementService(RpcService):
     @private
     def query(self, filter=None, params=None):
         def serialize(job):
-            last_task = None
-            current_task = None
-            current_progress = None
             schedule = {f.name: f for f in job.trigger.fields}
             schedule['coalesce'] = job.coalesce
-
-            last_run = self.context.datastore.query(
-                'schedulerd.runs',
-                ('job_id', '=', job.id),
-                sort='created_at',
-                single=True
-            )
-
-            if last_run:
-                last_task = self.context.datastore.get_by_id('tasks', last_run['task_id'])
-
-            if job.id in self.context.active_tasks:
-                current_task_id = self.context.active_tasks[job.id]
-                current_task = self.context.client.call_sync('task.status', current_task_id)
-                if 'progress' in current_task:
-                    current_progress = current_task['progress']
+            schedule['max_concurrency'] = job.kwargs.get('max_concurrency')
 
             return {
                 'id': job.id,
@@ -88,17 +85,61 @@ class ManagementService(RpcService):
                 'name': job.args[0],
                 'args': job.args[1:],
                 'enabled': job.next_run_time is not None,
-                'status': {
-                    'next_run_time': job.next_run_time,
-                    'last_run_time': last_run['created_at'] if last_run else None,
-                    'last_run_status': last_task['state'] if last_task else None,
-                    'current_run_status': current_task['state'] if current_task else None,
-                    'current_run_progress': current_progress
-                },
                 'schedule': schedule
             }
 
-        return wrap(list(map(serialize, self.context.scheduler.get_jobs()))).query(*(filter or []), **(params or {}))
+        def extend(entry):
+            job = jobs[entry['id']]
+            stats = self.context.get_job_stats(job.id)
+            last_run = self.context.last_runs.get(job.id)
+            running = active_tasks.get(job.id)
+            current_task = current_tasks.get(running[-1]) if running else None
+
+            entry['status'] = {
+                'next_run_time': job.next_run_time,
+                'last_run_time': last_run['last_run_time'] if last_run else None,
+                'last_run_status': last_run['state'] if last_run else None,
+                'current_run_status': current_task['state'] if current_task else None,
+                'current_run_progress': current_task.get('progress') if current_task else None,
+                'running': len(running or []),
+                'skipped': stats['skipped'],
+                'misfires': stats['misfires'],
+                'last_misfire_time': stats['last_misfire_time']
+            }
+
+            return entry
+
+        # Rules which don't look at status are applied before status is
+        # generated, so only matching jobs are extended
+        filter = filter or []
+        jobs = {j.id: j for j in self.context.scheduler.get_jobs()}
+        with self.context.lock:
+            active_tasks = {k: list(v) for k, v in self.context.active_tasks.items()}
+
+        result = run_query(
+            [serialize(j) for j in jobs.values()],
+            *[r for r in filter if not uses_status(r)]
+        )
+
+        # Fetch all running tasks of matching jobs in a single call
+        # (slots still being submitted are reserved with None)
+        current_task_ids = [
+            active_tasks[i['id']][-1] for i in result
+            if active_tasks.get(i['id']) and active_tasks[i['id']][-1] is not None
+        ]
+
+        current_tasks = {}
+        if current_task_ids:
+            current_tasks = {
+                t['id']: t for t in
+                self.context.client.call_sync('task.query', [('id', 'in', current_task_ids)])
+            }
+
+        return run_query(
+            [extend(i) for i in result],
+            *[r for r in filter if uses_status(r)],
+            **(params or {})
+        )
 
     @private
     def add(self, task):
@@ -108,14 +149,18 @@ class ManagementService(RpcService):
         else:
             task_id = task['id']
 
+        kwargs = {'id': task_id}
+        if task['schedule'].get('max_concurrency'):
+            kwargs['max_concurrency'] = task['schedule']['max_concurrency']
+
         self.context.logger.info('Adding new job with ID {0}'.format(task_id))
         self.context.scheduler.add_job(
             job,
             trigger='cron',
             id=task_id,
             args=[task['name']] + task['args'],
-            kwargs={'id': task_id},
-            **task['schedule']
+            kwargs=kwargs,
+            **exclude(task['schedule'], 'max_concurrency')
         )
 
         return task_id
@@ -124,6 +169,8 @@ class ManagementService(RpcService):
     def delete(self, job_id):
         self.context.logger.info('Deleting job with ID {0}'.format(job_id))
         self.context.scheduler.remove_job(job_id)
+        self.context.last_runs.pop(job_id, None)
+        self.context.datastore.delete('schedulerd.last_runs', job_id)
 
     @private
     def update(self, job_id, updated_params):
@@ -147,10 +194,17 @@ class ManagementService(RpcService):
                     job_id,
                     coalesce=updated_params['schedule']['coalesce'])
 
+            if 'max_concurrency' in updated_params['schedule']:
+                kwargs = exclude(job.kwargs, 'max_concurrency')
+                if updated_params['schedule']['max_concurrency']:
+                    kwargs['max_concurrency'] = updated_params['schedule']['max_concurrency']
+
+                self.context.scheduler.modify_job(job_id, kwargs=kwargs)
+
             self.context.scheduler.reschedule_job(
                 job_id,
                 trigger='cron',
-                **exclude(updated_params['schedule'], 'coalesce')
+                **exclude(updated_params['schedule'], 'coalesce', 'max_concurrency')
             )
 
     @private
@@ -158,9 +212,10 @@ class ManagementService(RpcService):
         self.context.logger.info('Running job {0} manualy'.format(job_id))
         job = self.context.scheduler.get_job(job_id)
         self.context.scheduler.add_job(
+            job.func,
             id=job_id + '-temp',
             args=job.args,
-            kwargs=job.kwargs,
+            kwargs=dict(job.kwargs, manual=True),
         )
 
 
@@ -172,7 +227,13 @@ class Context(object):
         self.configstore = None
         self.client = None
         self.scheduler = None
+        self.lock = threading.RLock()
         self.active_tasks = {}
+        self.task_jobs = {}
+        self.pending_submits = 0
+        self.early_updates = {}
+        self.job_stats = {}
+        self.last_runs = {}
 
     def init_datastore(self):
         try:
@@ -181,23 +242,84 @@ class Context(object):
             self.logger.error('Cannot initialize datastore: %s', str(err))
             sys.exit(1)
 
-        self.configstore = ConfigStore(self.datastore)
+        self.configstore = ConfigStore(self.datastore, notify=self.on_config_set)
+        self.datastore.collection_create('schedulerd.runs', 'uuid', {
+            'type': 'log',
+            'indexes': [['job_id', 'created_at']]
+        })
+        self.datastore.collection_create('schedulerd.last_runs', 'native', {'type': 'log'})
+
+    def on_config_set(self, keys):
+        # Let cached config stores in other processes know
+        if self.client:
+            self.client.emit_event('config.changed', {
+                'keys': keys,
+                'pid': os.getpid(),
+                'nolog': True
+            })
 
     def init_dispatcher(self):
         def on_error(reason, **kwargs):
             if reason in (ClientError.CONNECTION_CLOSED, ClientError.LOGOUT):
                 self.logger.warning('Connection to dispatcher lost')
                 self.connect()
+                # Tasks might have finished while disconnected
+                self.sync_active_tasks()
 
         self.client = Client()
         self.client.on_error(on_error)
         self.connect()
+        self.client.register_event_handler('task.updated', self.on_task_updated)
 
     def init_scheduler(self):
         store = MongoDBJobStore(database='freenas', collection='calendar_tasks', client=self.datastore.client)
-        self.scheduler = BackgroundScheduler(jobstores={'default': store}, timezone=pytz.utc)
+        workers = self.configstore.get('middleware.scheduler.workers', DEFAULT_WORKERS)
+        grace_time = self.configstore.get('middleware.scheduler.misfire_grace_time', DEFAULT_MISFIRE_GRACE_TIME)
+        self.scheduler = BackgroundScheduler(
+            jobstores={'default': store},
+            executors={'default': ThreadPoolExecutor(workers)},
+            job_defaults={'misfire_grace_time': grace_time},
+            timezone=pytz.utc
+        )
+        self.scheduler.add_listener(self.on_job_missed, EVENT_JOB_MISSED)
         self.scheduler.start()
 
+        # Jobs created earlier keep the grace time they were stored with
+        for i in self.scheduler.get_jobs():
+            if i.misfire_grace_time != grace_time:
+                self.scheduler.modify_job(i.id, misfire_grace_time=grace_time)
+
+    def init_last_runs(self):
+        self.last_runs = {i['id']: i for i in self.datastore.query('schedulerd.last_runs')}
+
+        # Summaries are maintained since they were introduced, older jobs
+        # need to be looked up in the runs log once
+        for i in self.scheduler.get_jobs():
+            if i.id in self.last_runs:
+                continue
+
+            run = self.datastore.query('schedulerd.runs', ('job_id', '=', i.id), sort='-created_at', single=True)
+            if not run:
+                continue
+
+            state = run.get('state')
+            if not state:
+                task = self.datastore.get_by_id('tasks', run['task_id'])
+                state = task['state'] if task else None
+
+            self.update_last_run(i.id, run['task_id'], state, run['created_at'])
+
+    def update_last_run(self, job_id, task_id, state, timestamp):
+        summary = {
+            'id': job_id,
+            'task_id': task_id,
+            'state': state,
+            'last_run_time': timestamp
+        }
+
+        self.last_runs[job_id] = summary
+        self.datastore.upsert('schedulerd.last_runs', job_id, summary)
+
     def register_schemas(self):
         self.client.register_schema('calendar-task', {
             'type': 'object',
@@ -215,6 +337,7 @@ class Context(object):
                     'additionalProperties': False,
                     'properties': {
                         'coalesce': {'type': ['boolean', 'integer', 'null']},
+                        'max_concurrency': {'type': ['integer', 'null']},
                         'year': {'type': ['string', 'integer', 'null']},
                         'month': {'type': ['string', 'integer', 'null']},
                         'day': {'type': ['string', 'integer', 'null']},
@@ -234,7 +357,11 @@ class Context(object):
                 'next_run_time': {'type': 'string'},
                 'last_run_status': {'type': 'string'},
                 'current_run_status': {'type': ['string', 'null']},
-                'current_run_progress': {'type': ['object', 'null']}
+                'current_run_progress': {'type': ['object', 'null']},
+                'running': {'type': 'integer'},
+                'skipped': {'type': 'integer'},
+                'misfires': {'type': 'integer'},
+                'last_misfire_time': {'type': ['string', 'null']}
             }
         })
 
@@ -243,6 +370,7 @@ class Context(object):
             try:
                 self.client.connect('127.0.0.1')
                 self.client.login_service('schedulerd')
+                self.client.subscribe_events('task.updated')
                 self.client.enable_server()
                 self.client.register_service('scheduler.management', ManagementService(self))
                 self.client.register_service('scheduler.debug', DebugService())
@@ -253,27 +381,122 @@ class Context(object):
                 self.logger.warning('Cannot connect to dispatcher: {0}, retrying in 1 second'.format(str(err)))
                 time.sleep(1)
 
+    def get_job_stats(self, job_id):
+        with self.lock:
+            return self.job_stats.setdefault(job_id, {
+                'runs': 0,
+                'failures': 0,
+                'skipped': 0,
+                'misfires': 0,
+                'last_misfire_time': None
+            })
+
     def run_job(self, *args, **kwargs):
-        tid = self.client.submit_task(*args)
-        self.active_tasks[kwargs['id']] = tid
-        self.client.call_sync('task.wait', tid, timeout=None)
-        result = self.client.call_sync('task.status', tid)
-        if result['state'] != 'FINISHED':
+        # Only submits the task, completion is tracked through task.updated
+        # events so that scheduler threads are never blocked by long tasks
+        job_id = kwargs['id']
+        limit = kwargs.get('max_concurrency') or \
+            self.configstore.get('middleware.scheduler.max_concurrency', DEFAULT_MAX_CONCURRENCY)
+
+        with self.lock:
+            stats = self.get_job_stats(job_id)
+            running = self.active_tasks.setdefault(job_id, [])
+            if len(running) >= limit and not kwargs.get('manual'):
+                stats['skipped'] += 1
+                self.logger.warning('Skipping run of job {0}: {1} run(s) still in progress'.format(job_id, len(running)))
+                return
+
+            # Reserve the slot so that concurrent runs see it taken while
+            # the task is being submitted outside of the lock
+            running.append(None)
+            self.pending_submits += 1
+
+        tid = None
+        try:
+            tid = self.client.submit_task(*args)
+        finally:
+            with self.lock:
+                self.pending_submits -= 1
+                running = self.active_tasks[job_id]
+                running.remove(None)
+                if tid is None:
+                    if not running:
+                        del self.active_tasks[job_id]
+                else:
+                    running.append(tid)
+                    self.task_jobs[tid] = (job_id, args[0])
+                    stats['runs'] += 1
+
+                # Task might have finished before it was registered above
+                early = self.early_updates.pop(tid, None)
+                if not self.pending_submits:
+                    self.early_updates.clear()
+
+        if early:
+            self.on_task_updated(early)
+
+    def on_task_updated(self, args):
+        if args['state'] not in TERMINAL_STATES:
+            return
+
+        with self.lock:
+            job = self.task_jobs.pop(args['id'], None)
+            if not job:
+                if self.pending_submits:
+                    self.early_updates[args['id']] = args
+                return
+
+            job_id, name = job
+            running = self.active_tasks[job_id]
+            running.remove(args['id'])
+            if not running:
+                del self.active_tasks[job_id]
+
+            if args['state'] != 'FINISHED':
+                self.get_job_stats(job_id)['failures'] += 1
+
+        if args['state'] != 'FINISHED':
             try:
+                result = self.client.call_sync('task.status', args['id'])
                 self.client.call_sync('alerts.emit', {
                     'name': 'scheduler.task.failed',
                     'severity': 'CRITICAL',
-                    'description': 'Task {0} has failed: {1}'.format(kwargs['name'], result['error']['message']),
+                    'description': 'Task {0} has failed: {1}'.format(
+                        name,
+                        (result.get('error') or {}).get('message', args['state'])
+                    ),
                 })
             except RpcException as e:
                 self.logger.error('Failed to emit alert', exc_info=True)
 
-        del self.active_tasks[kwargs['id']]
-        self.datastore.insert('schedulerd.runs', {
-            'job_id': kwargs['id'],
-            'task_id': result['id']
+        run_id = self.datastore.insert('schedulerd.runs', {
+            'job_id': job_id,
+            'task_id': args['id'],
+            'state': args['state']
         })
 
+        # Same timestamp init_last_runs() picks up after a restart
+        run = self.datastore.get_by_id('schedulerd.runs', run_id)
+        self.update_last_run(job_id, args['id'], args['state'], run['created_at'])
+
+    def on_job_missed(self, event):
+        stats = self.get_job_stats(event.job_id)
+        with self.lock:
+            stats['misfires'] += 1
+            stats['last_misfire_time'] = event.scheduled_run_time
+
+        self.logger.warning('Job {0} missed its run time {1}'.format(event.job_id, event.scheduled_run_time))
+
+    def sync_active_tasks(self):
+        with self.lock:
+            tids = list(self.task_jobs.keys())
+
+        for i in tids:
+            try:
+                self.on_task_updated(self.client.call_sync('task.status', i))
+            except RpcException as err:
+                self.logger.warning('Cannot get status of task {0}: {1}'.format(i, str(err)))
+
     def parse_config(self, filename):
         try:
             f = open(filename, 'r')
@@ -299,6 +522,7 @@ class Context(object):
         self.parse_config(args.c)
         self.init_datastore()
         self.init_scheduler()
+        self.init_last_runs()
         self.init_dispatcher()
         self.register_schemas()
         self.client.wait_forever()
@@ -27,7 +27,10 @@
 
 
 import re
+import heapq
 import inspect
+import itertools
+import functools
 import dateutil.parser
 
 from six import string_types
@@ -51,60 +54,151 @@ conversions_table = {
 }
 
 
-def eval_logic_and(item, lst):
-    for i in lst:
-        if not eval_tuple(item, i):
-            return False
+_missing = object()
 
-    return True
 
+def split_path(path):
+    return [i.replace(r'\.', '.') for i in re.split(r'(?<!\\)\.', path)]
 
-def eval_logic_or(item, lst):
-    for i in lst:
-        if eval_tuple(item, i):
-            return True
 
-    return False
+def resolve_path(obj, parts):
+    for i in parts:
+        if not isinstance(obj, (dict, list, tuple)) and hasattr(obj, '__getstate__'):
+            obj = obj.__getstate__()
 
+        if isinstance(obj, dict):
+            obj = obj[i]
+        elif isinstance(obj, (list, tuple)):
+            obj = obj[int(i)]
+        else:
+            raise KeyError(i)
 
-def eval_logic_nor(item, lst):
-    for i in lst:
-        if eval_tuple(item, i):
-            return False
+    return obj
 
-    return True
 
+def get_path(obj, path, default=_missing):
+    """
+    Resolves dotted path against an object without wrapping it. Raises
+    KeyError when path does not exist, unless default is given.
+    """
+    try:
+        if isinstance(obj, (QueryDict, QueryList)):
+            return obj[path]
 
-def eval_logic_operator(item, t):
-    op, lst = t
-    return globals()['eval_logic_{0}'.format(op)](item, lst)
+        return resolve_path(obj, split_path(path))
+    except (KeyError, IndexError, ValueError):
+        if default is _missing:
+            raise KeyError(path)
 
+        return default
 
-def eval_field_operator(item, t):
-    left, op, right = t
 
-    if len(t) == 4:
-        right = conversions_table[t[3]](right)
+def compile_getter(path):
+    if not isinstance(path, string_types):
+        return lambda obj: obj[path]
 
-    return operators_table[op](item[left], right)
+    parts = split_path(path)
+
+    def getter(obj):
+        if isinstance(obj, (QueryDict, QueryList)):
+            return obj[path]
+
+        # Fast path for top level keys of plain dicts
+        if len(parts) == 1 and isinstance(obj, dict):
+            return obj[parts[0]]
+
+        try:
+            return resolve_path(obj, parts)
+        except (IndexError, ValueError):
+            raise KeyError(path)
 
+    return getter
 
-def eval_tuple(item, t):
+
+def compile_rule(t):
     if len(t) == 2:
-        return eval_logic_operator(item, t)
+        op, lst = t
+        rules = [compile_rule(i) for i in lst]
+
+        if op == 'and':
+            return lambda item: all(r(item) for r in rules)
+
+        if op == 'or':
+            return lambda item: any(r(item) for r in rules)
+
+        if op == 'nor':
+            return lambda item: not any(r(item) for r in rules)
+
+        raise ValueError('Invalid logic operator {0}'.format(op))
 
     if len(t) in (3, 4):
-        return eval_field_operator(item, t)
+        left, op, right = t[:3]
+        getter = compile_getter(left)
 
+        if len(t) == 4:
+            right = conversions_table[t[3]](right)
 
-def matches(obj, *rules):
-    fail = False
-    for r in rules:
-        if not eval_tuple(obj, r):
-            fail = True
-            break
+        if op == '~':
+            pattern = re.compile(right)
+            return lambda item: pattern.match(getter(item))
+
+        operator = operators_table[op]
+        return lambda item: operator(getter(item), right)
+
+    raise ValueError('Invalid rule {0}'.format(t))
+
+
+def compile_rules(rules):
+    compiled = [compile_rule(r) for r in rules]
+    if not compiled:
+        return None
+
+    if len(compiled) == 1:
+        return compiled[0]
+
+    return lambda item: all(r(item) for r in compiled)
+
+
+def compile_sort(sort):
+    """
+    Returns (key function, reverse) pair equivalent to sorting by given
+    keys, first key being the most significant one.
+    """
+    if isinstance(sort, string_types):
+        sort = [sort]
+
+    keys = []
+    for i in sort or []:
+        reverse = i.startswith('-')
+        keys.append((compile_getter(i[1:] if reverse else i), reverse))
+
+    if not keys:
+        return None, False
+
+    if len(set(r for _, r in keys)) == 1:
+        getters = [g for g, _ in keys]
+        if len(getters) == 1:
+            return getters[0], keys[0][1]
+
+        return lambda obj: tuple(g(obj) for g in getters), keys[0][1]
+
+    def compare(a, b):
+        for getter, reverse in keys:
+            x, y = getter(a), getter(b)
+            if x == y:
+                continue
+
+            result = -1 if x < y else 1
+            return -result if reverse else result
+
+        return 0
 
-    return not fail
+    return functools.cmp_to_key(compare), False
+
+
+def matches(obj, *rules):
+    predicate = compile_rules(rules)
+    return not predicate or bool(predicate(obj))
 
 
 def filter_and_map(fn, items):
@@ -116,6 +210,67 @@ def filter_and_map(fn, items):
         yield result
 
 
+def run_query(obj, *rules, **params):
+    """
+    Runs a query against list of plain objects. Rules and sort keys are
+    compiled once, paths are resolved lazily on the original objects and
+    items are processed as a stream, so that count and single queries
+    stop as soon as possible and sorted queries with limit only keep the
+    top items in a heap.
+    """
+    single = params.pop('single', False)
+    count = params.pop('count', None)
+    offset = params.pop('offset', None) or 0
+    limit = params.pop('limit', None)
+    sort = params.pop('sort', None)
+    postprocess = params.pop('callback', None)
+    select = params.pop('select', None)
+
+    if not isinstance(obj, (list, tuple)) and hasattr(obj, '__getstate__'):
+        obj = obj.__getstate__()
+
+    predicate = compile_rules(rules)
+    items = filter(predicate, obj) if predicate else iter(obj)
+
+    if select:
+        def select_fn(fn, obj):
+            obj = fn(obj) if fn else obj
+
+            if isinstance(select, (list, tuple)):
+                return [get_path(obj, i, None) for i in select]
+
+            if isinstance(select, str):
+                return get_path(obj, select, None)
+
+        old = postprocess
+        postprocess = lambda o: select_fn(old, o)
+
+    key, reverse = compile_sort(sort)
+    if key:
+        # Callback may filter items out, so single query can't stop at the first one then
+        if single and not limit and not postprocess:
+            limit = 1
+
+        if limit:
+            select_top = heapq.nlargest if reverse else heapq.nsmallest
+            items = iter(select_top(offset + limit, items, key=key))
+        else:
+            items = iter(sorted(items, key=key, reverse=reverse))
+
+    items = itertools.islice(items, offset, offset + limit if limit else None)
+
+    if postprocess:
+        items = filter_and_map(postprocess, items)
+
+    if single:
+        return next(items, None)
+
+    if count:
+        return sum(1 for _ in items)
+
+    return list(items)
+
+
 def partition(s):
     res = re.split(r'(?<!\\)\.', s, maxsplit=1)
     left = res[0].replace(r'\.', '.')
@@ -218,73 +373,7 @@ class QueryList(list):
         super(QueryList, self).__setitem__(key, value)
 
     def query(self, *rules, **params):
-        single = params.pop('single', False)
-        count = params.pop('count', None)
-        offset = params.pop('offset', None)
-        limit = params.pop('limit', None)
-        sort = params.pop('sort', None)
-        postprocess = params.pop('callback', None)
-        select = params.pop('select', None)
-        result = []
-
-        if len(rules) == 0:
-            result = list(self)
-        else:
-            for i in self:
-                if matches(i, *rules):
-                    result.append(i)
-
-        if select:
-            def select_fn(fn, obj):
-                obj = fn(obj) if fn else obj
-                obj = wrap(obj)
-
-                if isinstance(select, (list, tuple)):
-                    return [obj.get(i) for i in select]
-
-                if isinstance(select, str):
-                    return obj.get(select)
-
-            old = postprocess
-            postprocess = lambda o: select_fn(old, o)
-
-        if sort:
-            def sort_transform(result, key):
-                reverse = False
-                if key.startswith('-'):
-                    key = key[1:]
-                    reverse=True
-                result.append((key, reverse))
-
-            _sort = []
-            if isinstance(sort, string_types):
-                sort_transform(_sort, sort)
-            elif isinstance(sort, (tuple, list)):
-                for s in sort:
-                    sort_transform(_sort, s)
-            if _sort:
-                for key, reverse in reversed(_sort):
-                    result = sorted(result, key=lambda x: x[key], reverse=reverse)
-
-        if offset:
-            result = result[offset:]
-
-        if limit:
-            result = result[:limit]
-
-        if not result and single:
-            return None
-
-        if postprocess:
-            result = list(filter_and_map(postprocess, result))
-
-        if single:
-            return result[0]
-
-        if count:
-            return len(result)
-
-        return result
+        return run_query(self, *rules, **params)
 
 
 class QueryDict(dict):
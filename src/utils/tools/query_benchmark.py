@@ -0,0 +1,104 @@
+#!/usr/local/bin/python3
+#+
+# Copyright 2016 iXsystems, Inc.
+# All rights reserved
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted providing that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR ``AS IS'' AND ANY EXPRESS OR
+# IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT,
+# STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING
+# IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+#####################################################################
+
+
+import os
+import sys
+import time
+import copy
+import random
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from freenas.utils.query import wrap, run_query
+
+
+QUERIES = [
+    ('filter', [('properties.used.rawvalue', '>', 500000)], {}),
+    ('regex', [('name', '~', '^tank/ds1')], {}),
+    ('sort+limit', [('type', '=', 'FILESYSTEM')], {'sort': '-properties.used.rawvalue', 'limit': 10}),
+    ('count', [('properties.compression.value', '=', 'lz4')], {'count': True}),
+    ('single', [('name', '=', 'tank/ds5')], {'single': True}),
+]
+
+
+def generate(count):
+    return [
+        {
+            'name': 'tank/ds{0}'.format(i),
+            'type': random.choice(['FILESYSTEM', 'VOLUME']),
+            'mountpoint': '/mnt/tank/ds{0}'.format(i),
+            'properties': {
+                'used': {'value': None, 'rawvalue': random.randint(0, 1000000)},
+                'compression': {'value': random.choice(['lz4', 'off', 'gzip'])},
+                'atime': {'value': 'on'}
+            }
+        }
+        for i in range(count)
+    ]
+
+
+def measure(fn, iterations):
+    start = time.time()
+    for i in range(iterations):
+        result = fn()
+
+    return (time.time() - start) / iterations, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare wrapped QueryList queries with run_query()')
+    parser.add_argument('--objects', type=int, default=20000, help='Number of objects')
+    parser.add_argument('--iterations', type=int, default=5, help='Iterations per query')
+    args = parser.parse_args()
+
+    items = generate(args.objects)
+    for name, rules, params in QUERIES:
+        wrapped_time, expected = measure(
+            lambda: wrap(copy.copy(items)).query(*rules, **copy.copy(params)),
+            args.iterations
+        )
+
+        compiled_time, result = measure(
+            lambda: run_query(items, *rules, **copy.copy(params)),
+            args.iterations
+        )
+
+        if result != expected:
+            raise AssertionError('Results differ for query {0}'.format(name))
+
+        print('{0:>12}: wrap().query() {1:.4f}s, run_query() {2:.4f}s, {3:.1f}x'.format(
+            name,
+            wrapped_time,
+            compiled_time,
+            wrapped_time / compiled_time
+        ))
+
+
+if __name__ == '__main__':
+    main()